@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бектест політики керування зарядкою на записаній телеметрії.
+
+Завантажує ряди SOC та потужності мережі (CSV, Parquet або файл історії
+HISTORY_FILE) і проганяє через них правило увімкнення/вимкнення з
+ChargeStateMachine для сітки параметрів: пороги SOC та імпорту,
+гістерезис, інтервал перевірки, EMA-згладжування, мінімальні часи у стані,
+ліміт команд на годину та тривалість імпорту для вимкнення.
+
+Модель:
+- з записаної потужності мережі віднімається навантаження зарядки, що
+  заряджала під час запису (charger_state = 2, струм current_a), - це
+  потужність мережі "без EV"
+- увімкнена в симуляції зарядка додає до неї CHARGING_CURRENT_A x напруга x
+  фази; SOC береться як записаний (без зворотного впливу на батарею)
+- рішення приймаються на сітці CHECK_INTERVAL_SEC (пропущені тики не
+  накопичуються, як у FixedRateTicker)
+- імпорт вище порогу вимикає зарядку (і не заважає увімкненню) лише якщо
+  за останні --import-window секунд він тривав не менше GRID_IMPORT_MAX_SEC
+  (як import_above_sec з InverterSampler; 0 = кожне значення тривале)
+- команда понад MAX_COMMANDS_PER_HOUR за останню годину придушується
+
+Усі комбінації параметрів рахуються одночасно: стан кожної - елемент
+масивів NumPy, один прохід по часу оновлює всю сітку векторними
+операціями. Сітка ділиться на частини між процесами (ядрами CPU).
+
+Звіт для кожної комбінації: енергія в EV (kWh), імпорт з мережі,
+спричинений зарядкою (kWh), частка EV з власної генерації та кількість
+циклів увімкнення.
+
+Потрібен NumPy (pip install numpy), для Parquet - pyarrow.
+
+Використання:
+    python backtest.py data/history.bin
+    python backtest.py telemetry.csv --soc 85:96:5 --soc-hysteresis 0,5 \\
+        --grid 100,250,500 --interval 60,120,300 --ema-tau 0,30 --top 10
+"""
+
+import argparse
+import csv
+import math
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import product
+from typing import Dict, List
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("Для бектесту потрібен NumPy: pip install numpy")
+
+# Значення за замовчуванням - поточні налаштування з .env (LOGGER_SN main.py не потрібен)
+os.environ.setdefault("LOGGER_SN", "0")
+import main as controller  # noqa: E402
+
+# Параметри сітки: (назва, опис, значення за замовчуванням)
+PARAMETERS = (
+    ("soc", "SOC увімкнення (%)", controller.SOC_THRESHOLD),
+    ("soc_hysteresis", "SOC_THRESHOLD - SOC_OFF_THRESHOLD (%)",
+     controller.SOC_THRESHOLD - controller.SOC_OFF_THRESHOLD),
+    ("grid", "Максимальний імпорт для увімкнення (W)", controller.GRID_IMPORT_THRESHOLD),
+    ("grid_off_ratio", "GRID_IMPORT_OFF_THRESHOLD / GRID_IMPORT_THRESHOLD",
+     controller.GRID_IMPORT_OFF_THRESHOLD / controller.GRID_IMPORT_THRESHOLD
+     if controller.GRID_IMPORT_THRESHOLD else 1.0),
+    ("interval", "Інтервал перевірки (сек)", controller.CHECK_INTERVAL_SEC),
+    ("ema_tau", "Стала часу EMA мережі (сек, 0 = без згладжування)",
+     controller.GRID_EMA_TAU_SEC if controller.SAMPLE_INTERVAL_SEC > 0 else 0.0),
+    ("min_on", "Мінімальний час ВВІМК (сек)", controller.MIN_ON_TIME_SEC),
+    ("min_off", "Мінімальний час ВИМК (сек)", controller.MIN_OFF_TIME_SEC),
+    ("max_commands", "Ліміт команд на годину (0 = без ліміту)", controller.MAX_COMMANDS_PER_HOUR),
+    ("import_max", "Тривалість імпорту для вимкнення, GRID_IMPORT_MAX_SEC (сек, 0 = одразу)",
+     controller.GRID_IMPORT_MAX_SEC if controller.SAMPLE_INTERVAL_SEC > 0 else 0.0),
+)
+RESULT_COLUMNS = ("ev_kwh", "ev_import_kwh", "self_use_pct", "cycles")
+# Поріг напрямку "import" (див. DeyeInverter.grid_direction)
+IMPORT_DIRECTION_W = 10.0
+
+
+# ============================================================
+# Завантаження телеметрії
+# ============================================================
+
+
+def _parse_timestamp(value: str) -> float:
+    """Unix-час (секунди) або ISO 8601."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _float_or_nan(value) -> float:
+    return math.nan if value in (None, "") else float(value)
+
+
+def load_csv(path: str) -> Dict[str, "np.ndarray"]:
+    """CSV з колонками timestamp, battery_soc_pct, grid_power_w [, charger_state, current_a]."""
+    columns: Dict[str, List[float]] = {
+        "timestamp": [], "battery_soc_pct": [], "grid_power_w": [],
+        "charger_state": [], "current_a": [],
+    }
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            columns["timestamp"].append(_parse_timestamp(row["timestamp"]))
+            columns["battery_soc_pct"].append(_float_or_nan(row["battery_soc_pct"]))
+            columns["grid_power_w"].append(_float_or_nan(row["grid_power_w"]))
+            state = row.get("charger_state")
+            columns["charger_state"].append(
+                controller.CHARGER_STATE_UNKNOWN if state in (None, "") else int(float(state))
+            )
+            columns["current_a"].append(_float_or_nan(row.get("current_a")))
+    return {name: np.asarray(values, dtype=float) for name, values in columns.items()}
+
+
+def load_parquet(path: str) -> Dict[str, "np.ndarray"]:
+    """Parquet з тими ж колонками, що й CSV (timestamp - число або timestamp)."""
+    try:
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        sys.exit("Для Parquet потрібен pyarrow: pip install pyarrow")
+    table = pq.read_table(path)
+    timestamps = table.column("timestamp")
+    if str(timestamps.type).startswith("timestamp"):
+        timestamps = pc.divide(pc.cast(pc.cast(timestamps, "timestamp[ms]"), "int64"), 1000.0)
+    data = {"timestamp": timestamps.to_numpy().astype(float)}
+    for name, default in (
+        ("battery_soc_pct", None),
+        ("grid_power_w", None),
+        ("charger_state", float(controller.CHARGER_STATE_UNKNOWN)),
+        ("current_a", math.nan),
+    ):
+        if name in table.column_names:
+            data[name] = table.column(name).to_numpy(zero_copy_only=False).astype(float)
+        elif default is None:
+            sys.exit(f"{path}: немає колонки {name}")
+        else:
+            data[name] = np.full(len(data["timestamp"]), default)
+    return data
+
+
+def load_history(path: str) -> Dict[str, "np.ndarray"]:
+    """
+    Файл історії TelemetryHistory (HISTORY_FILE) лише для читання.
+
+    Файл не відкривається через TelemetryHistory, бо той перестворює
+    файл з іншою capacity.
+    """
+    history = controller.TelemetryHistory
+    with open(path, "rb") as f:
+        magic, version, capacity, written = history.HEADER.unpack(f.read(history.HEADER.size))
+    if magic != history.MAGIC or version != history.VERSION:
+        sys.exit(f"{path}: не файл історії (magic {magic!r}, версія {version})")
+    count = min(written, capacity)
+    oldest = (written - count) % capacity
+    data = {}
+    offset = history.HEADER_SIZE
+    for name, code in history.COLUMNS:
+        dtype = np.dtype(code)
+        column = np.fromfile(path, dtype=dtype, count=capacity, offset=offset)
+        data[name] = np.roll(column, -oldest)[:count].astype(float)
+        offset += capacity * struct.calcsize(code)
+    return data
+
+
+def load_telemetry(path: str) -> Dict[str, "np.ndarray"]:
+    """Завантажує ряд за розширенням файлу; відкидає неповні записи та сортує за часом."""
+    if path.endswith(".parquet"):
+        data = load_parquet(path)
+    elif path.endswith(".csv"):
+        data = load_csv(path)
+    else:
+        data = load_history(path)
+    valid = ~(np.isnan(data["battery_soc_pct"]) | np.isnan(data["grid_power_w"]))
+    order = np.argsort(data["timestamp"][valid], kind="stable")
+    return {name: values[valid][order] for name, values in data.items()}
+
+
+# ============================================================
+# Векторизована симуляція
+# ============================================================
+
+
+def prepare_series(
+    data: Dict[str, "np.ndarray"], ev_power_w: float, max_gap_sec: float, import_window_sec: float
+) -> Dict:
+    """
+    Ряди для симуляції (векторно, без циклу по часу).
+
+    Енергія та імпорт рахуються через кумулятивні суми: інтервал роботи
+    зарядки [k1, k2) коштує дві різниці, тому цикл симуляції звертається
+    до них лише при перемиканнях.
+
+    Returns:
+        Словник t, soc, base_grid (мережа без записаної зарядки), кумулятивні
+        суми cum_time / cum_extra_import, межі вікна імпорту window_start /
+        window_size та recorded (показники запису або None)
+    """
+    t = data["timestamp"]
+    dt = np.minimum(np.diff(t, append=t[-1]), max_gap_sec)
+    # Вікно імпорту кроку k - записи з t > t[k] - import_window_sec; кожен
+    # запис важить час від попереднього (як dt у RollingWindow)
+    window_start = np.searchsorted(t, t - import_window_sec, side="right")
+    sample_dt = np.minimum(np.diff(t, prepend=t[0]), max_gap_sec)
+    charging = data["charger_state"] == controller.CHARGER_STATE_CHARGING
+    current = np.where(np.isnan(data["current_a"]), controller.CHARGING_CURRENT_A, data["current_a"])
+    recorded_ev_w = np.where(
+        charging, current * controller.CHARGER_VOLTAGE_V * controller.CHARGER_PHASES, 0.0
+    )
+    base_grid = data["grid_power_w"] - recorded_ev_w
+    base_import = np.maximum(base_grid, 0.0)
+    # Додатковий імпорт за крок, якби зарядка працювала (W*сек)
+    extra_import = (np.maximum(base_grid + ev_power_w, 0.0) - base_import) * dt
+    recorded = None
+    if charging.any():
+        recorded = {
+            "ev_kwh": float(recorded_ev_w @ dt) / 3.6e6,
+            "ev_import_kwh": float((np.maximum(data["grid_power_w"], 0.0) - base_import) @ dt) / 3.6e6,
+            "cycles": int(np.count_nonzero(charging[1:] & ~charging[:-1])),
+        }
+    return {
+        "t": t,
+        "soc": data["battery_soc_pct"],
+        "base_grid": base_grid,
+        "cum_time": np.concatenate(([0.0], np.cumsum(dt))),
+        "cum_extra_import": np.concatenate(([0.0], np.cumsum(extra_import))),
+        "window_start": window_start,
+        "window_size": int((np.arange(len(t)) - window_start).max()) + 1,
+        "sample_dt": sample_dt,
+        "ev_power_w": ev_power_w,
+        "recorded": recorded,
+    }
+
+
+def simulate(series: Dict, params: "np.ndarray") -> "np.ndarray":
+    """
+    Проганяє ряд для всіх комбінацій params одночасно.
+
+    Args:
+        series: Результат prepare_series()
+        params: Масив (N, len(PARAMETERS)) у порядку PARAMETERS
+
+    Returns:
+        Масив (N, len(RESULT_COLUMNS))
+    """
+    (
+        soc_on, soc_hyst, grid_on, grid_off_ratio, interval, ema_tau, min_on, min_off,
+        max_commands, import_max,
+    ) = params.T
+    soc_off = soc_on - soc_hyst
+    grid_off = grid_on * grid_off_ratio
+    n = len(params)
+    columns = np.arange(n)
+    t, soc, base_grid = series["t"], series["soc"], series["base_grid"]
+    cum_time, cum_extra_import = series["cum_time"], series["cum_extra_import"]
+    window_start, sample_dt = series["window_start"], series["sample_dt"]
+    ev_w = series["ev_power_w"]
+
+    on = np.zeros(n, dtype=bool)
+    since = np.full(n, -np.inf)  # Час входу в поточний стан
+    on_index = np.zeros(n, dtype=np.int64)  # Крок, з якого зарядка увімкнена
+    next_due = np.full(n, t[0])
+    on_sec = np.zeros(n)
+    ev_import = np.zeros(n)  # W*сек
+    cycles = np.zeros(n, dtype=np.int64)
+    smoothing = ema_tau > 0
+    any_smoothing = bool(smoothing.any())
+    tau = np.where(smoothing, ema_tau, 1.0)
+    ema = np.full(n, base_grid[0])
+
+    # Час імпорту вище grid_on у вікні: кільце внесків записів вікна
+    track_import = bool((import_max > 0).any())
+    window_size = series["window_size"]
+    above_ring = np.zeros((window_size, n)) if track_import else None
+    above_sec = np.zeros(n)
+    window_left = 0
+    always = np.ones(n, dtype=bool)
+
+    # Ліміт команд: кільце часів останніх max_commands команд кожної комбінації
+    limit = max_commands.astype(np.int64)
+    limited = limit > 0
+    command_times = np.full((max(1, int(limit.max())), n), -np.inf)
+    command_count = np.zeros(n, dtype=np.int64)
+
+    def close_intervals(mask: "np.ndarray", k: int):
+        """Зараховує інтервали роботи [on_index, k) комбінацій mask."""
+        start = on_index[mask]
+        on_sec[mask] += cum_time[k] - cum_time[start]
+        ev_import[mask] += cum_extra_import[k] - cum_extra_import[start]
+
+    previous = t[0]
+    for k in range(len(t)):
+        now = t[k]
+        if any_smoothing:
+            # EMA з нерівномірним кроком (як RollingWindow); без згладжування - миттєве значення
+            alpha = np.where(smoothing, -np.expm1(-(now - previous) / tau), 1.0)
+            ema += alpha * (base_grid[k] + on * ev_w - ema)
+            previous = now
+        if track_import:
+            while window_left < window_start[k]:
+                above_sec -= above_ring[window_left % window_size]
+                window_left += 1
+            contribution = np.where(base_grid[k] + on * ev_w > grid_on, sample_dt[k], 0.0)
+            above_ring[k % window_size] = contribution
+            above_sec += contribution
+            if k % window_size == window_size - 1:
+                # Раз на оберт перераховуємо суму, щоб не накопичувати похибку float
+                above_sec = above_ring[np.arange(window_left, k + 1) % window_size].sum(axis=0)
+
+        due = now >= next_due
+        if not due.any():
+            continue
+        grid = ema if any_smoothing else base_grid[k] + on * ev_w
+        import_w = np.where(grid > IMPORT_DIRECTION_W, grid, 0.0)
+        sustained = above_sec >= import_max if track_import else always
+        in_state = now - since
+        slot = np.where(limited, command_count % np.maximum(limit, 1), 0)
+        allowed = ~limited | (now - command_times[slot, columns] >= 3600)
+        turn_on = (
+            due & ~on & (soc[k] >= soc_on) & ((import_w < grid_on) | ~sustained)
+            & (in_state >= min_off) & allowed
+        )
+        turn_off = (
+            due & on & ((soc[k] < soc_off) | ((import_w > grid_off) & sustained))
+            & (in_state >= min_on) & allowed
+        )
+        if turn_off.any():
+            close_intervals(turn_off, k)
+        if turn_on.any():
+            on_index[turn_on] = k
+            cycles += turn_on
+        switched = turn_on | turn_off
+        on ^= switched
+        since[switched] = now
+        command_times[slot[switched], columns[switched]] = now
+        command_count += switched
+        # Фіксована сітка: пропущені тики об'єднуються в один
+        missed = np.floor((now - next_due[due]) / interval[due]) + 1
+        next_due[due] += missed * interval[due]
+
+    close_intervals(on, len(t))
+    ev_kwh = on_sec * ev_w / 3.6e6
+    ev_import_kwh = ev_import / 3.6e6
+    with np.errstate(invalid="ignore", divide="ignore"):
+        self_use = np.where(ev_kwh > 0, 100.0 * (1.0 - ev_import_kwh / ev_kwh), np.nan)
+    return np.column_stack((ev_kwh, ev_import_kwh, self_use, cycles))
+
+
+def run_sweep(series: Dict, params: "np.ndarray", workers: int) -> "np.ndarray":
+    """Ділить сітку на частини та рахує їх паралельно в процесах."""
+    workers = max(1, min(workers, len(params)))
+    if workers == 1:
+        return simulate(series, params)
+    chunks = np.array_split(params, workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(simulate, [series] * len(chunks), chunks)
+        return np.vstack(list(results))
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+
+def parse_values(text: str) -> List[float]:
+    """Список "85,90,95" або діапазон "start:stop:step" (stop не включно)."""
+    if ":" in text:
+        start, stop, step = (float(part) for part in text.split(":"))
+        return list(np.arange(start, stop, step))
+    return [float(part) for part in text.split(",") if part.strip()]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бектест політики керування зарядкою")
+    parser.add_argument("input", help="CSV, Parquet або файл історії (HISTORY_FILE)")
+    for name, help_text, default in PARAMETERS:
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=parse_values,
+            default=[default],
+            help=f"{help_text}; список через кому або start:stop:step (поточне: {default:g})",
+        )
+    parser.add_argument(
+        "--current", type=float, default=controller.CHARGING_CURRENT_A, help="Струм зарядки (A)"
+    )
+    parser.add_argument(
+        "--max-gap", type=float, default=900.0,
+        help="Проміжок без даних довший за N сек не рахується (сек)",
+    )
+    parser.add_argument(
+        "--import-window", type=float, default=controller.SAMPLE_WINDOW_SEC,
+        help="Вікно, в якому рахується тривалість імпорту (SAMPLE_WINDOW_SEC, сек)",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Кількість процесів")
+    parser.add_argument(
+        "--sort", choices=RESULT_COLUMNS, default="ev_kwh", help="Сортування результатів (спадання)"
+    )
+    parser.add_argument("--top", type=int, default=20, help="Скільки рядків показати")
+    parser.add_argument("--output", help="Записати всі результати в CSV")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    data = load_telemetry(args.input)
+    if len(data["timestamp"]) < 2:
+        sys.exit(f"{args.input}: недостатньо записів")
+    ev_power_w = args.current * controller.CHARGER_VOLTAGE_V * controller.CHARGER_PHASES
+    series = prepare_series(data, ev_power_w, args.max_gap, args.import_window)
+
+    grid = [getattr(args, name) for name, _, _ in PARAMETERS]
+    params = np.array(list(product(*grid)), dtype=float)
+    results = run_sweep(series, params, args.workers)
+
+    names = [name for name, _, _ in PARAMETERS]
+    span_days = (series["t"][-1] - series["t"][0]) / 86400
+    print("=" * 60)
+    print(
+        f"Записів: {len(series['t'])} за {span_days:.1f} доби, комбінацій: {len(params)}, "
+        f"EV {ev_power_w:.0f}W"
+    )
+    if series["recorded"] is not None:
+        recorded = series["recorded"]
+        print(
+            f"Запис: EV {recorded['ev_kwh']:.1f} kWh, імпорт через EV "
+            f"{recorded['ev_import_kwh']:.1f} kWh, циклів {recorded['cycles']}"
+        )
+    step = float(np.median(np.diff(series["t"])))
+    if min(args.interval) < step:
+        print(f"Увага: інтервал менший за крок даних ({step:.0f} сек) - рішення не частіше за крок")
+    print("=" * 60)
+
+    order = np.argsort(-np.nan_to_num(results[:, RESULT_COLUMNS.index(args.sort)], nan=-np.inf))
+    header = names + list(RESULT_COLUMNS)
+    print("  ".join(f"{name:>14}" for name in header))
+    for index in order[: args.top]:
+        row = [f"{value:>14g}" for value in params[index]]
+        row += [f"{value:>14.1f}" for value in results[index, :3]]
+        row.append(f"{int(results[index, 3]):>14d}")
+        print("  ".join(row))
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for index in order:
+                writer.writerow(list(params[index]) + list(results[index]))
+        print(f"Результати: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Наскрізний бенчмарк циклу керування на локальних симуляторах.
+
+Запускає SolarmanV5Simulator та TuyaSimulator (див. simulators.py), налаштовує
+main.py на них через ENV і проганяє async_control_loop() заданої кількості
+ітерацій. Стан інвертора перемикається між "надлишок" та "дефіцит", щоб цикл
+постійно вмикав і вимикав зарядку.
+
+Звіт:
+- тривалість ітерації (p50/p90/p99/max), її фаз та запізнення планових тиків
+- час від рішення до застосування команди на пристрої
+- кількість запитів до кожного пристрою на ітерацію
+
+Використання:
+    python benchmark.py --iterations 50 --latency 0.05 --jitter 0.02
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+from simulators import FaultProfile, SimulatorThread, SolarmanV5Simulator, TuyaSimulator
+
+LOGGER_SN = 1234567890
+DEVICE_ID = "bench0feyree0device0"
+LOCAL_KEY = "0123456789abcdef"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль методом найближчого рангу."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def describe(title: str, values: List[float], unit: str = "мс", scale: float = 1000.0) -> str:
+    """Форматує рядок звіту p50/p90/p99/max."""
+    if not values:
+        return f"{title}: немає даних"
+    scaled = [v * scale for v in values]
+    return (
+        f"{title} (n={len(scaled)}): "
+        f"p50 {percentile(scaled, 50):.1f}{unit}, "
+        f"p90 {percentile(scaled, 90):.1f}{unit}, "
+        f"p99 {percentile(scaled, 99):.1f}{unit}, "
+        f"max {max(scaled):.1f}{unit}"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк циклу керування на симуляторах")
+    parser.add_argument("--iterations", type=int, default=40, help="Кількість ітерацій циклу")
+    parser.add_argument("--interval", type=float, default=0.05, help="CHECK_INTERVAL_SEC")
+    parser.add_argument("--toggle-every", type=int, default=2, help="Змінювати стан інвертора кожні N ітерацій")
+    parser.add_argument("--latency", type=float, default=0.0, help="Затримка відповіді пристроїв (сек)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Випадкова додаткова затримка (сек)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Ймовірність втрати відповіді")
+    parser.add_argument("--tuya-version", default="3.3", choices=("3.3", "3.4"))
+    parser.add_argument("--sample-interval", type=float, default=0.0, help="SAMPLE_INTERVAL_SEC (0 = вимкнено)")
+    parser.add_argument("--no-listener", action="store_true", help="FEYREE_PUSH_LISTENER=false")
+    parser.add_argument("--verbose", action="store_true", help="Не приглушувати логи main.py")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    def faults() -> FaultProfile:
+        return FaultProfile(
+            latency_sec=args.latency, jitter_sec=args.jitter, drop_rate=args.error_rate
+        )
+
+    inverter_sim = SolarmanV5Simulator(logger_sn=LOGGER_SN, faults=faults())
+    charger_sim = TuyaSimulator(DEVICE_ID, LOCAL_KEY, float(args.tuya_version), faults=faults())
+    simulators = SimulatorThread(inverter_sim, charger_sim)
+    simulators.start()
+
+    # Конфігурація main.py зчитується з ENV під час імпорту
+    os.environ.update(
+        {
+            "LOGGER_IP": "127.0.0.1",
+            "LOGGER_PORT": str(inverter_sim.port),
+            "LOGGER_SN": str(LOGGER_SN),
+            "FEYREE_IP": "127.0.0.1",
+            "FEYREE_PORT": str(charger_sim.port),
+            "FEYREE_DEVICE_ID": DEVICE_ID,
+            "FEYREE_LOCAL_KEY": LOCAL_KEY,
+            "FEYREE_VERSION": args.tuya_version,
+            "CHECK_INTERVAL_SEC": str(args.interval),
+            "SAMPLE_INTERVAL_SEC": str(args.sample_interval),
+            "FEYREE_PUSH_LISTENER": "false" if args.no_listener else "true",
+            "MIN_ON_TIME_SEC": "0",
+            "MIN_OFF_TIME_SEC": "0",
+            "MAX_COMMANDS_PER_HOUR": "0",
+            "GRID_IMPORT_MAX_SEC": "0",
+            "RETRY_DELAY_SEC": "0.05",
+            "CONNECTION_TIMEOUT_SEC": "2",
+        }
+    )
+    import main as controller
+
+    if not args.verbose:
+        logging.getLogger(controller.__name__).setLevel(logging.WARNING)
+
+    surplus = {"battery_soc_pct": 95, "grid_power_w": -1500, "pv_power_w": 5000}
+    deficit = {"battery_soc_pct": 40, "grid_power_w": 2500, "pv_power_w": 0}
+    results: List[Dict] = []
+    counters = {"inverter": 0, "charger": 0}
+    round_trips: Dict[str, List[int]] = {"inverter": [], "charger": []}
+
+    def on_iteration(info: Dict) -> None:
+        inverter_total = inverter_sim.stats.requests
+        charger_total = charger_sim.stats.requests
+        round_trips["inverter"].append(inverter_total - counters["inverter"])
+        round_trips["charger"].append(charger_total - counters["charger"])
+        counters["inverter"], counters["charger"] = inverter_total, charger_total
+        results.append(info)
+        if info["iteration"] % args.toggle_every == 0:
+            phase = (info["iteration"] // args.toggle_every) % 2
+            simulators.call(inverter_sim.set_state, **(deficit if phase else surplus))
+
+    simulators.call(inverter_sim.set_state, **surplus)
+    started = time.monotonic()
+    try:
+        asyncio.run(
+            controller.async_control_loop(max_iterations=args.iterations, on_iteration=on_iteration)
+        )
+    finally:
+        elapsed = time.monotonic() - started
+        simulators.stop()
+
+    # Перші ітерації включають підключення; вони теж входять у статистику
+    durations = [info["duration_sec"] for info in results]
+    actuations = list(charger_sim.actuations)
+    to_actuation: List[float] = []
+    decisions = [info["decided_at"] for info in results if info["decided_at"] is not None]
+    for info in results:
+        if info["command"] is None or info["decided_at"] is None:
+            continue
+        # Застосування зараховується лише до наступного рішення (втрачені команди пропускаються)
+        window_end = next((t for t in decisions if t > info["decided_at"]), float("inf"))
+        applied = next(
+            (t for t, _ in actuations if info["decided_at"] <= t < window_end), None
+        )
+        if applied is not None:
+            to_actuation.append(applied - info["decided_at"])
+
+    commands = sum(1 for info in results if info["command"] is not None)
+    confirmed = sum(1 for info in results if info["command_ok"])
+
+    print("=" * 60)
+    print(
+        f"Ітерацій: {len(results)} за {elapsed:.2f} сек "
+        f"(Tuya {args.tuya_version}, затримка {args.latency * 1000:.0f}±{args.jitter * 1000:.0f} мс, "
+        f"втрати {args.error_rate:.0%})"
+    )
+    print(describe("Тривалість ітерації", durations))
+    lateness = [info["lateness_sec"] for info in results if info["lateness_sec"] is not None]
+    print(describe("Запізнення планового тику", lateness))
+    for phase in ("sample", "decide", "actuate"):
+        print(describe(f"Фаза {phase}", [info["phases"][phase] for info in results if phase in info["phases"]]))
+    print(describe("Рішення -> застосування на пристрої", to_actuation))
+    print(f"Команд: {commands}, підтверджено: {confirmed}, застосовано пристроєм: {len(actuations)}")
+    for name in ("inverter", "charger"):
+        trips = round_trips[name]
+        print(
+            f"Запитів до {name} на ітерацію: середнє {statistics.fmean(trips):.2f}, "
+            f"max {max(trips)}"
+        )
+    print(f"Помилки симуляторів: інвертор {inverter_sim.stats.faults}, зарядка {charger_sim.stats.faults}")
+    print("=" * 60)
+    sys.exit(0 if results else 1)
+
+
+if __name__ == "__main__":
+    main()
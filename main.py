@@ -9,28 +9,114 @@
 - Вимикання зарядки: в усіх інших випадках
 """
 
+import asyncio
+import atexit
+import bisect
+import functools
+import inspect
+import itertools
+import json
 import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
+import random
+import select
+import signal
+import sqlite3
+import statistics
+import struct
 import sys
+import threading
 import time
-from typing import Dict, Optional
+import urllib.parse
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Dict, Optional
 
 import tinytuya
-from dotenv import load_dotenv
-from pysolarmanv5 import PySolarmanV5, V5FrameError, NoSocketAvailableError
+from dotenv import dotenv_values, load_dotenv
+from pysolarmanv5 import (
+    PySolarmanV5,
+    PySolarmanV5Async,
+    V5FrameError,
+    NoSocketAvailableError,
+)
+from umodbus.exceptions import ModbusError  # залежність pysolarmanv5
 
 # Завантаження конфігурації з .env файлу
 load_dotenv()
 
+
+def _env_bool(name: str, default: str) -> bool:
+    """Зчитує булеве значення з ENV ("1", "true", "yes", "on" = True)."""
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
 # ============================================================
 # Налаштування логування
 # ============================================================
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
-)
+# Формат: "text" - рядки для людини, "json" - JSON-записи лише при змінах стану
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+# Режим json: запис ітерації без змін не рідше ніж раз на N секунд
+LOG_HEARTBEAT_SEC = float(os.getenv("LOG_HEARTBEAT_SEC", "300"))
+
+
+class JsonFormatter(logging.Formatter):
+    """Запис логу як один рядок JSON (додаткові поля - extra={"fields": {...}})."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, що не форматує запис у потоці виклику (це робить QueueListener)."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(log_format: str = LOG_FORMAT) -> logging.handlers.QueueListener:
+    """
+    Налаштовує логування через чергу.
+
+    Форматування та запис у stdout виконує окремий потік, тому повільний
+    приймач логів (Docker json-file) не блокує цикл керування. Черга
+    дописується при завершенні процесу (atexit).
+    """
+    stream = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    logging.basicConfig(level=logging.INFO, handlers=[_DeferredQueueHandler(log_queue)])
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+LOG_LISTENER = setup_logging()
 logger = logging.getLogger(__name__)
+# Структуровані записи ітерацій (LOG_FORMAT=json); у режимі json детальні
+# рядки INFO не пишуться, лишаються попередження та помилки
+events = logging.getLogger(f"{__name__}.events")
+if LOG_FORMAT == "json":
+    logger.setLevel(logging.WARNING)
+    events.setLevel(logging.INFO)
 
 
 # ============================================================
@@ -48,6 +134,7 @@ FEYREE_IP = os.getenv("FEYREE_IP", "")
 FEYREE_DEVICE_ID = os.getenv("FEYREE_DEVICE_ID", "")
 FEYREE_LOCAL_KEY = os.getenv("FEYREE_LOCAL_KEY", "")
 FEYREE_VERSION = os.getenv("FEYREE_VERSION", "3.3")
+FEYREE_PORT = int(os.getenv("FEYREE_PORT", "6668"))
 
 # Feyree DPS коди (Data Point System)
 FEYREE_SWITCH_DPS = int(os.getenv("FEYREE_SWITCH_DPS", "18"))  # DPS для ВВІМК/ВИМК
@@ -55,6 +142,8 @@ FEYREE_MODE_DPS = int(os.getenv("FEYREE_MODE_DPS", "14"))  # DPS для режи
 FEYREE_CHARGE_NOW_MODE = os.getenv(
     "FEYREE_CHARGE_NOW_MODE", "charge_now"
 )  # Режим "заряджати зараз"
+# DPS для встановлення струму зарядки (0 = не надсилати струм, напр. 115 = max_current)
+FEYREE_CURRENT_DPS = int(os.getenv("FEYREE_CURRENT_DPS", "0"))
 # DPS 123 - це ключова команда для старту зарядки (True = start, False = stop)
 # DPS 101 - статус зарядки ("finish", "charing" [з опечаткою від Tuya])
 # DPS 124 - статус режиму ("CloseCharging", тощо)
@@ -62,567 +151,6938 @@ FEYREE_CHARGE_NOW_MODE = os.getenv(
 # Логіка керування
 SOC_THRESHOLD = float(os.getenv("SOC_THRESHOLD", "90"))
 GRID_IMPORT_THRESHOLD = float(os.getenv("GRID_IMPORT_THRESHOLD", "250"))
-CHECK_INTERVAL_SEC = int(os.getenv("CHECK_INTERVAL_SEC", "120"))
+CHECK_INTERVAL_SEC = float(os.getenv("CHECK_INTERVAL_SEC", "120"))
 CHARGING_CURRENT_A = int(os.getenv("CHARGING_CURRENT_A", "16"))
 
-# Налаштування повторів та timeout
-MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "5"))
-RETRY_DELAY_SEC = float(os.getenv("RETRY_DELAY_SEC", "1.0"))
-CONNECTION_TIMEOUT_SEC = int(os.getenv("CONNECTION_TIMEOUT_SEC", "15"))
-
-
-# ============================================================
-# Клас для роботи з Deye інвертором
-# ============================================================
+# Режим керування: "threshold" (ВВІМК/ВИМК на CHARGING_CURRENT_A)
+# або "surplus" (струм підлаштовується під надлишок PV)
+CONTROL_MODE = os.getenv("CONTROL_MODE", "threshold").strip().lower()
+MIN_CHARGING_CURRENT_A = int(os.getenv("MIN_CHARGING_CURRENT_A", "6"))
+CHARGER_PHASES = int(os.getenv("CHARGER_PHASES", "1"))
+CHARGER_VOLTAGE_V = float(os.getenv("CHARGER_VOLTAGE_V", "230"))
+# Параметри регулятора струму в режимі "surplus"
+SURPLUS_INTERVAL_SEC = float(os.getenv("SURPLUS_INTERVAL_SEC", "5"))
+SURPLUS_TARGET_GRID_W = float(os.getenv("SURPLUS_TARGET_GRID_W", "-100"))
+SURPLUS_DEADBAND_W = float(os.getenv("SURPLUS_DEADBAND_W", "150"))
+SURPLUS_MAX_STEP_A = int(os.getenv("SURPLUS_MAX_STEP_A", "2"))
+SURPLUS_MIN_CHANGE_INTERVAL_SEC = float(
+    os.getenv("SURPLUS_MIN_CHANGE_INTERVAL_SEC", "15")
+)
+# Режим "plan": таблиця дозволеного струму з прогнозу PV та навантаження
+# (CSV: timestamp, pv_w, необов'язково load_w)
+FORECAST_FILE = os.getenv("FORECAST_FILE", "")
+# Корисна ємність батареї (kWh) та SOC, нижче якого план не розряджає її зарядкою (%)
+BATTERY_CAPACITY_KWH = float(os.getenv("BATTERY_CAPACITY_KWH", "10"))
+PLAN_MIN_SOC = float(os.getenv("PLAN_MIN_SOC", "30"))
+# Крок (60-300 секунд) та горизонт плану (секунди)
+PLAN_STEP_SEC = float(os.getenv("PLAN_STEP_SEC", "300"))
+PLAN_HORIZON_SEC = float(os.getenv("PLAN_HORIZON_SEC", "86400"))
+# Навантаження, якщо в прогнозі немає колонки load_w (W)
+PLAN_DEFAULT_LOAD_W = float(os.getenv("PLAN_DEFAULT_LOAD_W", "500"))
+# Перерахунок плану: відхилення фактичного SOC від планового (%) або
+# нового прогнозу від попереднього (W)
+PLAN_SOC_TOLERANCE_PCT = float(os.getenv("PLAN_SOC_TOLERANCE_PCT", "5"))
+PLAN_FORECAST_TOLERANCE_W = float(os.getenv("PLAN_FORECAST_TOLERANCE_W", "300"))
+# Каталог для таблиць плану plan-<об'єкт>.json (порожньо = не записувати)
+PLAN_DIR = os.getenv("PLAN_DIR", "")
 
+# Гістерезис: окремі пороги увімкнення та вимкнення
+SOC_OFF_THRESHOLD = float(os.getenv("SOC_OFF_THRESHOLD", str(SOC_THRESHOLD - 5)))
+GRID_IMPORT_OFF_THRESHOLD = float(
+    os.getenv("GRID_IMPORT_OFF_THRESHOLD", str(GRID_IMPORT_THRESHOLD * 2))
+)
+# Мінімальний час у стані ВВІМК/ВИМК перед наступним перемиканням (секунди)
+MIN_ON_TIME_SEC = float(os.getenv("MIN_ON_TIME_SEC", "300"))
+MIN_OFF_TIME_SEC = float(os.getenv("MIN_OFF_TIME_SEC", "300"))
+# Максимальна кількість команд перемикання на годину (0 = без обмеження)
+MAX_COMMANDS_PER_HOUR = int(os.getenv("MAX_COMMANDS_PER_HOUR", "6"))
 
-class DeyeInverter:
-    """Клас для читання даних з Deye інвертора через Modbus."""
+# Високочастотне опитування інвертора (0 = вимкнено, одне читання на перевірку)
+SAMPLE_INTERVAL_SEC = float(os.getenv("SAMPLE_INTERVAL_SEC", "0"))
+# Довжина ковзного вікна статистики (секунди)
+SAMPLE_WINDOW_SEC = float(os.getenv("SAMPLE_WINDOW_SEC", "120"))
+# Стала часу експоненційного згладжування потужності мережі (секунди)
+GRID_EMA_TAU_SEC = float(os.getenv("GRID_EMA_TAU_SEC", "30"))
+# Скільки секунд у вікні імпорт може перевищувати поріг без вимкнення зарядки
+GRID_IMPORT_MAX_SEC = float(os.getenv("GRID_IMPORT_MAX_SEC", "60"))
 
-    def __init__(self):
-        """Ініціалізація клієнта Deye інвертора."""
-        self.client = None
-        self._connect()
-        logger.info(
-            f"Deye інвертор: підключення до {LOGGER_IP}:{LOGGER_PORT} (SN: {LOGGER_SN})"
-        )
+# Карта регістрів Deye (JSON файл; порожньо = вбудована карта SUN-10K)
+REGISTER_MAP_FILE = os.getenv("REGISTER_MAP_FILE", "")
+# Поля для читання (через кому; порожньо = всі поля карти)
+INVERTER_FIELDS = [
+    name.strip() for name in os.getenv("INVERTER_FIELDS", "").split(",") if name.strip()
+]
+# Максимальна кількість регістрів в одному запиті read_holding_registers
+MAX_REGISTERS_PER_READ = int(os.getenv("MAX_REGISTERS_PER_READ", "100"))
+# Максимальний проміжок між полями, який вигідніше дочитати, ніж робити новий запит
+REGISTER_MAX_GAP = int(os.getenv("REGISTER_MAX_GAP", "16"))
 
-    def _connect(self):
-        """Створює нове з'єднання з інвертором."""
-        self.client = PySolarmanV5(
-            address=LOGGER_IP,
-            serial=LOGGER_SN,
-            port=LOGGER_PORT,
-            mb_slave_id=MB_SLAVE_ID,
-            socket_timeout=CONNECTION_TIMEOUT_SEC,
-            verbose=False,
-        )
+# Історія телеметрії (файл у змонтованому томі; порожньо = лише в пам'яті)
+HISTORY_FILE = os.getenv("HISTORY_FILE", "")
+# Кількість записів у кільцевому буфері (один запис на ітерацію циклу)
+HISTORY_CAPACITY = int(os.getenv("HISTORY_CAPACITY", "100000"))
+# Журнал сесій зарядки (SQLite у змонтованому томі; порожньо = вимкнено)
+SESSION_DB_FILE = os.getenv("SESSION_DB_FILE", "")
+# Період пакетного запису журналу сесій (секунди)
+SESSION_DB_FLUSH_SEC = float(os.getenv("SESSION_DB_FLUSH_SEC", "5"))
 
-    def reconnect(self):
-        """Перепідключається до інвертора."""
-        logger.warning("Спроба перепідключення до Deye інвертора...")
-        try:
-            if self.client:
-                self.disconnect()
-        except Exception:
-            pass  # Ігноруємо помилки при закритті
-        self._connect()
-        logger.info("Перепідключення успішне")
+# Налаштування повторів та timeout
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "5"))
+RETRY_DELAY_SEC = float(os.getenv("RETRY_DELAY_SEC", "1.0"))
+CONNECTION_TIMEOUT_SEC = int(os.getenv("CONNECTION_TIMEOUT_SEC", "15"))
+# Загальний бюджет часу на одне читання регістрів разом з повторами (секунди)
+READ_BUDGET_SEC = float(os.getenv("READ_BUDGET_SEC", "20"))
+# Максимальна затримка між повторами (експоненційна від RETRY_DELAY_SEC, з jitter)
+RETRY_MAX_DELAY_SEC = float(os.getenv("RETRY_MAX_DELAY_SEC", "8"))
+# Circuit breaker: невдалих читань поспіль до розмикання (0 = вимкнено)
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+# Пауза до пробного читання після розмикання (секунди)
+BREAKER_RESET_SEC = float(os.getenv("BREAKER_RESET_SEC", "60"))
+# Максимальний вік останніх даних інвертора, що використовуються при його недоступності
+STALE_READING_MAX_SEC = float(os.getenv("STALE_READING_MAX_SEC", "300"))
+# Вимикати зарядку, коли даних інвертора немає довше STALE_READING_MAX_SEC
+STALE_SAFE_OFF = _env_bool("STALE_SAFE_OFF", "true")
+# Максимальний час очікування підтвердження команди від зарядки
+COMMAND_ACK_TIMEOUT_SEC = float(os.getenv("COMMAND_ACK_TIMEOUT_SEC", "5"))
 
-    def read_registers(self, start: int, quantity: int) -> list[int]:
-        """
-        Зчитує діапазон Modbus-регістрів з повторними спробами.
+# Дедлайни фаз ітерації (секунди): опитування пристроїв, рішення, виконання команд.
+# Перевищення рахується в метриках і логується
+DEADLINE_SAMPLE_SEC = float(os.getenv("DEADLINE_SAMPLE_SEC", str(READ_BUDGET_SEC)))
+DEADLINE_DECIDE_SEC = float(os.getenv("DEADLINE_DECIDE_SEC", "0.5"))
+DEADLINE_ACTUATE_SEC = float(
+    os.getenv("DEADLINE_ACTUATE_SEC", str(2 * COMMAND_ACK_TIMEOUT_SEC))
+)
+# Файл живості для Docker HEALTHCHECK (порожньо = вимкнено). Після кожної
+# ітерації в нього записується час (Unix), до якого очікується наступна
+LIVENESS_FILE = os.getenv("LIVENESS_FILE", "")
+# Знімок стану для теплого старту (порожньо = вимкнено): автомати рішень,
+# останні дані інвертора та стан зарядок зберігаються періодично та при зупинці
+STATE_SNAPSHOT_FILE = os.getenv("STATE_SNAPSHOT_FILE", "")
+# Період збереження знімка (секунди)
+STATE_SNAPSHOT_SEC = float(os.getenv("STATE_SNAPSHOT_SEC", "60"))
+# Максимальний вік знімка, з яким цикл стартує без очікування перевірки пристроїв
+WARM_START_MAX_AGE_SEC = float(os.getenv("WARM_START_MAX_AGE_SEC", "900"))
 
-        Args:
-            start: Початкова адреса регістру
-            quantity: Кількість регістрів для читання
+# Перезавантаження налаштувань без перезапуску (SIGHUP або зміна файлу):
+# файл у форматі .env, значення якого перекривають ENV (порожньо = лише SIGHUP)
+CONFIG_RELOAD_FILE = os.getenv("CONFIG_RELOAD_FILE", "")
+# Період перевірки змін CONFIG_RELOAD_FILE та SITES_FILE (секунди, 0 = лише SIGHUP)
+CONFIG_WATCH_SEC = float(os.getenv("CONFIG_WATCH_SEC", "5"))
 
-        Returns:
-            Список значень регістрів
+# Фоновий слухач push-повідомлень Feyree (замість status() кожної ітерації)
+FEYREE_PUSH_LISTENER = _env_bool("FEYREE_PUSH_LISTENER", "true")
+# Інтервал heartbeat для утримання з'єднання (секунди, 0 = вимкнено)
+FEYREE_HEARTBEAT_SEC = float(os.getenv("FEYREE_HEARTBEAT_SEC", "10"))
+# Пошук зарядки за UDP broadcast (порти 6666/6667) при зміні її IP адреси
+FEYREE_DISCOVERY = _env_bool("FEYREE_DISCOVERY", "true")
+# Файл з останніми знайденими адресами зарядок (порожньо = без кешу)
+FEYREE_ADDRESS_CACHE_FILE = os.getenv("FEYREE_ADDRESS_CACHE_FILE", "")
 
-        Raises:
-            V5FrameError: Якщо всі спроби не вдалися
-        """
-        last_exc = None
+# HTTP endpoint /metrics у форматі Prometheus (0 = вимкнено)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
 
-        for attempt in range(MAX_ATTEMPTS):
-            try:
-                values = self.client.read_holding_registers(
-                    register_addr=start, quantity=quantity
-                )
-                if len(values) != quantity:
-                    raise V5FrameError(
-                        f"Неочікувана довжина відповіді для регістрів {start}-{start+quantity-1}: "
-                        f"{len(values)} != {quantity}"
-                    )
-                return values
-            except NoSocketAvailableError as exc:
-                # З'єднання закрите - намагаємося перепідключитись
-                last_exc = exc
-                if attempt < MAX_ATTEMPTS - 1:
-                    logger.warning(
-                        f"З'єднання закрите. Спроба {attempt + 1}/{MAX_ATTEMPTS} перепідключення..."
-                    )
-                    try:
-                        self.reconnect()
-                        time.sleep(RETRY_DELAY_SEC)
-                    except Exception as reconnect_exc:
-                        logger.error(f"Помилка перепідключення: {reconnect_exc}")
-                        time.sleep(RETRY_DELAY_SEC)
-            except V5FrameError as exc:
-                last_exc = exc
-                if attempt < MAX_ATTEMPTS - 1:
-                    logger.warning(
-                        f"Спроба {attempt + 1}/{MAX_ATTEMPTS} не вдалася: {exc}"
-                    )
-                    time.sleep(RETRY_DELAY_SEC)
+# HTTP API стану /state у форматі JSON (0 = вимкнено)
+STATE_API_PORT = int(os.getenv("STATE_API_PORT", "0"))
+STATE_API_HOST = os.getenv("STATE_API_HOST", "0.0.0.0")
+# Максимальний час long-poll запиту ?wait=N (секунди)
+STATE_API_MAX_WAIT_SEC = float(os.getenv("STATE_API_MAX_WAIT_SEC", "60"))
 
-        # Якщо всі спроби не вдалися
-        logger.error(f"Не вдалося зчитати регістри після {MAX_ATTEMPTS} спроб")
-        if last_exc:
-            raise last_exc
-        raise V5FrameError("Не вдалося зчитати регістри")
+# Кілька об'єктів: JSON файл з інверторами, зарядками та їх зв'язками
+# (порожньо = один об'єкт з параметрів ENV)
+SITES_FILE = os.getenv("SITES_FILE", "")
+# Кількість потоків для викликів tinytuya (спільна для всіх зарядок)
+TUYA_POOL_SIZE = int(os.getenv("TUYA_POOL_SIZE", "4"))
 
-    @staticmethod
-    def as_signed16(value: int) -> int:
-        """Перетворює 16-бітне беззнакове значення у signed (для потужностей)."""
-        return value - 0x10000 if value >= 0x8000 else value
+# Проксі logger: інші клієнти (Home Assistant, моніторинг) працюють через
+# єдине з'єднання цього сервісу (порти: 0 = вимкнено)
+PROXY_HOST = os.getenv("PROXY_HOST", "0.0.0.0")
+PROXY_V5_PORT = int(os.getenv("PROXY_V5_PORT", "0"))
+PROXY_MODBUS_PORT = int(os.getenv("PROXY_MODBUS_PORT", "0"))
+# Скільки секунд прочитані регістри віддаються клієнтам проксі з кешу
+PROXY_CACHE_TTL_SEC = float(os.getenv("PROXY_CACHE_TTL_SEC", "5"))
 
-    def get_battery_and_grid_state(self) -> Dict[str, float | str]:
-        """
-        Зчитує необхідні дані про батарею та мережу.
+# Профілювання циклу: каталог файлів flamegraph (порожньо = вимкнено),
+# вмикається SIGUSR1, POST /profile/start на порту метрик або з запуском
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+PROFILE_ON_START = _env_bool("PROFILE_ON_START", "false")
+# POST /profile/start і /profile/stop без автентифікації: лише явним прапорцем
+PROFILE_HTTP_CONTROL = _env_bool("PROFILE_HTTP_CONTROL", "false")
+# Період вибірки стеків (секунди)
+PROFILE_INTERVAL_SEC = float(os.getenv("PROFILE_INTERVAL_SEC", "0.02"))
+# Період ротації файлів (секунди) та кількість збережених вікон
+PROFILE_ROTATE_SEC = float(os.getenv("PROFILE_ROTATE_SEC", "300"))
+PROFILE_KEEP_FILES = int(os.getenv("PROFILE_KEEP_FILES", "48"))
 
-        Returns:
-            Словник з ключами:
-            - battery_soc_pct: Рівень заряду батареї (%)
-            - grid_power_w: Потужність з/в мережі (W, позитивне = імпорт)
-            - grid_direction: Напрямок потоку ("import", "export", "idle")
-        """
-        # Читаємо регістри 169-190 (169=grid power, 184=SOC)
-        # Регістр 169: активна потужність мережі (W, signed)
-        # Регістр 184: рівень заряду батареї (%)
-        regs = self.read_registers(start=169, quantity=22)  # 169 to 190
 
-        # Регістр 169: потужність мережі
-        grid_power_w = float(self.as_signed16(regs[0]))
+# ============================================================
+# Метрики Prometheus
+# ============================================================
 
-        # Регістр 184: SOC батареї (офсет 15 від початку 169)
-        battery_soc_pct = float(regs[15])
+# Межі бакетів гістограм тривалості (секунди)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
-        # Визначення напрямку потоку енергії мережі
-        if grid_power_w > 10:
-            grid_direction = "import"  # імпорт з мережі
-        elif grid_power_w < -10:
-            grid_direction = "export"  # експорт в мережу
-        else:
-            grid_direction = "idle"  # баланс
 
-        return {
-            "battery_soc_pct": battery_soc_pct,
-            "grid_power_w": grid_power_w,
-            "grid_direction": grid_direction,
-        }
+def _format_labels(labels: Dict[str, str]) -> str:
+    """Формує рядок міток Prometheus ({a="1",b="2"}) один раз при реєстрації."""
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in sorted(labels.items()):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
 
-    def disconnect(self):
-        """Закриває з'єднання з інвертором."""
-        if hasattr(self.client, "disconnect"):
-            self.client.disconnect()
 
+class Counter:
+    """Лічильник, що лише зростає. Значення зберігається в array('d') на місці."""
 
-# ============================================================
-# Клас для керування зарядкою Feyree EV
-# ============================================================
+    kind = "counter"
+    __slots__ = ("name", "help", "labels", "_value")
 
+    def __init__(self, name: str, help: str, labels: str = ""):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._value = array("d", [0.0])
 
-class FeyreeCharger:
-    """Клас для керування зарядкою Feyree EV через Tuya протокол."""
+    def inc(self, amount: float = 1.0) -> None:
+        self._value[0] += amount
 
-    def __init__(self):
-        """
-        Ініціалізація зарядки Feyree.
+    @property
+    def value(self) -> float:
+        return self._value[0]
 
-        Raises:
-            ValueError: Якщо не вказані DEVICE_ID або LOCAL_KEY
-        """
-        if not FEYREE_DEVICE_ID or FEYREE_DEVICE_ID == "your_device_id_here":
-            raise ValueError(
-                "FEYREE_DEVICE_ID не налаштовано! "
-                "Встановіть Device ID в .env файлі. "
-                "Використайте 'python -m tinytuya wizard' для отримання ключів."
-            )
+    def render(self) -> list[str]:
+        return [f"{self.name}{self.labels} {self._value[0]!r}"]
 
-        if not FEYREE_LOCAL_KEY or FEYREE_LOCAL_KEY == "your_local_key_here":
-            raise ValueError(
-                "FEYREE_LOCAL_KEY не налаштовано! "
-                "Встановіть Local Key в .env файлі. "
-                "Використайте 'python -m tinytuya wizard' для отримання ключів."
-            )
 
-        # Ініціалізація Tuya пристрою
-        self.device = tinytuya.OutletDevice(
-            dev_id=FEYREE_DEVICE_ID,
-            address=FEYREE_IP,
-            local_key=FEYREE_LOCAL_KEY,
-            version=FEYREE_VERSION,
-        )
-        self.device.set_socketTimeout(CONNECTION_TIMEOUT_SEC)
+class Gauge(Counter):
+    """Значення, що може зростати та зменшуватись."""
 
-        self.current_state = None  # Кешуємо стан для уникнення зайвих перемикань
+    kind = "gauge"
+    __slots__ = ()
 
-        logger.info(
-            f"Feyree зарядка: підключення до {FEYREE_IP} (ID: {FEYREE_DEVICE_ID})"
-        )
+    def set(self, value: float) -> None:
+        self._value[0] = value
 
-    def get_status(self) -> Optional[Dict]:
-        """
-        Отримує поточний стан зарядки.
 
-        Returns:
-            Словник зі станом пристрою або None у випадку помилки
-        """
-        try:
-            status = self.device.status()
-            return status
-        except Exception as e:
-            logger.error(f"Помилка отримання статусу Feyree: {e}")
-            return None
+class Histogram:
+    """
+    Гістограма з фіксованими бакетами.
 
-    def turn_on(self, current_a: int = CHARGING_CURRENT_A) -> bool:
-        """
-        Увімкнює зарядку з заданим струмом.
+    Лічильники бакетів та сума - попередньо виділені масиви array, тому
+    observe() лише інкрементує елемент (бінарний пошук бакета, без
+    створення нових об'єктів-контейнерів).
+    """
 
-        Args:
-            current_a: Сила струму зарядки (Ампери)
+    kind = "histogram"
+    __slots__ = ("name", "help", "labels", "bounds", "_counts", "_sum")
 
-        Returns:
-            True якщо команда виконана успішно, False інакше
-        """
-        try:
-            logger.info(f"Спроба увімкнути зарядку Feyree на {current_a}A")
+    def __init__(
+        self, name: str, help: str, labels: str = "", buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = tuple(sorted(buckets))
+        # Останній елемент - бакет +Inf
+        self._counts = array("Q", bytes(8 * (len(self.bounds) + 1)))
+        self._sum = array("d", [0.0])
 
-            # Увімкнення перемикача
-            switch_result = self.device.set_value(FEYREE_SWITCH_DPS, True)
-            if not switch_result:
-                logger.warning(
-                    f"Не вдалося увімкнути перемикач (DPS {FEYREE_SWITCH_DPS})"
-                )
-                return False
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self.bounds, value)] += 1
+        self._sum[0] += value
 
-            time.sleep(0.5)
+    def observe_since(self, started: float) -> None:
+        """Записує час від started (time.perf_counter()) до зараз."""
+        self.observe(time.perf_counter() - started)
 
-            # Встановлення режиму charge_now (DPS 14 - це Enum: "charge_now", "charge_pct", etc.)
-            self.device.set_value(FEYREE_MODE_DPS, FEYREE_CHARGE_NOW_MODE)  # type: ignore[arg-type]
-            time.sleep(0.5)
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
 
-            # Активація зарядки (DPS 123 = True - ключова команда для старту)
-            self.device.set_value(123, True)
-            time.sleep(0.5)
+    def render(self) -> list[str]:
+        inner = self.labels[1:-1] + "," if self.labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self._counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{inner}le="{bound}"}} {cumulative}')
+        cumulative += self._counts[-1]
+        lines.append(f'{self.name}_bucket{{{inner}le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum{self.labels} {self._sum[0]!r}")
+        lines.append(f"{self.name}_count{self.labels} {cumulative}")
+        return lines
 
-            # DPS 10 (додатковий параметр)
-            self.device.set_value(10, 1)
 
-            logger.info(f"Зарядка Feyree УВІМКНЕНА ({current_a}A)")
-            self.current_state = True
-            return True
+class MetricsRegistry:
+    """
+    Реєстр метрик та рендер у текстовий формат Prometheus.
 
-        except Exception as e:
-            logger.error(f"Помилка увімкнення зарядки Feyree: {e}")
-            return False
+    Метрики з мітками реєструються заздалегідь (по одному об'єкту на набір
+    міток), тому на гарячому шляху немає пошуку чи створення серій.
+    """
 
-    def turn_off(self) -> bool:
-        """
-        Вимикає зарядку.
+    def __init__(self):
+        # назва -> (тип, опис, серії)
+        self._families: Dict[str, tuple] = {}
 
-        Returns:
-            True якщо команда виконана успішно, False інакше
-        """
-        try:
-            logger.info("Спроба вимкнути зарядку Feyree")
+    def _register(self, metric):
+        family = self._families.setdefault(metric.name, (metric.kind, metric.help, []))
+        if family[0] != metric.kind:
+            raise ValueError(f"Метрика {metric.name} вже зареєстрована як {family[0]}")
+        family[2].append(metric)
+        return metric
 
-            # Зупинка зарядки (DPS 123 = False - ключова команда для зупинки)
-            self.device.set_value(123, False)
-            time.sleep(0.5)
+    def counter(self, name: str, help: str, **labels: str) -> Counter:
+        return self._register(Counter(name, help, _format_labels(labels)))
 
-            # Вимкнення головного перемикача (DPS 18 = switch)
-            result = self.device.set_value(FEYREE_SWITCH_DPS, False)
+    def gauge(self, name: str, help: str, **labels: str) -> Gauge:
+        return self._register(Gauge(name, help, _format_labels(labels)))
 
-            if result:
-                logger.info("Зарядка Feyree ВИМКНЕНА")
-                self.current_state = False
-                return True
-            else:
-                logger.warning(f"Не вдалося вимкнути зарядку (DPS {FEYREE_SWITCH_DPS})")
-                return False
+    def histogram(
+        self, name: str, help: str, buckets=LATENCY_BUCKETS, **labels: str
+    ) -> Histogram:
+        return self._register(Histogram(name, help, _format_labels(labels), buckets))
 
-        except Exception as e:
-            logger.error(f"Помилка вимкнення зарядки Feyree: {e}")
-            return False
+    def render(self) -> str:
+        """Текстовий формат Prometheus (version 0.0.4)."""
+        lines = []
+        for name, (kind, help, series) in self._families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in series:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
 
-    def display_device_status(self, status: Optional[Dict], prefix: str = ""):
-        """
-        Відображає детальну інформацію про стан пристрою.
 
-        Args:
-            status: Словник зі станом пристрою
-            prefix: Префікс для логування (напр. "ДО" або "ПІСЛЯ")
-        """
-        if not status or "dps" not in status:
-            logger.warning(f"{prefix} Статус недоступний")
-            return
+def timed(histogram: Histogram, failures: Optional[Counter] = None):
+    """
+    Декоратор: записує тривалість виклику в histogram.
 
-        dps = status.get("dps", {})
+    Якщо задано failures, лічильник збільшується при винятку або
+    результаті False/None. Працює для звичайних функцій та корутин.
+    """
 
-        logger.info(f"{prefix} Стан пристрою Feyree:")
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
 
-        # Основні DPS коди
-        switch_state = dps.get(str(FEYREE_SWITCH_DPS), None)
-        work_mode = dps.get(str(FEYREE_MODE_DPS), None)
-        work_state = dps.get("3", None)  # ВАЖЛИВО: це реальний стан зарядки!
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                result = None
+                try:
+                    result = await func(*args, **kwargs)
+                    return result
+                finally:
+                    histogram.observe_since(started)
+                    if failures is not None and (result is None or result is False):
+                        failures.inc()
 
-        # Додаткові важливі коди зі snapshot.json
-        charge_status = dps.get("101", None)  # finish/charging/тощо
-        energy_kwh = dps.get("102", None)  # енергія в Втг
-        current_a = dps.get("114", None)  # струм
-        max_current = dps.get("115", None)  # макс струм
-        charging_time = dps.get("120", None)  # час зарядки
-        charge_mode_status = dps.get("124", None)  # статус режиму зарядки
+            return async_wrapper
 
-        # Виводимо основну інформацію
-        if work_state is not None:
-            logger.info(f"  └─ DPS 3 (work_state): {work_state}")
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                histogram.observe_since(started)
+                if failures is not None and (result is None or result is False):
+                    failures.inc()
 
-        if switch_state is not None:
-            logger.info(
-                f"  └─ DPS {FEYREE_SWITCH_DPS} (switch): {'ВВІМК' if switch_state else 'ВИМК'}"
-            )
+        return wrapper
 
-        if work_mode is not None:
-            logger.info(f"  └─ DPS {FEYREE_MODE_DPS} (work_mode): {work_mode}")
+    return decorator
 
-        if charge_status is not None:
-            logger.info(f"  └─ DPS 101 (charge_status): {charge_status}")
 
-        if charge_mode_status is not None:
-            logger.info(f"  └─ DPS 124 (mode_status): {charge_mode_status}")
+async def read_http_request(
+    reader: asyncio.StreamReader, timeout: float = 5
+) -> tuple[str, str, Dict[str, str], Dict[str, str]]:
+    """
+    Зчитує рядок запиту та заголовки HTTP/1.1 (тіло не підтримується).
 
-        if current_a is not None:
-            logger.info(f"  └─ DPS 114 (current): {current_a}A")
+    Returns:
+        (метод, шлях, параметри query, заголовки з іменами в нижньому регістрі)
+    """
+    request_line = await asyncio.wait_for(reader.readline(), timeout)
+    headers: Dict[str, str] = {}
+    while (line := await asyncio.wait_for(reader.readline(), timeout)) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    parts = request_line.decode("latin1").split()
+    if len(parts) < 2:
+        return "", "", {}, headers
+    path, _, query_string = parts[1].partition("?")
+    query = {}
+    for pair in filter(None, query_string.split("&")):
+        key, _, value = pair.partition("=")
+        query[key] = value
+    return parts[0], path, query, headers
 
-        if max_current is not None:
-            logger.info(f"  └─ DPS 115 (max_current): {max_current}A")
 
-        if energy_kwh is not None:
-            # Згідно з devices.json, scale=3, тому ділимо на 1000
-            # DPS 102 повертає integer, конвертуємо в float
-            energy_display: float = float(energy_kwh) / 1000.0
-            logger.info(f"  └─ DPS 102 (energy): {energy_display:.3f} kWh")
+def http_response(
+    status: str, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None
+) -> bytes:
+    """Формує HTTP/1.1 відповідь з Connection: close."""
+    lines = [f"HTTP/1.1 {status}"]
+    if body or not status.startswith("304"):
+        lines.append(f"Content-Type: {content_type}")
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    lines.append(f"Content-Length: {len(body)}")
+    lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
 
-        if charging_time is not None:
-            logger.info(f"  └─ DPS 120 (time): {charging_time}")
 
-    def should_charge(
-        self, battery_soc: float, grid_power: float, grid_direction: str
-    ) -> bool:
-        """
-        Визначає чи потрібно вмикати зарядку на основі поточного стану.
+async def start_metrics_server(
+    registry: "MetricsRegistry",
+    host: str = METRICS_HOST,
+    port: int = METRICS_PORT,
+    profiler: Optional["ContinuousProfiler"] = None,
+    profile_control: bool = PROFILE_HTTP_CONTROL,
+) -> asyncio.base_events.Server:
+    """
+    Запускає HTTP сервер з endpoint /metrics у поточному event loop.
 
-        Логіка: Зарядка увімкнена якщо:
-        - Батарея заряджена >= SOC_THRESHOLD (за замовчуванням 90%)
-        - ТА немає помітного імпорту з мережі:
-          - АБО напрямок != "import"
-          - АБО потужність імпорту < GRID_IMPORT_THRESHOLD (за замовчуванням 250W)
+    З профілювальником також GET /profile (стан і розбивка поточного вікна
+    за фазами), а з profile_control - POST /profile/start, POST /profile/stop
+    (без автентифікації, тому за замовчуванням вимкнені).
 
-        Args:
-            battery_soc: Рівень заряду батареї (%)
-            grid_power: Потужність мережі (W)
-            grid_direction: Напрямок потоку енергії
+    Returns:
+        asyncio Server (закривається викликом close())
+    """
 
-        Returns:
-            True якщо потрібно заряджати, False інакше
-        """
-        # Умова 1: Батарея достатньо заряджена
-        soc_ok = battery_soc >= SOC_THRESHOLD
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, _, _ = await read_http_request(reader)
+            if method == "GET" and path == "/metrics":
+                response = http_response(
+                    "200 OK",
+                    registry.render().encode(),
+                    "text/plain; version=0.0.4; charset=utf-8",
+                )
+            elif profiler is not None and (
+                (method, path) == ("GET", "/profile")
+                or (
+                    profile_control
+                    and (method, path) in (("POST", "/profile/start"), ("POST", "/profile/stop"))
+                )
+            ):
+                if path == "/profile/start":
+                    profiler.start("HTTP")
+                elif path == "/profile/stop":
+                    # Зупинка чекає на запис останнього вікна
+                    await asyncio.to_thread(profiler.stop, "HTTP")
+                response = http_response(
+                    "200 OK",
+                    json.dumps(profiler.status(), ensure_ascii=False).encode(),
+                    "application/json; charset=utf-8",
+                )
+            else:
+                response = http_response("404 Not Found", b"Not Found\n", "text/plain; charset=utf-8")
+            writer.write(response)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
 
-        # Умова 2: Немає помітного імпорту з мережі
-        grid_ok = (grid_direction != "import") or (grid_power < GRID_IMPORT_THRESHOLD)
+    return await asyncio.start_server(handle, host, port)
 
-        return soc_ok and grid_ok
 
+METRICS = MetricsRegistry()
+
+DEYE_READ_SECONDS = METRICS.histogram(
+    "deye_read_registers_seconds", "Тривалість read_registers (з повторами)"
+)
+DEYE_READ_RETRIES = METRICS.counter(
+    "deye_read_retries_total", "Повторні спроби читання регістрів"
+)
+DEYE_ERRORS_NO_SOCKET = METRICS.counter(
+    "deye_errors_total", "Помилки зв'язку з інвертором", error="no_socket"
+)
+DEYE_ERRORS_FRAME = METRICS.counter(
+    "deye_errors_total", "Помилки зв'язку з інвертором", error="v5_frame"
+)
+DEYE_ERRORS_TIMEOUT = METRICS.counter(
+    "deye_errors_total", "Помилки зв'язку з інвертором", error="timeout"
+)
+DEYE_ERRORS_SOCKET = METRICS.counter(
+    "deye_errors_total", "Помилки зв'язку з інвертором", error="socket"
+)
+DEYE_RECONNECTS = METRICS.counter(
+    "deye_reconnects_total", "Перепідключення до інвертора"
+)
+DEYE_BREAKER_STATE = METRICS.gauge(
+    "deye_breaker_state", "Стан circuit breaker інвертора (0 замкнено, 1 розімкнено, 2 пробне читання)"
+)
+DEYE_BREAKER_OPENS = METRICS.counter(
+    "deye_breaker_opens_total", "Розмикання circuit breaker інвертора"
+)
+DEYE_BREAKER_REJECTED = METRICS.counter(
+    "deye_breaker_rejected_total", "Читання, відхилені розімкненим circuit breaker"
+)
+PROXY_CLIENTS = METRICS.gauge("proxy_clients", "Підключені клієнти проксі logger")
+PROXY_CACHE_HITS = METRICS.counter(
+    "proxy_requests_total", "Запити клієнтів проксі", result="cache_hit"
+)
+PROXY_COALESCED = METRICS.counter(
+    "proxy_requests_total", "Запити клієнтів проксі", result="coalesced"
+)
+PROXY_UPSTREAM = METRICS.counter(
+    "proxy_requests_total", "Запити клієнтів проксі", result="upstream"
+)
+PROXY_ERRORS = METRICS.counter(
+    "proxy_requests_total", "Запити клієнтів проксі", result="error"
+)
+PROXY_UPSTREAM_SECONDS = METRICS.histogram(
+    "proxy_upstream_seconds", "Тривалість запиту проксі до logger"
+)
+INVERTER_FALLBACK_CACHED = METRICS.counter(
+    "inverter_fallback_total", "Рішення без свіжих даних інвертора", action="cached"
+)
+INVERTER_FALLBACK_SAFE_OFF = METRICS.counter(
+    "inverter_fallback_total", "Рішення без свіжих даних інвертора", action="safe_off"
+)
+FEYREE_STATUS_SECONDS = METRICS.histogram(
+    "feyree_status_seconds", "Тривалість запиту status() до зарядки"
+)
+FEYREE_STATUS_ERRORS = METRICS.counter(
+    "feyree_status_errors_total", "Помилки запиту status() до зарядки"
+)
+FEYREE_ADDRESS_CHANGES = METRICS.counter(
+    "feyree_address_changes_total", "Зміни адреси зарядки, знайдені за UDP broadcast"
+)
+FEYREE_TURN_ON_SECONDS = METRICS.histogram(
+    "feyree_command_seconds", "Час від надсилання команди до підтвердження", command="turn_on"
+)
+FEYREE_TURN_OFF_SECONDS = METRICS.histogram(
+    "feyree_command_seconds", "Час від надсилання команди до підтвердження", command="turn_off"
+)
+FEYREE_SET_CURRENT_SECONDS = METRICS.histogram(
+    "feyree_command_seconds", "Час від надсилання команди до підтвердження", command="set_current"
+)
+FEYREE_TURN_ON_FAILURES = METRICS.counter(
+    "feyree_command_failures_total", "Команди без підтвердження", command="turn_on"
+)
+FEYREE_TURN_OFF_FAILURES = METRICS.counter(
+    "feyree_command_failures_total", "Команди без підтвердження", command="turn_off"
+)
+FEYREE_SET_CURRENT_FAILURES = METRICS.counter(
+    "feyree_command_failures_total", "Команди без підтвердження", command="set_current"
+)
+STATE_API_OK = METRICS.counter(
+    "state_api_requests_total", "Запити до HTTP API стану", status="200"
+)
+STATE_API_NOT_MODIFIED = METRICS.counter(
+    "state_api_requests_total", "Запити до HTTP API стану", status="304"
+)
+STATE_API_WAITING = METRICS.gauge(
+    "state_api_waiting", "Запити до HTTP API стану, що очікують змін (long-poll)"
+)
+CONTROL_ITERATION_SECONDS = METRICS.histogram(
+    "control_iteration_seconds", "Тривалість ітерації циклу керування"
+)
+CONFIG_RELOADS_OK = METRICS.counter(
+    "config_reloads_total", "Перезавантаження налаштувань", result="ok"
+)
+CONFIG_RELOADS_FAILED = METRICS.counter(
+    "config_reloads_total", "Перезавантаження налаштувань", result="error"
+)
+PHASE_DEADLINES = {
+    "sample": DEADLINE_SAMPLE_SEC,
+    "decide": DEADLINE_DECIDE_SEC,
+    "actuate": DEADLINE_ACTUATE_SEC,
+}
+CONTROL_PHASE_SECONDS = {
+    phase: METRICS.histogram("control_phase_seconds", "Тривалість фази ітерації", phase=phase)
+    for phase in PHASE_DEADLINES
+}
+CONTROL_PHASE_OVERRUNS = {
+    phase: METRICS.counter(
+        "control_phase_overruns_total", "Перевищення дедлайну фази ітерації", phase=phase
+    )
+    for phase in PHASE_DEADLINES
+}
+SCHEDULE_LATENESS = {
+    loop: METRICS.histogram(
+        "schedule_lateness_seconds", "Запізнення запуску тику відносно сітки", loop=loop
+    )
+    for loop in ("control", "sampler", "surplus")
+}
+SCHEDULE_SKIPPED = {
+    loop: METRICS.counter(
+        "schedule_skipped_ticks_total", "Пропущені (об'єднані) тики планувальника", loop=loop
+    )
+    for loop in ("control", "sampler", "surplus")
+}
+BATTERY_SOC = METRICS.gauge("battery_soc_percent", "Рівень заряду батареї (%)")
+GRID_POWER = METRICS.gauge(
+    "grid_power_watts", "Потужність мережі (W, позитивне = імпорт)"
+)
+CHARGER_STATE = METRICS.gauge(
+    "charger_state", "Стан зарядки (-1 невідомо, 0 ВИМК, 1 ВВІМК, 2 заряджає)"
+)
+CHARGER_CURRENT = METRICS.gauge(
+    "charger_current_amps", "Встановлений струм зарядки (A)"
+)
+CHARGER_STATE.set(-1)
+CHARGER_CURRENT.set(math.nan)
+PLAN_RUNS = {
+    reason: METRICS.counter("plan_runs_total", "Розрахунки плану зарядки", reason=reason)
+    for reason in ("start", "forecast", "soc", "expired")
+}
+PLAN_SECONDS = METRICS.histogram("plan_compute_seconds", "Тривалість розрахунку плану зарядки")
+PLAN_FALLBACK = METRICS.counter(
+    "plan_fallback_total", "Рішення за пороговим правилом без дійсного плану"
+)
+
+# Фази циклу для профілювання; стек без маркера фази - "other" або "idle"
+PROFILE_PHASES = ("inverter", "status", "decide", "actuate")
+PROFILER_ACTIVE = METRICS.gauge("profiler_active", "Профілювання циклу увімкнено (1/0)")
+PROFILER_SAMPLES = {
+    phase: METRICS.counter("profiler_samples_total", "Вибірки стеків профілювальника", phase=phase)
+    for phase in PROFILE_PHASES + ("other", "idle")
+}
+
+
+# ============================================================
+# Профілювання циклу керування
+# ============================================================
+
+
+class ContinuousProfiler:
+    """
+    Вибірковий профілювальник для роботи у production.
+
+    Окремий потік кожні interval_sec знімає стеки всіх потоків
+    (sys._current_frames) і відносить кожен стек до фази циклу за
+    найглибшою функцією-маркером у ньому (mark()): так потоки tinytuya та
+    корутини інвертора в event loop отримують власні фази. Стек без маркера -
+    "idle", якщо потік з попередньої вибірки майже не використав CPU
+    (очікування в select, черзі, sleep), інакше "other" (напр. логування).
+
+    Час CPU кожного потоку (/proc/self/task/<tid>/schedstat) між вибірками
+    приписується фазі його поточного стеку. Час виконання фаз (wall) вимірює
+    сам цикл через timed() / record_wall(). Різниця wall та CPU фази - час
+    очікування мережі або пауз.
+
+    Раз на rotate_sec у output_dir записуються profile-<час>.folded
+    (collapsed stacks для flamegraph.pl / speedscope, корінь - фаза, далі
+    потік; стеки "idle" не пишуться) та profile-<час>.json з розбивкою за
+    фазами. Без активного профілювання цикл перевіряє лише прапорець active.
+    """
+
+    def __init__(
+        self,
+        output_dir: str = PROFILE_DIR,
+        interval_sec: float = PROFILE_INTERVAL_SEC,
+        rotate_sec: float = PROFILE_ROTATE_SEC,
+        keep_files: int = PROFILE_KEEP_FILES,
+    ):
+        self.output_dir = output_dir
+        self.interval_sec = interval_sec
+        self.rotate_sec = rotate_sec
+        self.keep_files = keep_files
+        self.active = False
+        self.last_files: list[str] = []
+        self._markers: Dict[object, str] = {}
+        self._labels: Dict[object, str] = {}
+        self._lock = threading.Lock()
+        # start()/stop() можуть виконуватись з різних потоків (event loop, to_thread)
+        self._control_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping: Optional[asyncio.Task] = None
+        self._reset_window()
+
+    def mark(self, phase: str, *functions: Callable):
+        """Позначає функції (або корутини), виконання яких належить фазі."""
+        for function in functions:
+            # Обгортки (напр. @timed) спільні для багатьох функцій - маркер на оригіналі
+            self._markers[inspect.unwrap(function).__code__] = phase
+
+    def _reset_window(self):
+        self._window_started = time.time()
+        self._window_end = time.monotonic() + self.rotate_sec
+        self._stacks: Dict[str, int] = {}
+        self._samples: Dict[str, int] = {}
+        self._cpu: Dict[str, float] = {}
+        self._wall: Dict[str, float] = {}
+        self._calls: Dict[str, int] = {}
+
+    # ---------- керування ----------
+
+    def start(self, reason: str) -> bool:
+        """Вмикає профілювання. Повертає False, якщо вже увімкнено або немає PROFILE_DIR."""
+        with self._control_lock:
+            if self.active or not self.output_dir:
+                return False
+            try:
+                os.makedirs(self.output_dir, exist_ok=True)
+            except OSError as e:
+                logger.error(f"Профілювання: не вдалося створити {self.output_dir}: {e}")
+                return False
+            with self._lock:
+                self._reset_window()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self.active = True
+            PROFILER_ACTIVE.set(1)
+            self._thread.start()
+        logger.info(
+            f"Профілювання увімкнено ({reason}): вибірка раз на {self.interval_sec * 1000:.0f} мс, "
+            f"файли в {self.output_dir} раз на {self.rotate_sec:.0f} сек"
+        )
+        return True
+
+    def stop(self, reason: str) -> bool:
+        """
+        Вимикає профілювання та записує незавершене вікно.
+
+        Чекає на потік вибірки та запис файлів, тому з event loop
+        викликається через asyncio.to_thread().
+        """
+        with self._control_lock:
+            if not self.active:
+                return False
+            self.active = False
+            PROFILER_ACTIVE.set(0)
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+        logger.info(f"Профілювання вимкнено ({reason})")
+        return True
+
+    def toggle(self, reason: str = "SIGUSR1"):
+        """Перемикає профілювання (обробник сигналу в event loop)."""
+        if self._stopping is not None and not self._stopping.done():
+            logger.info("Профілювання ще зупиняється (запис останнього вікна)")
+        elif self.active:
+            # Зупинка - у потоці, щоб запис вікна не блокував цикл керування
+            self._stopping = asyncio.get_running_loop().create_task(
+                asyncio.to_thread(self.stop, reason), name="profiler-stop"
+            )
+        elif not self.start(reason):
+            logger.warning("Профілювання недоступне: не задано PROFILE_DIR")
+
+    # ---------- вимірювання фаз циклом ----------
+
+    def timed(self, phase: str, awaitable: Awaitable) -> Awaitable:
+        """Обгортає корутину вимірюванням часу фази (без профілювання - без змін)."""
+        if not self.active:
+            return awaitable
+        return self._timed(phase, awaitable)
+
+    async def _timed(self, phase: str, awaitable: Awaitable):
+        started = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.record_wall(phase, time.monotonic() - started)
+
+    def record_wall(self, phase: str, duration: float):
+        """Додає тривалість виконання фази до поточного вікна."""
+        if not self.active:
+            return
+        with self._lock:
+            self._wall[phase] = self._wall.get(phase, 0.0) + duration
+            self._calls[phase] = self._calls.get(phase, 0) + 1
+
+    # ---------- вибірка ----------
+
+    @staticmethod
+    def _thread_cpu(native_id: Optional[int]) -> Optional[float]:
+        """Час CPU потоку (секунди) або None, якщо недоступно."""
+        if native_id is None:
+            return None
+        try:
+            with open(f"/proc/self/task/{native_id}/schedstat") as f:
+                return int(f.read().split()[0]) / 1e9
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = f"{name} ({os.path.basename(code.co_filename)})"
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        cpu_seen: Dict[int, float] = {}
+        own_cpu_started = time.thread_time()
+        next_tick = time.monotonic()
+        while not self._stop.wait(max(0.0, next_tick - time.monotonic())):
+            now = time.monotonic()
+            # Пропущені тики не надолужуються
+            next_tick = max(next_tick + self.interval_sec, now)
+            try:
+                self._sample(own_ident, cpu_seen)
+            except Exception as e:
+                logger.warning(f"Профілювання: помилка вибірки: {e!r}")
+            if now >= self._window_end:
+                own_cpu = time.thread_time()
+                self._flush(own_cpu - own_cpu_started)
+                own_cpu_started = own_cpu
+        self._flush(time.thread_time() - own_cpu_started)
+
+    def _sample(self, own_ident: int, cpu_seen: Dict[int, float]):
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        for ident in list(cpu_seen):
+            if ident not in frames:
+                del cpu_seen[ident]
+        samples = []
+        for ident, frame in frames.items():
+            if ident == own_ident:
+                continue
+            thread = threads.get(ident)
+            cpu = self._thread_cpu(getattr(thread, "native_id", None))
+            cpu_delta = 0.0
+            if cpu is not None:
+                cpu_delta = max(0.0, cpu - cpu_seen.get(ident, cpu))
+                cpu_seen[ident] = cpu
+
+            phase = None
+            labels = []
+            while frame is not None:
+                code = frame.f_code
+                if phase is None:
+                    phase = self._markers.get(code)
+                labels.append(self._label(code))
+                frame = frame.f_back
+            if phase is None:
+                # Майже без CPU з попередньої вибірки - потік чекає
+                idle = cpu is not None and cpu_delta < self.interval_sec * 0.05
+                phase = "idle" if idle else "other"
+            thread_name = thread.name.rstrip("0123456789").rstrip("_-") if thread else str(ident)
+            labels.append(thread_name)
+            labels.append(phase)
+            samples.append((phase, ";".join(reversed(labels)), cpu_delta))
+
+        with self._lock:
+            for phase, stack, cpu_delta in samples:
+                self._samples[phase] = self._samples.get(phase, 0) + 1
+                self._cpu[phase] = self._cpu.get(phase, 0.0) + cpu_delta
+                if phase != "idle":
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+        for phase, _, _ in samples:
+            PROFILER_SAMPLES[phase].inc()
+
+    # ---------- звіти ----------
+
+    def _breakdown(self, ended_at: float, profiler_cpu_sec: Optional[float] = None) -> Dict:
+        """Розбивка поточного вікна за фазами (викликається під self._lock)."""
+        phases = {}
+        for phase in PROFILE_PHASES + ("other", "idle"):
+            phases[phase] = {
+                "wall_sec": round(self._wall[phase], 6) if phase in self._wall else None,
+                "calls": self._calls.get(phase, 0),
+                "cpu_sec": round(self._cpu.get(phase, 0.0), 6),
+                "samples": self._samples.get(phase, 0),
+            }
+        return {
+            "started_at": self._window_started,
+            "ended_at": ended_at,
+            "interval_sec": self.interval_sec,
+            "samples": sum(self._samples.values()),
+            "phases": phases,
+            "profiler_cpu_sec": None if profiler_cpu_sec is None else round(profiler_cpu_sec, 6),
+        }
+
+    def status(self) -> Dict:
+        """Стан профілювальника та розбивка поточного вікна (для HTTP)."""
+        with self._lock:
+            window = self._breakdown(time.time()) if self.active else None
+        return {
+            "active": self.active,
+            "output_dir": self.output_dir or None,
+            "interval_sec": self.interval_sec,
+            "rotate_sec": self.rotate_sec,
+            "window": window,
+            "last_files": self.last_files,
+        }
+
+    def _flush(self, profiler_cpu_sec: float):
+        """Записує вікно у файли та починає нове (у потоці профілювальника)."""
+        with self._lock:
+            stacks = self._stacks
+            breakdown = self._breakdown(time.time(), profiler_cpu_sec)
+            self._reset_window()
+        if not breakdown["samples"]:
+            return
+
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(breakdown["started_at"]))
+        base = os.path.join(self.output_dir, f"profile-{stamp}")
+        suffix = 1
+        while os.path.exists(f"{base}.folded"):
+            suffix += 1
+            base = os.path.join(self.output_dir, f"profile-{stamp}-{suffix}")
+        try:
+            with open(f"{base}.folded", "w", encoding="utf-8") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            with open(f"{base}.json", "w", encoding="utf-8") as f:
+                json.dump(breakdown, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logger.warning(f"Профілювання: не вдалося записати {base}: {e}")
+            return
+        self.last_files = [f"{base}.folded", f"{base}.json"]
+        self._prune()
+
+        summary = ", ".join(
+            f"{phase} {values['wall_sec'] or 0:.2f}/{values['cpu_sec']:.2f}"
+            for phase, values in breakdown["phases"].items()
+            if phase in PROFILE_PHASES
+        )
+        logger.info(
+            f"Профілювання: {base}.folded ({breakdown['samples']} вибірок); "
+            f"фази wall/CPU сек: {summary}; other CPU {breakdown['phases']['other']['cpu_sec']:.2f}"
+        )
+
+    def _prune(self):
+        """Видаляє найстаріші вікна понад keep_files."""
+        try:
+            windows = sorted(
+                name[: -len(".folded")]
+                for name in os.listdir(self.output_dir)
+                if name.startswith("profile-") and name.endswith(".folded")
+            )
+        except OSError:
+            return
+        for name in windows[: max(0, len(windows) - self.keep_files)]:
+            for extension in (".folded", ".json"):
+                try:
+                    os.remove(os.path.join(self.output_dir, name + extension))
+                except OSError:
+                    pass
+
+
+PROFILER = ContinuousProfiler()
+
+
+# ============================================================
+# Декларативна карта регістрів Deye
+# ============================================================
+
+
+# Типи полів: 16 або 32 біти (32-біт: молодше слово першим), без знаку або зі знаком
+REGISTER_TYPES = ("u16", "s16", "u32", "s32")
+# Імена атрибутів InverterSnapshot, які не можуть бути полями карти
+RESERVED_FIELD_NAMES = ("timestamp", "extra")
+
+
+@dataclass(frozen=True)
+class RegisterField:
+    """Опис одного значення в регістрах інвертора."""
+
+    name: str  # Ім'я поля в InverterSnapshot
+    address: int  # Адреса (для 32-біт - молодше слово)
+    type: str = "u16"  # "u16", "s16", "u32", "s32" (32-біт: молодше слово першим)
+    scale: float = 1.0  # Множник сирого значення
+    sign: int = 1  # -1 щоб змінити напрямок (напр. розряд/заряд батареї)
+    unit: str = ""
+
+    def __post_init__(self):
+        """
+        Перевіряє опис поля.
+
+        Raises:
+            ValueError: Невідомий тип, зарезервоване ім'я або некоректна адреса
+        """
+        if self.type not in REGISTER_TYPES:
+            raise ValueError(
+                f"Поле {self.name}: невідомий тип {self.type!r} (очікується {', '.join(REGISTER_TYPES)})"
+            )
+        if self.name in RESERVED_FIELD_NAMES:
+            raise ValueError(f"Поле {self.name}: ім'я зарезервоване в InverterSnapshot")
+        if not isinstance(self.address, int) or not 0 <= self.address <= 0xFFFF - (self.words - 1):
+            raise ValueError(f"Поле {self.name}: некоректна адреса {self.address!r}")
+
+    @property
+    def words(self) -> int:
+        """Кількість 16-бітних регістрів поля."""
+        return 2 if self.type in ("u32", "s32") else 1
+
+
+# Карта за замовчуванням для Deye SUN-10K (однофазний гібрид)
+DEFAULT_REGISTER_FIELDS = (
+    RegisterField("grid_l1_power_w", 167, "s16", unit="W"),
+    RegisterField("grid_l2_power_w", 168, "s16", unit="W"),
+    RegisterField("grid_power_w", 169, "s16", unit="W"),  # позитивне = імпорт
+    RegisterField("grid_ct_power_w", 172, "s16", unit="W"),
+    RegisterField("inverter_power_w", 175, "s16", unit="W"),
+    RegisterField("load_power_w", 178, "s16", unit="W"),
+    RegisterField("battery_voltage_v", 183, "u16", scale=0.01, unit="V"),
+    RegisterField("battery_soc_pct", 184, "u16", unit="%"),
+    RegisterField("pv1_power_w", 186, "u16", unit="W"),
+    RegisterField("pv2_power_w", 187, "u16", unit="W"),
+    RegisterField("battery_power_w", 190, "s16", unit="W"),  # позитивне = розряд
+    RegisterField("battery_current_a", 191, "s16", scale=0.01, unit="A"),
+)
+
+# Поля, без яких цикл керування не працює
+REQUIRED_FIELDS = ("grid_power_w", "battery_soc_pct")
+
+
+@dataclass(frozen=True)
+class ReadBlock:
+    """Один запит read_holding_registers та поля, які з нього декодуються."""
+
+    start: int
+    count: int
+    # (ім'я, офсет, тип, множник) - підготовлено для швидкого декодування
+    fields: tuple
+
+    def decode(self, values: list[int]) -> Dict[str, float]:
+        """
+        Декодує значення регістрів блоку за один прохід.
+
+        Signed-значення читаються через memoryview того ж буфера (без копій).
+
+        Args:
+            values: Регістри блоку, починаючи з self.start
+
+        Returns:
+            Словник {ім'я поля: значення з урахуванням множника та знаку}
+        """
+        raw = array("H", values)
+        signed = memoryview(raw).cast("B").cast("h")
+        out = {}
+        for name, offset, kind, factor in self.fields:
+            if kind == "u16":
+                value = raw[offset]
+            elif kind == "s16":
+                value = signed[offset]
+            else:
+                value = raw[offset] | (raw[offset + 1] << 16)
+                if kind == "s32" and value >= 0x80000000:
+                    value -= 0x100000000
+            out[name] = value * factor
+        return out
+
+
+class RegisterMap:
+    """
+    Декларативна карта регістрів з планувальником блочного читання.
+
+    Планувальник об'єднує потрібні поля в мінімальну кількість суцільних
+    запитів у межах max_block регістрів, дочитуючи проміжки до max_gap.
+    """
+
+    def __init__(
+        self,
+        fields=DEFAULT_REGISTER_FIELDS,
+        max_block: int = MAX_REGISTERS_PER_READ,
+        max_gap: int = REGISTER_MAX_GAP,
+    ):
+        """
+        Args:
+            fields: Послідовність RegisterField
+            max_block: Максимальна кількість регістрів в одному запиті
+            max_gap: Максимальний проміжок, який дочитується в межах блоку
+        """
+        self.fields = {f.name: f for f in fields}
+        self.max_block = max_block
+        self.max_gap = max_gap
+        self._plans: Dict[tuple, list[ReadBlock]] = {}
+
+    @classmethod
+    def from_file(
+        cls, path: str, required: tuple = REQUIRED_FIELDS, **kwargs
+    ) -> "RegisterMap":
+        """
+        Завантажує карту з JSON файлу.
+
+        Формат: {"fields": [{"name": ..., "address": ..., "type": "s16",
+        "scale": 1, "sign": 1, "unit": "W"}, ...]}
+
+        Args:
+            path: Шлях до JSON файлу
+            required: Поля, які мають бути в карті (() = без перевірки)
+
+        Raises:
+            OSError: Файл недоступний
+            ValueError: Некоректний JSON, опис поля, дублікат імені або
+                відсутнє обов'язкове поле
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or not isinstance(data.get("fields"), list):
+            raise ValueError(f"Карта {path}: очікується об'єкт зі списком fields")
+        fields = []
+        for index, item in enumerate(data["fields"]):
+            name = item.get("name", f"#{index}") if isinstance(item, dict) else f"#{index}"
+            try:
+                fields.append(RegisterField(**item))
+            except TypeError as e:
+                raise ValueError(f"Карта {path}, поле {name}: {e}") from None
+            except ValueError as e:
+                raise ValueError(f"Карта {path}: {e}") from None
+        names = [f.name for f in fields]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Карта {path}: поля описані кілька разів: {', '.join(duplicates)}")
+        missing = [name for name in required if name not in names]
+        if missing:
+            raise ValueError(f"Карта {path}: немає обов'язкових полів {', '.join(missing)}")
+        return cls(fields, **kwargs)
+
+    def plan(self, names=None) -> list[ReadBlock]:
+        """
+        Будує (і кешує) план читання для заданих полів.
+
+        Args:
+            names: Імена полів (None = всі поля карти)
+
+        Returns:
+            Список ReadBlock, відсортований за адресою
+
+        Raises:
+            ValueError: Якщо поле відсутнє в карті
+        """
+        key = tuple(sorted(names)) if names else tuple(sorted(self.fields))
+        if key in self._plans:
+            return self._plans[key]
+        unknown = [name for name in key if name not in self.fields]
+        if unknown:
+            raise ValueError(f"Поля відсутні в карті регістрів: {', '.join(unknown)}")
+
+        wanted = sorted((self.fields[name] for name in key), key=lambda f: f.address)
+        groups: list[list[RegisterField]] = []
+        for field_def in wanted:
+            if groups:
+                group = groups[-1]
+                start = group[0].address
+                end = max(f.address + f.words for f in group)
+                new_end = max(end, field_def.address + field_def.words)
+                if (
+                    field_def.address - end <= self.max_gap
+                    and new_end - start <= self.max_block
+                ):
+                    group.append(field_def)
+                    continue
+            groups.append([field_def])
+
+        blocks = []
+        for group in groups:
+            start = group[0].address
+            end = max(f.address + f.words for f in group)
+            blocks.append(
+                ReadBlock(
+                    start=start,
+                    count=end - start,
+                    fields=tuple(
+                        (f.name, f.address - start, f.type, f.scale * f.sign)
+                        for f in group
+                    ),
+                )
+            )
+        self._plans[key] = blocks
+        return blocks
+
+
+def load_register_map() -> RegisterMap:
+    """Карта з REGISTER_MAP_FILE або вбудована карта SUN-10K."""
+    if REGISTER_MAP_FILE:
+        logger.info(f"Карта регістрів: {REGISTER_MAP_FILE}")
+        return RegisterMap.from_file(REGISTER_MAP_FILE)
+    return RegisterMap()
+
+
+def inverter_fields(register_map: RegisterMap) -> list[str]:
+    """Поля для читання: INVERTER_FIELDS (+ обов'язкові) або вся карта."""
+    if not INVERTER_FIELDS:
+        return sorted(register_map.fields)
+    return sorted(set(INVERTER_FIELDS) | set(REQUIRED_FIELDS))
+
+
+@dataclass(slots=True)
+class InverterSnapshot:
+    """Типізований знімок стану інвертора за одне опитування."""
+
+    timestamp: float  # time.time() моменту читання
+    battery_soc_pct: float
+    grid_power_w: float  # позитивне = імпорт
+    grid_l1_power_w: Optional[float] = None
+    grid_l2_power_w: Optional[float] = None
+    grid_ct_power_w: Optional[float] = None
+    inverter_power_w: Optional[float] = None
+    load_power_w: Optional[float] = None
+    battery_voltage_v: Optional[float] = None
+    battery_power_w: Optional[float] = None
+    battery_current_a: Optional[float] = None
+    pv1_power_w: Optional[float] = None
+    pv2_power_w: Optional[float] = None
+    extra: Dict[str, float] = field(default_factory=dict)  # Поля поза схемою
+
+    @classmethod
+    def from_values(cls, values: Dict[str, float]) -> "InverterSnapshot":
+        """Створює знімок з декодованих значень (невідомі поля - в extra)."""
+        known = {k: v for k, v in values.items() if k in cls.__dataclass_fields__}
+        extra = {k: v for k, v in values.items() if k not in known}
+        return cls(timestamp=time.time(), extra=extra, **known)
+
+    @property
+    def pv_power_w(self) -> Optional[float]:
+        """Сумарна потужність PV (W)."""
+        if self.pv1_power_w is None and self.pv2_power_w is None:
+            return None
+        return (self.pv1_power_w or 0.0) + (self.pv2_power_w or 0.0)
+
+    @property
+    def grid_direction(self) -> str:
+        """Напрямок потоку енергії мережі."""
+        return DeyeInverter.grid_direction(self.grid_power_w)
+
+    def as_state(self) -> Dict[str, float | str]:
+        """Стан у форматі DeyeInverter.get_battery_and_grid_state()."""
+        return {
+            "battery_soc_pct": float(self.battery_soc_pct),
+            "grid_power_w": float(self.grid_power_w),
+            "grid_direction": self.grid_direction,
+        }
+
+
+# ============================================================
+# Стійкість зв'язку з інвертором
+# ============================================================
+
+
+class CircuitOpenError(V5FrameError):
+    """Читання не виконувалось: circuit breaker розімкнено."""
+
+
+class ModbusExceptionError(V5FrameError):
+    """Пристрій відповів Modbus exception (напр. недопустима адреса): повтор не допоможе."""
+
+    @staticmethod
+    def matches(exc: BaseException) -> bool:
+        """
+        Exception-відповідь: async клієнт піднімає помилку umodbus, синхронний -
+        V5FrameError, про яку свідчить лише текст.
+        """
+        if isinstance(exc, ModbusError):
+            return True
+        return isinstance(exc, V5FrameError) and "Modbus EXCEPTION" in str(exc)
+
+
+def retry_backoff_sec(attempt: int) -> float:
+    """
+    Затримка перед повтором: експоненційна з jitter.
+
+    Args:
+        attempt: Номер невдалої спроби (0 = перша)
+
+    Returns:
+        Випадкове значення з [ceiling/2, ceiling], де ceiling =
+        min(RETRY_MAX_DELAY_SEC, RETRY_DELAY_SEC * 2^attempt)
+    """
+    ceiling = min(RETRY_MAX_DELAY_SEC, RETRY_DELAY_SEC * (2**attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker для зв'язку з logger.
+
+    Після failure_threshold невдалих читань поспіль розмикається, і читання
+    одразу завершуються CircuitOpenError без звернення до мережі. Через
+    reset_sec дозволяється одне пробне читання: успіх замикає breaker,
+    невдача розмикає його знову.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(
+        self,
+        name: str = "Deye інвертор",
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_sec: float = BREAKER_RESET_SEC,
+        state_gauge: Gauge = DEYE_BREAKER_STATE,
+        opens: Counter = DEYE_BREAKER_OPENS,
+        rejected: Counter = DEYE_BREAKER_REJECTED,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            name: Назва пристрою для логів
+            failure_threshold: Невдач поспіль до розмикання (0 = вимкнено)
+            reset_sec: Пауза до пробного читання (секунди)
+            state_gauge: Метрика стану
+            opens: Лічильник розмикань
+            rejected: Лічильник відхилених читань
+            clock: Джерело монотонного часу
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_sec = reset_sec
+        self.state_gauge = state_gauge
+        self.opens = opens
+        self.rejected = rejected
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state_gauge.set(self.state)
+
+    def _set_state(self, state: int):
+        self.state = state
+        self.state_gauge.set(state)
+
+    def before_call(self):
+        """
+        Перевіряє, чи дозволено звернення до пристрою.
+
+        Raises:
+            CircuitOpenError: Якщо breaker розімкнено або пробне читання вже триває
+        """
+        if self.state == self.CLOSED:
+            return
+        remaining = self.reset_sec - (self.clock() - self.opened_at)
+        if self.state == self.OPEN and remaining <= 0:
+            logger.info(f"{self.name}: пробне читання після {self.reset_sec:.0f} сек паузи")
+            self._set_state(self.HALF_OPEN)
+            return
+        self.rejected.inc()
+        raise CircuitOpenError(
+            f"{self.name} недоступний (circuit breaker розімкнено, "
+            f"пробне читання через {max(0.0, remaining):.0f} сек)"
+        )
+
+    def record_success(self):
+        """Фіксує успішне читання."""
+        if self.state != self.CLOSED:
+            logger.info(f"{self.name}: зв'язок відновлено, circuit breaker замкнено")
+            self._set_state(self.CLOSED)
+        self.failures = 0
+
+    def record_failure(self):
+        """Фіксує читання, що не вдалося після всіх повторів."""
+        self.failures += 1
+        if self.failure_threshold <= 0:
+            return
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opens.inc()
+                logger.error(
+                    f"{self.name}: {self.failures} невдалих читань поспіль - circuit breaker "
+                    f"розімкнено, наступна спроба через {self.reset_sec:.0f} сек"
+                )
+            self.opened_at = self.clock()
+            self._set_state(self.OPEN)
+
+
+# ============================================================
+# Клас для роботи з Deye інвертором
+# ============================================================
+
+
+class DeyeInverter:
+    """Клас для читання даних з Deye інвертора через Modbus."""
+
+    def __init__(
+        self,
+        register_map: Optional[RegisterMap] = None,
+        address: str = LOGGER_IP,
+        serial: int = LOGGER_SN,
+        port: int = LOGGER_PORT,
+        mb_slave_id: int = MB_SLAVE_ID,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        Ініціалізація клієнта Deye інвертора.
+
+        Args:
+            register_map: Карта регістрів (за замовчуванням load_register_map())
+            address: IP адреса Data Logger Stick
+            serial: Серійний номер logger
+            port: TCP порт logger
+            mb_slave_id: Modbus Slave ID інвертора
+            breaker: Circuit breaker (за замовчуванням - з метриками deye_breaker_*)
+        """
+        self.client = None
+        self.breaker = breaker or CircuitBreaker()
+        self.address = address
+        self.serial = serial
+        self.port = port
+        self.mb_slave_id = mb_slave_id
+        self.register_map = register_map or load_register_map()
+        self.fields = inverter_fields(self.register_map)
+        self.last_snapshot: Optional[InverterSnapshot] = None
+        self._connect()
+        logger.info(
+            f"Deye інвертор: підключення до {self.address}:{self.port} (SN: {self.serial})"
+        )
+
+    def _connect(self):
+        """Створює нове з'єднання з інвертором."""
+        self.client = PySolarmanV5(
+            address=self.address,
+            serial=self.serial,
+            port=self.port,
+            mb_slave_id=self.mb_slave_id,
+            socket_timeout=CONNECTION_TIMEOUT_SEC,
+            verbose=False,
+        )
+
+    def reconnect(self):
+        """Перепідключається до інвертора."""
+        logger.warning("Спроба перепідключення до Deye інвертора...")
+        DEYE_RECONNECTS.inc()
+        try:
+            if self.client:
+                self.disconnect()
+        except Exception:
+            pass  # Ігноруємо помилки при закритті
+        self._connect()
+        logger.info("Перепідключення успішне")
+
+    @timed(DEYE_READ_SECONDS)
+    def read_registers(self, start: int, quantity: int) -> list[int]:
+        """
+        Зчитує діапазон Modbus-регістрів з повторними спробами.
+
+        Усі спроби разом обмежені READ_BUDGET_SEC; між спробами - експоненційна
+        затримка з jitter. Поки circuit breaker розімкнено, читання одразу
+        завершується CircuitOpenError.
+
+        Args:
+            start: Початкова адреса регістру
+            quantity: Кількість регістрів для читання
+
+        Returns:
+            Список значень регістрів
+
+        Raises:
+            V5FrameError: Якщо всі спроби не вдалися (CircuitOpenError - breaker
+                розімкнено, ModbusExceptionError - одразу, без повторів)
+        """
+        self.breaker.before_call()
+        started = time.monotonic()
+        deadline = started + READ_BUDGET_SEC
+        last_exc = None
+        attempts = 0
+
+        for attempt in range(MAX_ATTEMPTS):
+            attempts = attempt + 1
+            need_reconnect = False
+            # Таймаут спроби не виходить за межі бюджету читання
+            self.client.socket_timeout = max(
+                0.1, min(CONNECTION_TIMEOUT_SEC, deadline - time.monotonic())
+            )
+            try:
+                values = self.client.read_holding_registers(
+                    register_addr=start, quantity=quantity
+                )
+                if len(values) != quantity:
+                    raise V5FrameError(
+                        f"Неочікувана довжина відповіді для регістрів {start}-{start+quantity-1}: "
+                        f"{len(values)} != {quantity}"
+                    )
+                self.breaker.record_success()
+                return values
+            except NoSocketAvailableError as exc:
+                # З'єднання закрите - перепідключаємось перед наступною спробою
+                last_exc = exc
+                need_reconnect = True
+                DEYE_ERRORS_NO_SOCKET.inc()
+            except V5FrameError as exc:
+                if ModbusExceptionError.matches(exc):
+                    # Пристрій відповів: зв'язок справний, а повтор дасть ту ж відповідь
+                    self.breaker.record_success()
+                    raise ModbusExceptionError(f"Modbus exception: {type(exc).__name__}") from exc
+                last_exc = exc
+                DEYE_ERRORS_FRAME.inc()
+            except OSError as exc:
+                # Скинуте/розірване з'єднання - теж невдала спроба з перепідключенням
+                last_exc = exc
+                need_reconnect = True
+                DEYE_ERRORS_SOCKET.inc()
+
+            delay = retry_backoff_sec(attempt)
+            if attempt == MAX_ATTEMPTS - 1 or time.monotonic() + delay >= deadline:
+                break
+            DEYE_READ_RETRIES.inc()
+            logger.warning(
+                f"Спроба {attempts}/{MAX_ATTEMPTS} не вдалася: {last_exc}. "
+                f"Повтор через {delay:.1f} сек"
+            )
+            if need_reconnect:
+                try:
+                    self.reconnect()
+                except Exception as reconnect_exc:
+                    logger.error(f"Помилка перепідключення: {reconnect_exc}")
+            time.sleep(delay)
+
+        # Якщо всі спроби не вдалися
+        self.breaker.record_failure()
+        logger.error(
+            f"Не вдалося зчитати регістри після {attempts} спроб "
+            f"за {time.monotonic() - started:.1f} сек"
+        )
+        if last_exc:
+            raise last_exc
+        raise V5FrameError("Не вдалося зчитати регістри")
+
+    def get_snapshot(self) -> InverterSnapshot:
+        """
+        Зчитує всі налаштовані поля карти мінімальною кількістю запитів.
+
+        Returns:
+            InverterSnapshot
+        """
+        values: Dict[str, float] = {}
+        for block in self.register_map.plan(self.fields):
+            values.update(block.decode(self.read_registers(block.start, block.count)))
+        self.last_snapshot = InverterSnapshot.from_values(values)
+        return self.last_snapshot
+
+    def get_battery_and_grid_state(self) -> Dict[str, float | str]:
+        """
+        Зчитує необхідні дані про батарею та мережу.
+
+        Returns:
+            Словник з ключами:
+            - battery_soc_pct: Рівень заряду батареї (%)
+            - grid_power_w: Потужність з/в мережі (W, позитивне = імпорт)
+            - grid_direction: Напрямок потоку ("import", "export", "idle")
+        """
+        return self.get_snapshot().as_state()
+
+    @staticmethod
+    def grid_direction(grid_power_w: float) -> str:
+        """Визначення напрямку потоку енергії мережі ("import", "export", "idle")."""
+        if grid_power_w > 10:
+            return "import"  # імпорт з мережі
+        if grid_power_w < -10:
+            return "export"  # експорт в мережу
+        return "idle"  # баланс
+
+    def disconnect(self):
+        """Закриває з'єднання з інвертором."""
+        if hasattr(self.client, "disconnect"):
+            self.client.disconnect()
+
+
+class AsyncDeyeInverter(DeyeInverter):
+    """
+    Асинхронний варіант DeyeInverter на основі PySolarmanV5Async.
+
+    Методи читання є корутинами, тому очікування відповіді logger не блокує
+    event loop і дозволяє паралельно опитувати зарядку.
+    """
+
+    def __init__(
+        self,
+        register_map: Optional[RegisterMap] = None,
+        address: str = LOGGER_IP,
+        serial: int = LOGGER_SN,
+        port: int = LOGGER_PORT,
+        mb_slave_id: int = MB_SLAVE_ID,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        Ініціалізація клієнта (з'єднання відкривається в connect()).
+
+        Args:
+            register_map: Карта регістрів (за замовчуванням load_register_map())
+            address: IP адреса Data Logger Stick
+            serial: Серійний номер logger
+            port: TCP порт logger
+            mb_slave_id: Modbus Slave ID інвертора
+            breaker: Circuit breaker (за замовчуванням - з метриками deye_breaker_*)
+        """
+        self.client = None
+        self.breaker = breaker or CircuitBreaker()
+        self.address = address
+        self.serial = serial
+        self.port = port
+        self.mb_slave_id = mb_slave_id
+        self.register_map = register_map or load_register_map()
+        self.fields = inverter_fields(self.register_map)
+        self.last_snapshot: Optional[InverterSnapshot] = None
+        # Один запит до logger за раз (з'єднання може бути спільним для кількох об'єктів)
+        self._io_lock = asyncio.Lock()
+        # Кеш регістрів проксі (None = проксі вимкнено)
+        self.register_cache: Optional["RegisterCache"] = None
+        logger.info(
+            f"Deye інвертор (async): підключення до {self.address}:{self.port} (SN: {self.serial})"
+        )
+
+    def _connect(self):
+        """Створює новий асинхронний клієнт (без відкриття сокета)."""
+        self.client = PySolarmanV5Async(
+            address=self.address,
+            serial=self.serial,
+            port=self.port,
+            mb_slave_id=self.mb_slave_id,
+            socket_timeout=CONNECTION_TIMEOUT_SEC,
+            verbose=False,
+        )
+
+    async def connect(self):
+        """Відкриває з'єднання з інвертором."""
+        self._connect()
+        await self.client.connect()
+
+    async def connect_exclusive(self):
+        """
+        Підключення у фоні під блокуванням запитів: читання, що надійшли
+        під час підключення, чекають на нього замість повторних спроб.
+        """
+        async with self._io_lock:
+            try:
+                await self.client.connect()
+            except Exception as e:
+                logger.warning(f"Deye інвертор: фонове підключення не вдалося: {e!r}")
+
+    async def reconnect(self):
+        """Перепідключається до інвертора (наявний клієнт відкриває новий сокет)."""
+        logger.warning("Спроба перепідключення до Deye інвертора...")
+        DEYE_RECONNECTS.inc()
+        if self.client is None:
+            await self.connect()
+        else:
+            try:
+                await self.disconnect()
+            except Exception:
+                pass  # Ігноруємо помилки при закритті
+            await self.client.connect()
+        logger.info("Перепідключення успішне")
+
+    async def _request_with_retries(self, request: Callable[[], Awaitable], what: str):
+        """
+        Виконує запит до logger з повторними спробами.
+
+        Усі спроби разом обмежені READ_BUDGET_SEC, таймаут кожної - залишком
+        бюджету; між спробами - експоненційна затримка з jitter; при
+        закритому з'єднанні - перепідключення. Поки circuit breaker
+        розімкнено, запит одразу завершується CircuitOpenError.
+
+        Args:
+            request: Фабрика корутини одного запиту (виконується під _io_lock)
+            what: Опис запиту для логів та помилок
+
+        Raises:
+            V5FrameError: Якщо всі спроби не вдалися (CircuitOpenError - breaker
+                розімкнено, ModbusExceptionError - одразу, без повторів)
+        """
+        self.breaker.before_call()
+        started = time.monotonic()
+        deadline = started + READ_BUDGET_SEC
+        last_exc = None
+        attempts = 0
+
+        for attempt in range(MAX_ATTEMPTS):
+            attempts = attempt + 1
+            need_reconnect = False
+            try:
+                async with self._io_lock:
+                    # Таймаут спроби не виходить за межі бюджету
+                    result = await asyncio.wait_for(
+                        request(),
+                        max(0.1, min(CONNECTION_TIMEOUT_SEC, deadline - time.monotonic())),
+                    )
+                self.breaker.record_success()
+                return result
+            except NoSocketAvailableError as exc:
+                # З'єднання закрите - перепідключаємось перед наступною спробою
+                last_exc = exc
+                need_reconnect = True
+                DEYE_ERRORS_NO_SOCKET.inc()
+            except (V5FrameError, TimeoutError, ModbusError) as exc:
+                if ModbusExceptionError.matches(exc):
+                    # Пристрій відповів: зв'язок справний, а повтор дасть ту ж відповідь
+                    self.breaker.record_success()
+                    raise ModbusExceptionError(f"Modbus exception: {type(exc).__name__}") from exc
+                last_exc = exc
+                if isinstance(exc, TimeoutError):
+                    DEYE_ERRORS_TIMEOUT.inc()
+                else:
+                    DEYE_ERRORS_FRAME.inc()
+            except OSError as exc:
+                # ConnectionResetError/BrokenPipeError із write()/drain(): спроба
+                # не вдалася, з'єднання перевідкриваємо (TimeoutError - вище)
+                last_exc = exc
+                need_reconnect = True
+                DEYE_ERRORS_SOCKET.inc()
+
+            delay = retry_backoff_sec(attempt)
+            if attempt == MAX_ATTEMPTS - 1 or time.monotonic() + delay >= deadline:
+                break
+            DEYE_READ_RETRIES.inc()
+            logger.warning(
+                f"Спроба {attempts}/{MAX_ATTEMPTS} не вдалася: {last_exc!r}. "
+                f"Повтор через {delay:.1f} сек"
+            )
+            if need_reconnect:
+                try:
+                    async with self._io_lock:
+                        await asyncio.wait_for(
+                            self.reconnect(), max(0.1, deadline - time.monotonic())
+                        )
+                except Exception as reconnect_exc:
+                    logger.error(f"Помилка перепідключення: {reconnect_exc!r}")
+            await asyncio.sleep(delay)
+
+        # Якщо всі спроби не вдалися
+        self.breaker.record_failure()
+        logger.error(
+            f"Запит до logger ({what}) не вдався після {attempts} спроб "
+            f"за {time.monotonic() - started:.1f} сек"
+        )
+        if isinstance(last_exc, TimeoutError):
+            raise V5FrameError(f"Таймаут запиту до logger: {what}") from last_exc
+        if last_exc:
+            raise last_exc
+        raise V5FrameError(f"Запит до logger не вдався: {what}")
+
+    @timed(DEYE_READ_SECONDS)
+    async def read_registers(self, start: int, quantity: int) -> list[int]:
+        """
+        Зчитує діапазон Modbus-регістрів з повторними спробами (async).
+
+        Див. DeyeInverter.read_registers(): бюджет READ_BUDGET_SEC на всі
+        спроби, експоненційна затримка з jitter, circuit breaker. Успішний
+        результат потрапляє в register_cache (якщо увімкнено проксі).
+
+        Args:
+            start: Початкова адреса регістру
+            quantity: Кількість регістрів для читання
+
+        Returns:
+            Список значень регістрів
+
+        Raises:
+            V5FrameError: Якщо всі спроби не вдалися (CircuitOpenError - breaker розімкнено)
+        """
+
+        async def request() -> list[int]:
+            values = await self.client.read_holding_registers(
+                register_addr=start, quantity=quantity
+            )
+            if len(values) != quantity:
+                raise V5FrameError(
+                    f"Неочікувана довжина відповіді для регістрів {start}-{start+quantity-1}: "
+                    f"{len(values)} != {quantity}"
+                )
+            return values
+
+        cache = self.register_cache
+        generation = cache.generation if cache is not None else 0
+        values = await self._request_with_retries(request, f"регістри {start}-{start+quantity-1}")
+        if cache is not None:
+            cache.store(self.mb_slave_id, 0x03, start, values, generation)
+        return values
+
+    async def send_modbus_frame(self, frame: bytes) -> bytes:
+        """
+        Надсилає сирий Modbus RTU кадр через з'єднання інвертора (для проксі).
+
+        Запит проходить ту ж чергу, бюджет, повтори та circuit breaker, що й
+        read_registers().
+
+        Args:
+            frame: Modbus RTU кадр з CRC
+
+        Returns:
+            Modbus RTU відповідь (як отримано від logger)
+        """
+        return await self._request_with_retries(
+            lambda: self.client.send_raw_modbus_frame(frame),
+            f"Modbus функція 0x{frame[1]:02X}",
+        )
+
+    async def get_snapshot(self) -> InverterSnapshot:
+        """Див. DeyeInverter.get_snapshot() (async)."""
+        values: Dict[str, float] = {}
+        for block in self.register_map.plan(self.fields):
+            values.update(
+                block.decode(await self.read_registers(block.start, block.count))
+            )
+        self.last_snapshot = InverterSnapshot.from_values(values)
+        return self.last_snapshot
+
+    async def get_battery_and_grid_state(self) -> Dict[str, float | str]:
+        """
+        Зчитує необхідні дані про батарею та мережу (async).
+
+        Returns:
+            Словник у форматі DeyeInverter.get_battery_and_grid_state()
+        """
+        return (await self.get_snapshot()).as_state()
+
+    async def disconnect(self):
+        """Закриває з'єднання з інвертором."""
+        if self.client is not None:
+            await self.client.disconnect()
+
+
+# ============================================================
+# Проксі logger (Solarman V5 / Modbus-TCP)
+# ============================================================
+
+# Modbus функції запису (скидають кеш записаного діапазону)
+MODBUS_WRITE_FUNCTIONS = (0x05, 0x06, 0x0F, 0x10)
+# Modbus exception 0x03: некоректне значення в запиті (кількість регістрів)
+MODBUS_ILLEGAL_DATA_VALUE = 0x03
+# Modbus exception 0x0B: шлюз не отримав відповіді від пристрою
+MODBUS_GATEWAY_TARGET_FAILED = 0x0B
+# Максимум регістрів в одному читанні 0x03/0x04 (байт-лічильник - 1 байт)
+MODBUS_MAX_READ_REGISTERS = 125
+# Максимальне поле length заголовка MBAP (unit id + PDU до 253 байт)
+MODBUS_TCP_MAX_LENGTH = 254
+# Мінімальний час відповіді клієнту V5: синхронний PySolarmanV5 чекає на
+# відповідь лише після sendall() і відкидає надто швидку (з кешу) відповідь
+PROXY_V5_MIN_RESPONSE_SEC = 0.005
+
+
+def modbus_crc16(data: bytes) -> bytes:
+    """CRC16 Modbus (poly 0xA001, init 0xFFFF), little-endian."""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack("<H", crc)
+
+
+class RegisterCache:
+    """
+    Кеш прочитаних діапазонів регістрів з коротким TTL.
+
+    Заповнюється і читаннями циклу керування, і запитами клієнтів проксі.
+    Запит, що повністю лежить у свіжому діапазоні того ж unit id,
+    обслуговується без звернення до logger. Запис скидає перетин і збільшує
+    generation, тому читання, розпочате до запису, не кладе в кеш застарілі
+    значення.
+    """
+
+    def __init__(self, ttl_sec: float = PROXY_CACHE_TTL_SEC, clock: Callable[[], float] = time.monotonic):
+        self.ttl_sec = ttl_sec
+        self.clock = clock
+        self.generation = 0
+        # (unit id, функція, початкова адреса) -> (час читання, значення)
+        self._entries: Dict[tuple[int, int, int], tuple[float, array]] = {}
+
+    def store(self, unit: int, function: int, start: int, values, generation: int):
+        """Зберігає діапазон (ігнорується, якщо після початку читання був запис)."""
+        if generation != self.generation or self.ttl_sec <= 0:
+            return
+        now = self.clock()
+        for key in [k for k, (at, _) in self._entries.items() if now - at > self.ttl_sec]:
+            del self._entries[key]
+        self._entries[(unit, function, start)] = (now, array("H", values))
+
+    def lookup(self, unit: int, function: int, start: int, count: int) -> Optional[array]:
+        """Свіжі значення діапазону або None."""
+        now = self.clock()
+        for (entry_unit, entry_function, entry_start), (at, values) in self._entries.items():
+            if (
+                entry_unit == unit
+                and entry_function == function
+                and entry_start <= start
+                and start + count <= entry_start + len(values)
+                and now - at <= self.ttl_sec
+            ):
+                offset = start - entry_start
+                return values[offset : offset + count]
+        return None
+
+    def invalidate(self, unit: int, start: int, count: int):
+        """Скидає діапазони unit, що перетинаються з [start, start + count)."""
+        self.generation += 1
+        for key in [
+            (entry_unit, function, entry_start)
+            for (entry_unit, function, entry_start), (_, values) in self._entries.items()
+            if entry_unit == unit and entry_start < start + count and start < entry_start + len(values)
+        ]:
+            del self._entries[key]
+
+
+class SolarmanProxy:
+    """
+    Мультиплексор logger: багато клієнтів - одне з'єднання з logger.
+
+    Приймає клієнтів Solarman V5 (як сам logger, порт 8899) та Modbus-TCP.
+    Усі запити виконуються через AsyncDeyeInverter циклу керування (та сама
+    черга, повтори та circuit breaker), тому logger бачить лише одного
+    клієнта. Читання 0x03/0x04 обслуговуються з RegisterCache, однакові
+    одночасні читання об'єднуються в один запит. Записи виконуються строго
+    по черзі в порядку надходження та скидають кеш записаних регістрів.
+    """
+
+    def __init__(self, inverter: AsyncDeyeInverter, cache: Optional[RegisterCache] = None):
+        """
+        Args:
+            inverter: Інвертор, через з'єднання якого йдуть усі запити
+            cache: Кеш регістрів (за замовчуванням - з TTL PROXY_CACHE_TTL_SEC)
+        """
+        self.inverter = inverter
+        self.cache = cache or RegisterCache()
+        inverter.register_cache = self.cache
+        self.clients = 0
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._write_lock = asyncio.Lock()
+        self._servers: list[asyncio.AbstractServer] = []
+
+    async def start(self, host: str = PROXY_HOST, v5_port: int = 0, modbus_port: int = 0):
+        """Відкриває порти проксі (0 = протокол вимкнено)."""
+        if v5_port:
+            self._servers.append(await asyncio.start_server(self._serve_v5, host, v5_port))
+            logger.info(f"Проксі Solarman V5: {host}:{v5_port} -> {self.inverter.address}:{self.inverter.port}")
+        if modbus_port:
+            self._servers.append(await asyncio.start_server(self._serve_modbus_tcp, host, modbus_port))
+            logger.info(f"Проксі Modbus-TCP: {host}:{modbus_port} -> {self.inverter.address}:{self.inverter.port}")
+
+    def close(self):
+        """Закриває порти проксі."""
+        for server in self._servers:
+            server.close()
+        self._servers.clear()
+        self.inverter.register_cache = None
+
+    @staticmethod
+    def _exception_pdu(function: int, code: int = MODBUS_GATEWAY_TARGET_FAILED) -> bytes:
+        return bytes([function | 0x80, code])
+
+    async def handle_pdu(self, slave: int, pdu: bytes) -> bytes:
+        """
+        Обробляє Modbus PDU клієнта (функція + дані, без адреси та CRC).
+
+        Returns:
+            PDU відповіді (при помилці logger - exception 0x0B, при
+            некоректній кількості регістрів - exception 0x03)
+        """
+        function = pdu[0]
+        if function in (0x03, 0x04) and len(pdu) == 5:
+            start, count = struct.unpack(">HH", pdu[1:5])
+            if not 1 <= count <= MODBUS_MAX_READ_REGISTERS:
+                return self._exception_pdu(function, MODBUS_ILLEGAL_DATA_VALUE)
+            values = self.cache.lookup(slave, function, start, count)
+            if values is not None:
+                PROXY_CACHE_HITS.inc()
+                return bytes([function, 2 * count]) + struct.pack(f">{count}H", *values)
+
+            # Однакові одночасні читання чекають на один запит до logger
+            key = (slave, function, start, count, self.cache.generation)
+            pending = self._inflight.get(key)
+            if pending is not None:
+                PROXY_COALESCED.inc()
+                return await asyncio.shield(pending)
+            pending = asyncio.get_running_loop().create_future()
+            self._inflight[key] = pending
+            response = self._exception_pdu(function)
+            try:
+                response = await self._upstream(slave, pdu)
+                if response[0] == function:
+                    if response[1] != 2 * count or len(response) != 2 + 2 * count:
+                        # Відповідь не на ту кількість регістрів - не кешуємо і не віддаємо
+                        PROXY_ERRORS.inc()
+                        logger.warning(
+                            f"Проксі: logger повернув {response[1]} байт замість {2 * count} "
+                            f"на читання 0x{function:02X} {start}+{count}"
+                        )
+                        response = self._exception_pdu(function)
+                    else:
+                        values = struct.unpack(f">{count}H", response[2:])
+                        self.cache.store(slave, function, start, values, key[-1])
+            finally:
+                del self._inflight[key]
+                pending.set_result(response)
+            return response
+
+        if function in MODBUS_WRITE_FUNCTIONS and len(pdu) >= 5:
+            start = struct.unpack(">H", pdu[1:3])[0]
+            count = 1 if function in (0x05, 0x06) else struct.unpack(">H", pdu[3:5])[0]
+            # Записи - строго по одному, в порядку надходження
+            async with self._write_lock:
+                self.cache.invalidate(slave, start, count)
+                try:
+                    return await self._upstream(slave, pdu)
+                finally:
+                    self.cache.invalidate(slave, start, count)
+
+        return await self._upstream(slave, pdu)
+
+    async def _upstream(self, slave: int, pdu: bytes) -> bytes:
+        """Надсилає PDU до logger та повертає PDU відповіді."""
+        PROXY_UPSTREAM.inc()
+        frame = bytes([slave]) + pdu
+        started = time.perf_counter()
+        try:
+            response = await self.inverter.send_modbus_frame(frame + modbus_crc16(frame))
+        except Exception as e:
+            PROXY_ERRORS.inc()
+            logger.warning(f"Проксі: запит 0x{pdu[0]:02X} до logger не вдався: {e}")
+            return self._exception_pdu(pdu[0])
+        finally:
+            PROXY_UPSTREAM_SECONDS.observe_since(started)
+
+        # Довжина PDU відповіді за функцією (деякі logger дописують зайві байти)
+        if len(response) >= 3 and response[1] & 0x80:
+            size = 2
+        elif len(response) >= 3 and response[1] in (0x01, 0x02, 0x03, 0x04):
+            size = 2 + response[2]
+        else:
+            size = 5
+        body = bytes(response[: 1 + size])
+        if (
+            len(response) < size + 3
+            or response[0] != slave
+            or (response[1] & 0x7F) != pdu[0]
+            or modbus_crc16(body) != bytes(response[1 + size : 3 + size])
+        ):
+            PROXY_ERRORS.inc()
+            logger.warning(f"Проксі: некоректна відповідь logger на 0x{pdu[0]:02X}: {bytes(response).hex()}")
+            return self._exception_pdu(pdu[0])
+        return body[1:]
+
+    def _client_connected(self, delta: int):
+        self.clients += delta
+        PROXY_CLIENTS.set(self.clients)
+
+    async def _serve_v5(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Клієнт Solarman V5: кадри A5 ... 15 з Modbus RTU всередині."""
+        self._client_connected(1)
+        try:
+            while True:
+                head = await reader.readexactly(3)
+                if head[0] != 0xA5:
+                    return
+                length = struct.unpack("<H", head[1:3])[0]
+                frame = head + await reader.readexactly(length + 10)
+                control = struct.unpack("<H", frame[3:5])[0]
+                # payload: тип кадру(1) + тип сенсора(2) + 3 x 4 байти часу, далі Modbus RTU
+                rtu = frame[26:-2]
+                if control != 0x4510 or len(rtu) < 4 or modbus_crc16(rtu[:-2]) != rtu[-2:]:
+                    continue
+                started = time.monotonic()
+                pdu = await self.handle_pdu(rtu[0], rtu[1:-2])
+                remaining = PROXY_V5_MIN_RESPONSE_SEC - (time.monotonic() - started)
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                body = bytes([rtu[0]]) + pdu
+                payload = (
+                    bytes([0x02, 0x01])
+                    + struct.pack("<III", int(time.time()) & 0xFFFFFFFF, 0, 0)
+                    + body
+                    + modbus_crc16(body)
+                )
+                # Відповідь з тим самим номером послідовності та серійним номером
+                response = (
+                    bytes([0xA5])
+                    + struct.pack("<HH", len(payload), 0x1510)
+                    + frame[5:11]
+                    + payload
+                )
+                writer.write(response + bytes([sum(response[1:]) & 0xFF, 0x15]))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._client_connected(-1)
+            writer.close()
+
+    async def _serve_modbus_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Клієнт Modbus-TCP: заголовок MBAP + PDU."""
+        self._client_connected(1)
+        try:
+            while True:
+                transaction, protocol, length, unit = struct.unpack(">HHHB", await reader.readexactly(7))
+                # length включає unit id: без хоча б коду функції кадр некоректний,
+                # а межі наступного кадру вже невідомі - закриваємо з'єднання
+                if protocol != 0 or not 2 <= length <= MODBUS_TCP_MAX_LENGTH:
+                    return
+                pdu = await reader.readexactly(length - 1)
+                response = await self.handle_pdu(unit, pdu)
+                writer.write(struct.pack(">HHHB", transaction, 0, len(response) + 1, unit) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._client_connected(-1)
+            writer.close()
+
+
+# ============================================================
+# Клас для керування зарядкою Feyree EV
+# ============================================================
+
+
+class FeyreeCharger:
+    """Клас для керування зарядкою Feyree EV через Tuya протокол."""
+
+    def __init__(
+        self,
+        device_id: str = FEYREE_DEVICE_ID,
+        address: str = FEYREE_IP,
+        local_key: str = FEYREE_LOCAL_KEY,
+        version: str = FEYREE_VERSION,
+        port: int = FEYREE_PORT,
+    ):
+        """
+        Ініціалізація зарядки Feyree.
+
+        Args:
+            device_id: Device ID з Tuya IoT Platform
+            address: IP адреса зарядки
+            local_key: Local Key з Tuya IoT Platform
+            version: Версія протоколу Tuya
+            port: TCP порт Tuya local protocol
+
+        Raises:
+            ValueError: Якщо не вказані DEVICE_ID або LOCAL_KEY
+        """
+        if not device_id or device_id == "your_device_id_here":
+            raise ValueError(
+                "FEYREE_DEVICE_ID не налаштовано! "
+                "Встановіть Device ID в .env файлі. "
+                "Використайте 'python -m tinytuya wizard' для отримання ключів."
+            )
+
+        if not local_key or local_key == "your_local_key_here":
+            raise ValueError(
+                "FEYREE_LOCAL_KEY не налаштовано! "
+                "Встановіть Local Key в .env файлі. "
+                "Використайте 'python -m tinytuya wizard' для отримання ключів."
+            )
+
+        # Ініціалізація Tuya пристрою
+        self.device_id = device_id
+        self.address = address
+        self.device = tinytuya.OutletDevice(
+            dev_id=device_id,
+            address=address,
+            local_key=local_key,
+            version=version,
+            port=port,
+        )
+        # Налаштований таймаут сокета (змінюється set_timeout() без перепідключення)
+        self.timeout_sec = CONNECTION_TIMEOUT_SEC
+        self.device.set_socketTimeout(self.timeout_sec)
+        # Постійний сокет: команди та статус не відкривають нове з'єднання
+        self.device.set_socketPersistent(True)
+
+        self.current_state = None  # Кешуємо стан для уникнення зайвих перемикань
+        self.last_command_latency_sec: Optional[float] = None
+        self.current_setpoint_a: Optional[int] = None  # Останній надісланий струм
+        self.listener: Optional["FeyreeStatusListener"] = None
+        # Останні відомі DPS без слухача (з get_status() та підтверджень команд)
+        self.known_dps: Dict[str, object] = {}
+        # Серіалізує операції з сокетом між потоком команд та слухачем
+        self.send_lock = threading.Lock()
+
+        logger.info(
+            f"Feyree зарядка: підключення до {self.address} (ID: {self.device_id})"
+        )
+
+    def get_status(self) -> Optional[Dict]:
+        """
+        Отримує поточний стан зарядки.
+
+        Returns:
+            Словник зі станом пристрою або None у випадку помилки
+        """
+        started = time.perf_counter()
+        try:
+            with self.send_lock:
+                status = self.device.status()
+            if status and "Err" in status:
+                FEYREE_STATUS_ERRORS.inc()
+            elif status and "dps" in status:
+                self.known_dps.update(status["dps"])
+            return status
+        except Exception as e:
+            FEYREE_STATUS_ERRORS.inc()
+            logger.error(f"Помилка отримання статусу Feyree: {e}")
+            return None
+        finally:
+            FEYREE_STATUS_SECONDS.observe_since(started)
+
+    def start_listener(
+        self,
+        heartbeat_sec: float = FEYREE_HEARTBEAT_SEC,
+        on_change: Optional[Callable[[str, object, object], None]] = None,
+    ) -> "FeyreeStatusListener":
+        """
+        Запускає фоновий слухач push-повідомлень пристрою.
+
+        Після запуску сокет читає лише слухач: get_status() більше не
+        викликається в циклі, а команди чекають підтвердження через кеш DPS.
+
+        Args:
+            heartbeat_sec: Інтервал heartbeat (0 = вимкнено)
+            on_change: Викликається при зміні DPS 101 або 3 (код, старе, нове)
+
+        Returns:
+            Запущений слухач
+        """
+        self.listener = FeyreeStatusListener(
+            self, heartbeat_sec=heartbeat_sec, on_change=on_change
+        )
+        self.listener.start()
+        return self.listener
+
+    def stop_listener(self):
+        """Зупиняє фоновий слухач (якщо запущений)."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def set_timeout(self, timeout_sec: float):
+        """Змінює таймаут сокета Tuya (з'єднання не розривається)."""
+        with self.send_lock:
+            self.timeout_sec = timeout_sec
+            self.device.set_socketTimeout(timeout_sec)
+
+    def set_address(self, address: str, version: str):
+        """
+        Переводить зарядку на нову адресу та версію протоколу.
+
+        Поточний сокет закривається: наступний запит (або слухач після
+        помилки читання) підключається вже за новою адресою.
+        """
+        with self.send_lock:
+            self.address = address
+            self.device.address = address
+            if float(version) != self.device.version:
+                self.device.set_version(version)
+            self.device.close()
+
+    def send_command(
+        self, dps: Dict[int, object], timeout: Optional[float] = None
+    ) -> Optional[float]:
+        """
+        Надсилає кілька DPS одним CONTROL-повідомленням і чекає підтвердження.
+
+        Підтвердженням вважається повідомлення від пристрою, отримане після
+        надсилання і яке містить хоча б один з переданих DPS, за умови що
+        після нього кожен з переданих DPS має надіслане значення (DPS, що
+        вже мали це значення, пристрій може не повторювати). Значення в кеші
+        до надсилання самі по собі не є підтвердженням: кадр міг не дійти.
+
+        Args:
+            dps: Словник {DPS код: значення}
+            timeout: Максимальний час очікування підтвердження (секунди,
+                None = COMMAND_ACK_TIMEOUT_SEC)
+
+        Returns:
+            Час від надсилання до підтвердження (секунди) або None, якщо
+            пристрій не підтвердив усі DPS вчасно
+        """
+        if timeout is None:
+            timeout = COMMAND_ACK_TIMEOUT_SEC
+        pending = {str(key): value for key, value in dps.items()}
+        started = time.monotonic()
+        deadline = started + timeout
+        listener = self.listener if self.listener is not None and self.listener.is_alive() else None
+
+        if listener is not None:
+            # Підтвердження приходить як push і потрапляє в кеш слухача
+            since = listener.sequence()
+            with self.send_lock:
+                result = self.device.set_multiple_values(pending, nowait=True)
+            if result and "Err" in result:
+                logger.warning(f"Помилка надсилання команди Feyree: {result}")
+                return None
+            if not listener.wait_for(pending, timeout, since):
+                logger.warning(
+                    f"Не отримано підтвердження DPS {', '.join(sorted(pending))} за {timeout} сек"
+                )
+                return None
+            self.last_command_latency_sec = time.monotonic() - started
+            return self.last_command_latency_sec
+
+        state = dict(self.known_dps)
+        reported = False
+        with self.send_lock:
+            result = self.device.set_multiple_values(pending, nowait=True)
+            if result and "Err" in result:
+                logger.warning(f"Помилка надсилання команди Feyree: {result}")
+                return None
+            try:
+                while not (reported and all(state.get(k) == v for k, v in pending.items())):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.device.set_socketTimeout(remaining)
+                    msg = self.device.receive()
+                    if not msg:
+                        continue
+                    if "Err" in msg:
+                        logger.warning(f"Помилка очікування підтвердження Feyree: {msg}")
+                        break
+                    reported_dps = msg.get("dps") or {}
+                    state.update(reported_dps)
+                    reported = reported or any(key in pending for key in reported_dps)
+            finally:
+                self.device.set_socketTimeout(self.timeout_sec)
+        self.known_dps = state
+
+        unconfirmed = [k for k, v in pending.items() if not reported or state.get(k) != v]
+        if unconfirmed:
+            logger.warning(
+                f"Не отримано підтвердження DPS {', '.join(sorted(unconfirmed))} за {timeout} сек"
+            )
+            return None
+
+        self.last_command_latency_sec = time.monotonic() - started
+        return self.last_command_latency_sec
+
+    @timed(FEYREE_TURN_ON_SECONDS, FEYREE_TURN_ON_FAILURES)
+    def turn_on(self, current_a: int = CHARGING_CURRENT_A) -> bool:
+        """
+        Увімкнює зарядку з заданим струмом.
+
+        Усі DPS надсилаються одним повідомленням:
+        перемикач (DPS 18), режим charge_now (DPS 14),
+        старт зарядки (DPS 123 = True), DPS 10 та, якщо налаштовано
+        FEYREE_CURRENT_DPS, струм зарядки.
+
+        Args:
+            current_a: Сила струму зарядки (Ампери)
+
+        Returns:
+            True якщо пристрій підтвердив команду, False інакше
+        """
+        try:
+            logger.info(f"Спроба увімкнути зарядку Feyree на {current_a}A")
+
+            dps: Dict[int, object] = {
+                FEYREE_SWITCH_DPS: True,
+                FEYREE_MODE_DPS: FEYREE_CHARGE_NOW_MODE,
+                123: True,  # Ключова команда для старту
+                10: 1,  # Додатковий параметр
+            }
+            if FEYREE_CURRENT_DPS:
+                dps[FEYREE_CURRENT_DPS] = current_a
+
+            latency = self.send_command(dps)
+            if latency is None:
+                logger.warning("Зарядка Feyree не підтвердила увімкнення")
+                return False
+            if FEYREE_CURRENT_DPS:
+                self.current_setpoint_a = current_a
+
+            logger.info(
+                f"Зарядка Feyree УВІМКНЕНА ({current_a}A), підтверджено за {latency:.2f} сек"
+            )
+            self.current_state = True
+            return True
+
+        except Exception as e:
+            logger.error(f"Помилка увімкнення зарядки Feyree: {e}")
+            return False
+
+    @timed(FEYREE_SET_CURRENT_SECONDS, FEYREE_SET_CURRENT_FAILURES)
+    def set_current(self, current_a: int) -> bool:
+        """
+        Змінює струм зарядки без перемикання (DPS FEYREE_CURRENT_DPS).
+
+        Args:
+            current_a: Новий струм зарядки (Ампери)
+
+        Returns:
+            True якщо пристрій підтвердив команду, False інакше
+        """
+        if not FEYREE_CURRENT_DPS:
+            logger.warning("FEYREE_CURRENT_DPS не налаштовано - струм не змінено")
+            return False
+        try:
+            latency = self.send_command({FEYREE_CURRENT_DPS: current_a})
+            if latency is None:
+                logger.warning(f"Зарядка Feyree не підтвердила струм {current_a}A")
+                return False
+            logger.info(
+                f"Струм зарядки Feyree: {self.current_setpoint_a}A → {current_a}A "
+                f"(підтверджено за {latency:.2f} сек)"
+            )
+            self.current_setpoint_a = current_a
+            return True
+        except Exception as e:
+            logger.error(f"Помилка зміни струму зарядки Feyree: {e}")
+            return False
+
+    @timed(FEYREE_TURN_OFF_SECONDS, FEYREE_TURN_OFF_FAILURES)
+    def turn_off(self) -> bool:
+        """
+        Вимикає зарядку.
+
+        Зупинка зарядки (DPS 123 = False) та вимкнення перемикача (DPS 18)
+        надсилаються одним повідомленням.
+
+        Returns:
+            True якщо пристрій підтвердив команду, False інакше
+        """
+        try:
+            logger.info("Спроба вимкнути зарядку Feyree")
+
+            latency = self.send_command({123: False, FEYREE_SWITCH_DPS: False})
+            if latency is None:
+                logger.warning(f"Не вдалося вимкнути зарядку (DPS {FEYREE_SWITCH_DPS})")
+                return False
+
+            logger.info(f"Зарядка Feyree ВИМКНЕНА, підтверджено за {latency:.2f} сек")
+            self.current_state = False
+            return True
+
+        except Exception as e:
+            logger.error(f"Помилка вимкнення зарядки Feyree: {e}")
+            return False
+
+    def display_device_status(self, status: Optional[Dict], prefix: str = ""):
+        """
+        Відображає детальну інформацію про стан пристрою.
+
+        Args:
+            status: Словник зі станом пристрою
+            prefix: Префікс для логування (напр. "ДО" або "ПІСЛЯ")
+        """
+        if not status or "dps" not in status:
+            logger.warning(f"{prefix} Статус недоступний")
+            return
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
+        dps = status.get("dps", {})
+
+        logger.info(f"{prefix} Стан пристрою Feyree:")
+
+        # Основні DPS коди
+        switch_state = dps.get(str(FEYREE_SWITCH_DPS), None)
+        work_mode = dps.get(str(FEYREE_MODE_DPS), None)
+        work_state = dps.get("3", None)  # Код стану пристрою (стан зарядки - DPS 101)
+
+        # Додаткові важливі коди зі snapshot.json
+        charge_status = dps.get("101", None)  # finish/charging/тощо
+        energy_kwh = dps.get("102", None)  # енергія в Втг
+        current_a = dps.get("114", None)  # струм
+        max_current = dps.get("115", None)  # макс струм
+        charging_time = dps.get("120", None)  # час зарядки
+        charge_mode_status = dps.get("124", None)  # статус режиму зарядки
+
+        # Виводимо основну інформацію
+        if work_state is not None:
+            logger.info(f"  └─ DPS 3 (work_state): {work_state}")
+
+        if switch_state is not None:
+            logger.info(
+                f"  └─ DPS {FEYREE_SWITCH_DPS} (switch): {'ВВІМК' if switch_state else 'ВИМК'}"
+            )
+
+        if work_mode is not None:
+            logger.info(f"  └─ DPS {FEYREE_MODE_DPS} (work_mode): {work_mode}")
+
+        if charge_status is not None:
+            logger.info(f"  └─ DPS 101 (charge_status): {charge_status}")
+
+        if charge_mode_status is not None:
+            logger.info(f"  └─ DPS 124 (mode_status): {charge_mode_status}")
+
+        if current_a is not None:
+            logger.info(f"  └─ DPS 114 (current): {current_a}A")
+
+        if max_current is not None:
+            logger.info(f"  └─ DPS 115 (max_current): {max_current}A")
+
+        if energy_kwh is not None:
+            # Згідно з devices.json, scale=3, тому ділимо на 1000
+            # DPS 102 повертає integer, конвертуємо в float
+            energy_display: float = float(energy_kwh) / 1000.0
+            logger.info(f"  └─ DPS 102 (energy): {energy_display:.3f} kWh")
+
+        if charging_time is not None:
+            logger.info(f"  └─ DPS 120 (time): {charging_time}")
+
+
+class FeyreeStatusListener(threading.Thread):
+    """
+    Фоновий потік, що тримає живий кеш DPS з push-повідомлень Feyree.
+
+    Tuya пристрої надсилають зміни DPS через постійне з'єднання, тому
+    циклу керування достатньо читати кеш замість запиту status().
+    Доступ до кешу захищений блокуванням (Condition). Готовність сокета
+    слухач чекає без блокування зарядки, а читає кадр лише під send_lock,
+    тому не перехоплює кадри команд та статусу з інших потоків.
+    """
+
+    # DPS, зміна яких означає зміну реального стану зарядки (DPS 3 - код
+    # work_state пристрою, не ознака зарядки: рішення приймаються за DPS 101)
+    WATCHED_DPS = ("101",)
+    # Таймаут читання готового кадру під send_lock: tinytuya після порожнього
+    # підтвердження CONTROL чекає наступний кадр, і команди не повинні чекати разом з ним
+    READ_TIMEOUT_SEC = 0.1
+
+    def __init__(
+        self,
+        charger: FeyreeCharger,
+        heartbeat_sec: float = FEYREE_HEARTBEAT_SEC,
+        on_change: Optional[Callable[[str, object, object], None]] = None,
+    ):
+        """
+        Args:
+            charger: Зарядка, сокет якої читатиме слухач
+            heartbeat_sec: Інтервал heartbeat (0 = вимкнено)
+            on_change: Викликається при зміні WATCHED_DPS (код, старе, нове)
+        """
+        super().__init__(name="feyree-listener", daemon=True)
+        self.charger = charger
+        self.heartbeat_sec = heartbeat_sec
+        self.on_change = on_change
+        self._dps: Dict[str, object] = {}
+        # Номер останнього повідомлення та номер повідомлення, що містило кожен DPS
+        self._seq = 0
+        self._dps_seq: Dict[str, int] = {}
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._needs_refresh = True
+        self.updated_at: Optional[float] = None  # time.monotonic() останнього DPS
+
+    def run(self):
+        """Цикл читання повідомлень пристрою."""
+        device = self.charger.device
+        last_heartbeat = time.monotonic()
+
+        while not self._stop_event.is_set():
+            try:
+                sock = device.socket
+                if self._needs_refresh or sock is None:
+                    # Повний статус після (пере)підключення
+                    with self.charger.send_lock:
+                        msg = device.status()
+                    self._needs_refresh = bool(not msg or "Err" in msg)
+                else:
+                    if self.heartbeat_sec > 0:
+                        wait = max(0.0, last_heartbeat + self.heartbeat_sec - time.monotonic())
+                    else:
+                        wait = self.charger.timeout_sec
+                    # Очікування без send_lock: команди тим часом користуються сокетом
+                    try:
+                        readable, _, _ = select.select([sock], [], [], wait)
+                    except (OSError, ValueError):
+                        # Сокет закрито іншим потоком (нова адреса, зупинка)
+                        self._needs_refresh = True
+                        continue
+                    msg = None
+                    if readable:
+                        with self.charger.send_lock:
+                            if device.socket is sock:
+                                device.set_socketTimeout(self.READ_TIMEOUT_SEC)
+                                try:
+                                    msg = device.receive()
+                                finally:
+                                    device.set_socketTimeout(self.charger.timeout_sec)
+
+                if self.heartbeat_sec > 0 and (
+                    time.monotonic() - last_heartbeat >= self.heartbeat_sec
+                ):
+                    with self.charger.send_lock:
+                        device.heartbeat(nowait=True)
+                    last_heartbeat = time.monotonic()
+
+                if not msg:
+                    continue
+                if "Err" in msg:
+                    logger.warning(f"Слухач Feyree: помилка з'єднання: {msg}")
+                    with self.charger.send_lock:
+                        device.close()
+                    self._needs_refresh = True
+                    self._stop_event.wait(RETRY_DELAY_SEC)
+                    continue
+                self._apply(msg.get("dps") or {})
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                logger.error(f"Слухач Feyree: неочікувана помилка: {e}")
+                with self.charger.send_lock:
+                    device.close()
+                self._needs_refresh = True
+                self._stop_event.wait(RETRY_DELAY_SEC)
+
+    def _apply(self, dps: Dict[str, object]):
+        """Оновлює кеш та сповіщає про зміни стану зарядки."""
+        if not dps:
+            return
+        changes = []
+        with self._cond:
+            self._seq += 1
+            for code, value in dps.items():
+                old = self._dps.get(code)
+                if code in self.WATCHED_DPS and code in self._dps and old != value:
+                    changes.append((code, old, value))
+                self._dps[code] = value
+                self._dps_seq[code] = self._seq
+            self.updated_at = time.monotonic()
+            self._cond.notify_all()
+
+        for code, old, value in changes:
+            logger.info(f"Слухач Feyree: DPS {code} змінився: {old} → {value}")
+            if self.on_change is not None:
+                self.on_change(code, old, value)
+
+    def snapshot(self) -> Dict[str, object]:
+        """Копія поточного кешу DPS."""
+        with self._cond:
+            return dict(self._dps)
+
+    def get_status(self) -> Optional[Dict]:
+        """Статус у форматі tinytuya status() з кешу або None, якщо кеш порожній."""
+        dps = self.snapshot()
+        return {"dps": dps} if dps else None
+
+    def age_sec(self) -> Optional[float]:
+        """Час від останнього отриманого DPS (секунди) або None."""
+        if self.updated_at is None:
+            return None
+        return time.monotonic() - self.updated_at
+
+    def sequence(self) -> int:
+        """Номер останнього отриманого повідомлення (для wait_for())."""
+        with self._cond:
+            return self._seq
+
+    def wait_for(self, expected: Dict[str, object], timeout: float, since: int = 0) -> bool:
+        """
+        Чекає, доки пристрій після повідомлення since повідомить хоча б про
+        один з DPS, а всі DPS у кеші набудуть очікуваних значень.
+
+        Args:
+            expected: Словник {DPS код (str): значення}
+            timeout: Максимальний час очікування (секунди)
+            since: sequence() до надсилання команди
+
+        Returns:
+            True якщо всі значення підтверджено вчасно
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: any(self._dps_seq.get(k, 0) > since for k in expected)
+                and all(self._dps.get(k) == v for k, v in expected.items()),
+                timeout,
+            )
+
+    def stop(self):
+        """Зупиняє потік та закриває сокет."""
+        self._stop_event.set()
+        with self.charger.send_lock:
+            self.charger.device.close()
+        self.join(timeout=self.charger.timeout_sec)
+
+
+class AsyncFeyreeCharger:
+    """
+    Неблокуюча обгортка над FeyreeCharger для asyncio циклу.
+
+    tinytuya є синхронною бібліотекою, тому всі виклики виконуються в
+    пулі потоків. Без спільного пулу зарядка отримує власний потік; зі
+    спільним пулом (кілька зарядок) послідовний доступ до сокета Tuya
+    гарантує asyncio.Lock зарядки. Event loop тим часом обслуговує інвертор.
+    """
+
+    def __init__(
+        self,
+        charger: Optional[FeyreeCharger] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        """
+        Args:
+            charger: Синхронний екземпляр зарядки (створюється, якщо не передано)
+            executor: Спільний пул потоків (None = власний потік зарядки)
+        """
+        self.charger = charger if charger is not None else FeyreeCharger()
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="feyree-io"
+        )
+        self._io_lock = asyncio.Lock()
+
+    @property
+    def current_state(self) -> Optional[bool]:
+        """Останній відомий стан перемикача зарядки."""
+        return self.charger.current_state
+
+    @current_state.setter
+    def current_state(self, value: Optional[bool]):
+        self.charger.current_state = value
+
+    @property
+    def last_command_latency_sec(self) -> Optional[float]:
+        """Час від останньої команди до її підтвердження (секунди)."""
+        return self.charger.last_command_latency_sec
+
+    async def _run(self, func, *args):
+        """Виконує блокуючий виклик tinytuya в потоці зарядки."""
+        loop = asyncio.get_running_loop()
+        async with self._io_lock:
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get_status(self) -> Optional[Dict]:
+        """
+        Неблокуючий аналог FeyreeCharger.get_status().
+
+        Якщо запущений слухач push-повідомлень, статус береться з його кешу
+        без мережевого запиту.
+        """
+        if self.charger.listener is not None:
+            return self.charger.listener.get_status()
+        return await self._run(self.charger.get_status)
+
+    def start_listener(
+        self, on_change: Optional[Callable[[str, object, object], None]] = None
+    ) -> FeyreeStatusListener:
+        """Див. FeyreeCharger.start_listener()."""
+        return self.charger.start_listener(on_change=on_change)
+
+    async def turn_on(self, current_a: int = CHARGING_CURRENT_A) -> bool:
+        """Неблокуючий аналог FeyreeCharger.turn_on()."""
+        return await self._run(self.charger.turn_on, current_a)
+
+    async def set_current(self, current_a: int) -> bool:
+        """Неблокуючий аналог FeyreeCharger.set_current()."""
+        return await self._run(self.charger.set_current, current_a)
+
+    @property
+    def current_setpoint_a(self) -> Optional[int]:
+        """Останній підтверджений струм зарядки (Ампери)."""
+        return self.charger.current_setpoint_a
+
+    @current_setpoint_a.setter
+    def current_setpoint_a(self, value: Optional[int]):
+        self.charger.current_setpoint_a = value
+
+    async def turn_off(self) -> bool:
+        """Неблокуючий аналог FeyreeCharger.turn_off()."""
+        return await self._run(self.charger.turn_off)
+
+    def display_device_status(self, status: Optional[Dict], prefix: str = ""):
+        """Див. FeyreeCharger.display_device_status()."""
+        self.charger.display_device_status(status, prefix=prefix)
+
+    async def set_timeout(self, timeout_sec: float):
+        """Неблокуючий аналог FeyreeCharger.set_timeout()."""
+        await self._run(self.charger.set_timeout, timeout_sec)
+
+    async def set_address(self, address: str, version: str):
+        """Неблокуючий аналог FeyreeCharger.set_address()."""
+        await self._run(self.charger.set_address, address, version)
+
+    def close(self):
+        """Закриває сокет Tuya та зупиняє потоки зарядки."""
+        self.charger.stop_listener()
+        closing = self._executor.submit(self.charger.device.close)
+        if self._owns_executor:
+            self._executor.shutdown(wait=True)
+        else:
+            closing.result()
+
+
+# ============================================================
+# Пошук зарядок у мережі (Tuya UDP broadcast)
+# ============================================================
+
+
+class TuyaAddressCache:
+    """
+    Останні знайдені адреси зарядок у JSON файлі.
+
+    Запис прив'язаний до адреси з конфігурації, при якій його знайдено:
+    якщо адресу в .env змінили вручну, кеш ігнорується.
+    """
+
+    def __init__(self, path: str = FEYREE_ADDRESS_CACHE_FILE):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Кеш адрес зарядок {path} не прочитано: {e}")
+
+    def lookup(self, device_id: str, configured: str) -> Optional[Dict]:
+        """Збережена адреса (ip, version) або None."""
+        entry = self.entries.get(device_id)
+        if entry is None or entry.get("configured") != configured:
+            return None
+        return entry
+
+    def remember(self, device_id: str, configured: str, ip: str, version: str):
+        """Зберігає знайдену адресу (атомарна заміна файлу)."""
+        self.entries[device_id] = {
+            "configured": configured,
+            "ip": ip,
+            "version": version,
+            "seen_at": time.time(),
+        }
+        if not self.path:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Кеш адрес зарядок {self.path} не записано: {e}")
+
+
+class TuyaDiscovery(asyncio.DatagramProtocol):
+    """
+    Слухач UDP broadcast пристроїв Tuya (6666 - v3.1, 6667 - v3.3+).
+
+    Пристрої кожні кілька секунд оголошують свій Device ID, IP та версію
+    протоколу. Якщо відома зарядка з'явилася за іншою адресою (DHCP видав
+    нову), вона переводиться на нову адресу без перезапуску сервісу.
+    """
+
+    PORTS = (tinytuya.UDPPORT, tinytuya.UDPPORTS)
+
+    def __init__(self, cache: TuyaAddressCache):
+        self.cache = cache
+        # device_id -> (зарядка, адреса з конфігурації)
+        self.chargers: Dict[str, tuple[AsyncFeyreeCharger, str]] = {}
+        self._transports: list[asyncio.DatagramTransport] = []
+        self._updating: set[str] = set()
+
+    def watch(self, charger: AsyncFeyreeCharger, configured: str):
+        """Додає зарядку до відстежуваних."""
+        self.chargers[charger.charger.device_id] = (charger, configured)
+
+    async def start(self, host: str = "0.0.0.0"):
+        """Відкриває UDP порти (недоступний порт лише логується)."""
+        loop = asyncio.get_running_loop()
+        for port in self.PORTS:
+            try:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: self, local_addr=(host, port), reuse_port=True, allow_broadcast=True
+                )
+            except OSError as e:
+                logger.warning(f"Пошук зарядок: UDP порт {port} недоступний: {e}")
+                continue
+            self._transports.append(transport)
+        if self._transports:
+            logger.info(
+                f"Пошук зарядок за UDP broadcast: порти "
+                f"{', '.join(str(t.get_extra_info('sockname')[1]) for t in self._transports)}"
+            )
+
+    def datagram_received(self, data: bytes, addr):
+        """Розбирає оголошення пристрою та запускає зміну адреси."""
+        try:
+            announcement = json.loads(tinytuya.decrypt_udp(data))
+        except Exception:
+            return  # Чужий або пошкоджений пакет
+        if not isinstance(announcement, dict):
+            return
+        device_id = announcement.get("gwId")
+        if device_id not in self.chargers or device_id in self._updating:
+            return
+        charger = self.chargers[device_id][0].charger
+        ip = str(announcement.get("ip") or addr[0])
+        version = str(announcement.get("version") or charger.device.version)
+        try:
+            parsed_version = float(version)
+        except ValueError:
+            return  # Некоректна версія в оголошенні - пакет відкидаємо
+        if not math.isfinite(parsed_version):
+            return
+        if ip == charger.address and parsed_version == charger.device.version:
+            return
+        self._updating.add(device_id)
+        asyncio.get_running_loop().create_task(self._relocate(device_id, ip, version))
+
+    async def _relocate(self, device_id: str, ip: str, version: str):
+        """Переводить зарядку на нову адресу та оновлює кеш (помилка лише логується)."""
+        try:
+            charger, configured = self.chargers[device_id]
+            old = charger.charger.address
+            await charger.set_address(ip, version)
+            FEYREE_ADDRESS_CHANGES.inc()
+            logger.warning(
+                f"Feyree зарядка {device_id}: нова адреса {ip} (була {old}), протокол {version}"
+            )
+            self.cache.remember(device_id, configured, ip, version)
+        except Exception as e:
+            logger.warning(f"Пошук зарядок: не вдалося перевести {device_id} на {ip}: {e}")
+        finally:
+            self._updating.discard(device_id)
+
+    def close(self):
+        """Закриває UDP порти."""
+        for transport in self._transports:
+            transport.close()
+        self._transports.clear()
+
+
+# ============================================================
+# Планувальник з фіксованою частотою
+# ============================================================
+
+
+class FixedRateTicker:
+    """
+    Тики з фіксованою частотою на монотонному годиннику event loop.
+
+    Наступний тик відраховується від запланованого моменту попереднього,
+    а не від завершення роботи, тому тривалість ітерацій не накопичується.
+    Тики, пропущені через довгу роботу, не стають у чергу: запізнілий тик
+    виконується один раз, а наступний призначається на найближчий момент
+    сітки в майбутньому (пропущені лише рахуються).
+    """
+
+    def __init__(
+        self,
+        interval_sec: float,
+        loop_name: str = "control",
+        clock: Optional[Callable[[], float]] = None,
+    ):
+        """
+        Args:
+            interval_sec: Період тиків (секунди)
+            loop_name: Мітка loop метрик (control, sampler, surplus)
+            clock: Монотонний годинник (за замовчуванням loop.time() поточного event loop)
+        """
+        self.interval_sec = interval_sec
+        self.clock = clock
+        self.lateness_histogram = SCHEDULE_LATENESS[loop_name]
+        self.skipped_counter = SCHEDULE_SKIPPED[loop_name]
+        self.next_due: Optional[float] = None
+        self.ticks = 0
+        self.skipped = 0
+        self.max_lateness_sec = 0.0
+
+    def now(self) -> float:
+        return self.clock() if self.clock is not None else asyncio.get_running_loop().time()
+
+    def reset(self, first_due: Optional[float] = None):
+        """Починає сітку з first_due (за замовчуванням - зараз)."""
+        self.next_due = self.now() if first_due is None else first_due
+
+    def tick(self, now: Optional[float] = None) -> float:
+        """
+        Фіксує запуск тику та планує наступний.
+
+        Returns:
+            Запізнення запуску відносно сітки (секунди)
+        """
+        now = self.now() if now is None else now
+        if self.next_due is None:
+            self.next_due = now
+        lateness = max(0.0, now - self.next_due)
+        self.ticks += 1
+        self.max_lateness_sec = max(self.max_lateness_sec, lateness)
+        self.lateness_histogram.observe(lateness)
+
+        due = self.next_due + self.interval_sec
+        if due <= now:
+            missed = math.floor((now - due) / self.interval_sec) + 1
+            due += missed * self.interval_sec
+            self.skipped += missed
+            self.skipped_counter.inc(missed)
+        self.next_due = due
+        return lateness
+
+    async def wait(self) -> float:
+        """Чекає наступного тику. Повертає його запізнення (секунди)."""
+        if self.next_due is None:
+            self.reset()
+        delay = self.next_due - self.now()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.tick()
+
+
+# ============================================================
+# Високочастотне опитування та ковзна статистика
+# ============================================================
+
+
+class RollingWindow:
+    """
+    Кільцеве вікно фіксованого розміру з інкрементальною статистикою.
+
+    Кожна нова вибірка оновлює за O(1): середнє, максимум (монотонна черга),
+    EMA з урахуванням інтервалу між вибірками та сумарний час, коли значення
+    перевищувало поріг. Час перевищення іншого порогу рахується за O(n)
+    з інтервалів, що зберігаються для кожної вибірки.
+    """
+
+    def __init__(self, size: int, ema_tau_sec: float, threshold: float):
+        """
+        Args:
+            size: Кількість вибірок у вікні
+            ema_tau_sec: Стала часу EMA (секунди, 0 = без згладжування)
+            threshold: Поріг для підрахунку часу перевищення
+        """
+        self.size = max(1, size)
+        self.ema_tau_sec = ema_tau_sec
+        self.threshold = threshold
+        self._values = [0.0] * self.size
+        self._dt = [0.0] * self.size
+        self._above_dt = [0.0] * self.size
+        self._sum = 0.0
+        self._above_sum = 0.0
+        self._max_queue: deque = deque()  # (номер вибірки, значення), спадна
+        self._seq = 0
+        self.count = 0
+        self.ema: Optional[float] = None
+        self.last: Optional[float] = None
+        self.last_time: Optional[float] = None
+
+    def add(self, timestamp: float, value: float):
+        """
+        Додає вибірку.
+
+        Args:
+            timestamp: Час вибірки (time.monotonic())
+            value: Значення
+        """
+        dt = timestamp - self.last_time if self.last_time is not None else 0.0
+
+        if self.ema is None or self.ema_tau_sec <= 0:
+            self.ema = value
+        else:
+            alpha = 1.0 - math.exp(-dt / self.ema_tau_sec)
+            self.ema += alpha * (value - self.ema)
+
+        idx = self._seq % self.size
+        if self.count == self.size:
+            # Витісняємо найстарішу вибірку
+            self._sum -= self._values[idx]
+            self._above_sum -= self._above_dt[idx]
+        else:
+            self.count += 1
+
+        above_dt = dt if value > self.threshold else 0.0
+        self._values[idx] = value
+        self._dt[idx] = dt
+        self._above_dt[idx] = above_dt
+        self._sum += value
+        self._above_sum += above_dt
+
+        if idx == self.size - 1:
+            # Раз на оберт перераховуємо суми, щоб не накопичувати похибку float
+            self._sum = math.fsum(self._values[: self.count])
+            self._above_sum = math.fsum(self._above_dt[: self.count])
+
+        while self._max_queue and self._max_queue[-1][1] <= value:
+            self._max_queue.pop()
+        self._max_queue.append((self._seq, value))
+        while self._max_queue[0][0] <= self._seq - self.size:
+            self._max_queue.popleft()
+
+        self._seq += 1
+        self.last = value
+        self.last_time = timestamp
+
+    @property
+    def mean(self) -> Optional[float]:
+        """Середнє значення у вікні."""
+        return self._sum / self.count if self.count else None
+
+    @property
+    def max(self) -> Optional[float]:
+        """Максимальне значення у вікні."""
+        return self._max_queue[0][1] if self._max_queue else None
+
+    @property
+    def time_above_sec(self) -> float:
+        """Сумарний час у вікні, коли значення перевищувало поріг (секунди)."""
+        return max(0.0, self._above_sum)
+
+    def time_above(self, threshold: float) -> float:
+        """Сумарний час у вікні, коли значення перевищувало threshold (секунди)."""
+        if threshold == self.threshold:
+            return self.time_above_sec
+        return math.fsum(
+            dt for value, dt in zip(self._values[: self.count], self._dt[: self.count]) if value > threshold
+        )
+
+
+class InverterSampler:
+    """
+    Фонове опитування інвертора з частотою SAMPLE_INTERVAL_SEC.
+
+    Вибірки потрапляють у ковзне вікно, а цикл керування з власним
+    інтервалом CHECK_INTERVAL_SEC бере з нього згладжені значення.
+    """
+
+    def __init__(
+        self,
+        inverter: AsyncDeyeInverter,
+        interval_sec: float = SAMPLE_INTERVAL_SEC,
+        window_sec: float = SAMPLE_WINDOW_SEC,
+        ema_tau_sec: float = GRID_EMA_TAU_SEC,
+        import_threshold: float = GRID_IMPORT_THRESHOLD,
+    ):
+        """
+        Args:
+            inverter: Асинхронний клієнт інвертора
+            interval_sec: Інтервал опитування (секунди)
+            window_sec: Довжина ковзного вікна (секунди)
+            ema_tau_sec: Стала часу EMA потужності мережі (секунди)
+            import_threshold: Поріг імпорту для підрахунку часу перевищення (W)
+        """
+        self.inverter = inverter
+        self.interval_sec = interval_sec
+        self.grid = RollingWindow(
+            size=math.ceil(window_sec / interval_sec),
+            ema_tau_sec=ema_tau_sec,
+            threshold=import_threshold,
+        )
+        self.battery_soc_pct: Optional[float] = None
+        self.samples = 0
+        self.errors = 0
+
+    def add(self, state: Dict[str, float | str], timestamp: Optional[float] = None):
+        """Додає результат get_battery_and_grid_state() у вікно."""
+        self.grid.add(
+            time.monotonic() if timestamp is None else timestamp,
+            float(state["grid_power_w"]),
+        )
+        self.battery_soc_pct = float(state["battery_soc_pct"])
+        self.samples += 1
+
+    async def run(self):
+        """Безкінечний цикл опитування (запускається як asyncio task)."""
+        ticker = FixedRateTicker(self.interval_sec, "sampler")
+        while True:
+            await ticker.wait()
+            try:
+                self.add(await self.inverter.get_battery_and_grid_state())
+            except CircuitOpenError:
+                # Розмикання вже залоговано breaker'ом
+                self.errors += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Помилка вибірки з інвертора: {e}")
+
+    def age_sec(self) -> Optional[float]:
+        """Вік останньої вибірки (секунди) або None."""
+        if self.grid.last_time is None:
+            return None
+        return time.monotonic() - self.grid.last_time
+
+    async def get_battery_and_grid_state(
+        self, import_threshold: Optional[float] = None
+    ) -> Dict[str, float | str]:
+        """
+        Згладжений стан у форматі DeyeInverter.get_battery_and_grid_state().
+
+        Додаткові ключі: grid_power_raw_w, grid_mean_w, grid_max_w,
+        import_above_sec, samples.
+
+        Args:
+            import_threshold: Поріг для import_above_sec (за замовчуванням - поріг
+                вікна; об'єкти на спільному інверторі передають власний)
+
+        Raises:
+            V5FrameError: Якщо немає свіжих вибірок
+        """
+        age = self.age_sec()
+        if age is None or age > max(3 * self.interval_sec, CONNECTION_TIMEOUT_SEC):
+            raise V5FrameError("Немає свіжих вибірок з інвертора")
+
+        grid_power_w = float(self.grid.ema)
+        return {
+            "battery_soc_pct": self.battery_soc_pct,
+            "grid_power_w": grid_power_w,
+            "grid_direction": DeyeInverter.grid_direction(grid_power_w),
+            "grid_power_raw_w": float(self.grid.last),
+            "grid_mean_w": float(self.grid.mean),
+            "grid_max_w": float(self.grid.max),
+            "import_above_sec": (
+                self.grid.time_above_sec
+                if import_threshold is None
+                else self.grid.time_above(import_threshold)
+            ),
+            "samples": self.grid.count,
+        }
+
+
+# ============================================================
+# Історія телеметрії (кільцевий буфер у memory-mapped файлі)
+# ============================================================
+
+# Коди стану зарядки в історії
+CHARGER_STATE_UNKNOWN = -1
+CHARGER_STATE_OFF = 0
+CHARGER_STATE_ON = 1
+CHARGER_STATE_CHARGING = 2
+
+
+class _TimestampIndex:
+    """Мітки часу історії в логічному порядку (послідовність для bisect)."""
+
+    __slots__ = ("history",)
+
+    def __init__(self, history: "TelemetryHistory"):
+        self.history = history
+
+    def __len__(self) -> int:
+        return self.history.count
+
+    def __getitem__(self, index: int) -> float:
+        return self.history.timestamps[self.history._physical(index)]
+
+
+class TelemetryHistory:
+    """
+    Історія телеметрії фіксованого розміру з колонками в memory-mapped файлі.
+
+    Кожна колонка - типізований масив (memoryview над mmap) на capacity
+    записів, нові записи перезаписують найстаріші по колу. Пам'ять не
+    зростає з часом роботи, а файл у змонтованому томі переживає перезапуск
+    контейнера. Мітки часу неспадні, тому вибірка за інтервалом часу -
+    двійковий пошук без перебору.
+
+    Формат файлу: заголовок (HEADER_SIZE байт) + колонки COLUMNS одна за одною.
+    Лічильник записів у заголовку оновлюється після запису всіх колонок,
+    тому перерваний запис не потрапляє в історію.
+    """
+
+    MAGIC = b"FEYHIST1"
+    VERSION = 1
+    # magic, версія формату, capacity, загальна кількість записаних
+    HEADER = struct.Struct("<8sIIQ")
+    HEADER_SIZE = 64
+    # (назва, typecode array/memoryview) - порядок визначає розміщення у файлі
+    COLUMNS = (
+        ("timestamp", "d"),
+        ("battery_soc_pct", "f"),
+        ("grid_power_w", "f"),
+        ("current_a", "f"),
+        ("energy_kwh", "f"),
+        ("charger_state", "b"),
+    )
+
+    def __init__(self, path: str = "", capacity: int = HISTORY_CAPACITY):
+        """
+        Відкриває (або створює) історію.
+
+        Args:
+            path: Шлях до файлу (порожньо = анонімна пам'ять без збереження)
+            capacity: Кількість записів кільцевого буфера
+        """
+        if capacity <= 0:
+            raise ValueError("HISTORY_CAPACITY має бути більше 0")
+        self.path = path
+        self.capacity = capacity
+        size = self.HEADER_SIZE + sum(
+            capacity * struct.calcsize(code) for _, code in self.COLUMNS
+        )
+        if path:
+            self._mm = self._open_file(path, size)
+        else:
+            self._mm = mmap.mmap(-1, size)
+            self._write_header(0)
+
+        self._columns: Dict[str, memoryview] = {}
+        view = memoryview(self._mm)
+        offset = self.HEADER_SIZE
+        for name, code in self.COLUMNS:
+            length = capacity * struct.calcsize(code)
+            self._columns[name] = view[offset : offset + length].cast(code)
+            offset += length
+        view.release()
+
+        self.written: int = self.HEADER.unpack_from(self._mm)[3]
+        self.timestamps = self._columns["timestamp"]
+        self._index = _TimestampIndex(self)
+
+    def _open_file(self, path: str, size: int) -> mmap.mmap:
+        """Відкриває файл історії; несумісний файл створюється заново."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size
+            valid = False
+            if existing >= self.HEADER.size:
+                magic, version, capacity, _ = self.HEADER.unpack(
+                    os.pread(fd, self.HEADER.size, 0)
+                )
+                valid = (
+                    magic == self.MAGIC
+                    and version == self.VERSION
+                    and capacity == self.capacity
+                    and existing == size
+                )
+                if not valid:
+                    logger.warning(
+                        f"Файл історії {path} несумісний (capacity {capacity}, "
+                        f"потрібно {self.capacity}) - створюється новий"
+                    )
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+        finally:
+            # mmap тримає власний дескриптор файлу
+            os.close(fd)
+        if not valid:
+            self.HEADER.pack_into(mm, 0, self.MAGIC, self.VERSION, self.capacity, 0)
+        return mm
+
+    def _write_header(self, written: int) -> None:
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.VERSION, self.capacity, written)
+
+    @property
+    def count(self) -> int:
+        """Кількість записів в історії (не більше capacity)."""
+        return min(self.written, self.capacity)
+
+    def _physical(self, index: int) -> int:
+        """Логічний індекс (0 = найстаріший запис) -> позиція в колонках."""
+        return (self.written - self.count + index) % self.capacity
+
+    @property
+    def last_timestamp(self) -> Optional[float]:
+        """Мітка часу останнього запису (None = історія порожня)."""
+        if not self.written:
+            return None
+        return self.timestamps[(self.written - 1) % self.capacity]
+
+    def append(
+        self,
+        timestamp: float,
+        battery_soc_pct: float,
+        grid_power_w: float,
+        charger_state: int = CHARGER_STATE_UNKNOWN,
+        current_a: Optional[float] = None,
+        energy_kwh: Optional[float] = None,
+    ) -> None:
+        """
+        Додає запис (O(1), без виділення пам'яті під історію).
+
+        Мітка часу, менша за попередню (корекція годинника), замінюється
+        попередньою, щоб зберегти впорядкованість для пошуку.
+        """
+        last = self.last_timestamp
+        if last is not None and timestamp < last:
+            timestamp = last
+        position = self.written % self.capacity
+        columns = self._columns
+        columns["timestamp"][position] = timestamp
+        columns["battery_soc_pct"][position] = battery_soc_pct
+        columns["grid_power_w"][position] = grid_power_w
+        columns["current_a"][position] = math.nan if current_a is None else current_a
+        columns["energy_kwh"][position] = math.nan if energy_kwh is None else energy_kwh
+        columns["charger_state"][position] = charger_state
+        self.written += 1
+        self._write_header(self.written)
+
+    def _slice(self, start: int, stop: int) -> Dict[str, array]:
+        """Копіює логічний діапазон [start, stop) у масиви array по колонках."""
+        result = {name: array(code) for name, code in self.COLUMNS}
+        length = max(0, stop - start)
+        if not length:
+            return result
+        first = self._physical(start)
+        segments = [(first, min(first + length, self.capacity))]
+        if first + length > self.capacity:
+            segments.append((0, first + length - self.capacity))
+        for name, column in self._columns.items():
+            for begin, end in segments:
+                result[name].frombytes(column[begin:end].cast("B"))
+        return result
+
+    def query(self, start: float, end: Optional[float] = None) -> Dict[str, array]:
+        """
+        Записи з мітками часу в інтервалі [start, end].
+
+        Returns:
+            Словник колонок (array) однакової довжини; відсутні значення - NaN
+        """
+        low = bisect.bisect_left(self._index, start)
+        high = self.count if end is None else bisect.bisect_right(self._index, end)
+        return self._slice(low, high)
+
+    def latest(self, n: int) -> Dict[str, array]:
+        """Останні n записів (у хронологічному порядку)."""
+        count = self.count
+        return self._slice(max(0, count - n), count)
+
+    def flush(self) -> None:
+        """Скидає зміни на диск (для файлу історії)."""
+        if self.path:
+            self._mm.flush()
+
+    def close(self) -> None:
+        """Зберігає та закриває історію."""
+        self.flush()
+        for column in self._columns.values():
+            column.release()
+        self._columns.clear()
+        self._mm.close()
+
+
+# ============================================================
+# Журнал сесій зарядки (SQLite)
+# ============================================================
+
+
+@dataclass
+class ChargingSession:
+    """Одна сесія зарядки: від початку до завершення зарядки авто."""
+
+    site: str
+    charger: str
+    started_at: float  # time.time()
+    updated_at: float
+    ended_at: Optional[float] = None
+    energy_kwh: float = 0.0
+    grid_kwh: float = 0.0  # Частина енергії, імпортована з мережі
+    solar_kwh: float = 0.0  # Частина з власної генерації (PV або батарея)
+    max_power_w: float = 0.0
+    start_soc: Optional[float] = None
+    end_soc: Optional[float] = None
+
+    def row(self) -> tuple:
+        """Рядок для SessionLedger.UPSERT."""
+        return (
+            self.site,
+            self.charger,
+            self.started_at,
+            time.strftime("%Y-%m-%d", time.localtime(self.started_at)),
+            self.updated_at,
+            self.ended_at,
+            self.energy_kwh,
+            self.grid_kwh,
+            self.solar_kwh,
+            self.max_power_w,
+            self.start_soc,
+            self.end_soc,
+        )
+
+
+class SessionLedger:
+    """
+    Журнал сесій зарядки в SQLite.
+
+    Цикл керування лише кладе рядки в чергу (save() не торкається диска).
+    Фоновий потік раз на flush_sec записує накопичене однією транзакцією;
+    кілька оновлень однієї сесії в пакеті зводяться до останнього. Запис -
+    idempotent upsert за (site, charger, started_at), база в режимі WAL,
+    тому запити підсумків читають паралельно з записом.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            site TEXT NOT NULL,
+            charger TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            day TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            ended_at REAL,
+            energy_kwh REAL NOT NULL,
+            grid_kwh REAL NOT NULL,
+            solar_kwh REAL NOT NULL,
+            max_power_w REAL NOT NULL,
+            start_soc REAL,
+            end_soc REAL,
+            PRIMARY KEY (site, charger, started_at)
+        );
+        -- Покриваючий індекс для підсумків за днями та місяцями
+        CREATE INDEX IF NOT EXISTS sessions_by_day
+            ON sessions (day, site, charger, energy_kwh, grid_kwh, solar_kwh);
+    """
+    UPSERT = """
+        INSERT INTO sessions (site, charger, started_at, day, updated_at, ended_at,
+                              energy_kwh, grid_kwh, solar_kwh, max_power_w, start_soc, end_soc)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (site, charger, started_at) DO UPDATE SET
+            updated_at = excluded.updated_at,
+            ended_at = excluded.ended_at,
+            energy_kwh = excluded.energy_kwh,
+            grid_kwh = excluded.grid_kwh,
+            solar_kwh = excluded.solar_kwh,
+            max_power_w = excluded.max_power_w,
+            end_soc = excluded.end_soc
+    """
+    # Підсумок за період: {period} - вираз групування від day
+    SUMMARY = """
+        SELECT {period} AS period, site, charger, COUNT(*), SUM(energy_kwh),
+               SUM(grid_kwh), SUM(solar_kwh)
+        FROM sessions
+        WHERE day >= ? AND day < ?
+        GROUP BY period, site, charger
+        ORDER BY period, site, charger
+    """
+
+    _STOP = object()
+
+    def __init__(self, path: str, flush_sec: float = SESSION_DB_FLUSH_SEC):
+        """
+        Відкриває (або створює) базу та запускає потік запису.
+
+        Сесії, не завершені попереднім запуском (перезапуск під час
+        зарядки), закриваються моментом останнього оновлення.
+
+        Raises:
+            sqlite3.Error, OSError: База недоступна
+        """
+        self.path = path
+        self.flush_sec = flush_sec
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+            with conn:
+                conn.execute("UPDATE sessions SET ended_at = updated_at WHERE ended_at IS NULL")
+        finally:
+            conn.close()
+        self.written = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, name="session-ledger", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        # У WAL режимі NORMAL не втрачає цілісність, лише останні транзакції при збої живлення
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def save(self, session: ChargingSession):
+        """Ставить стан сесії в чергу запису (без очікування диска)."""
+        self._queue.put(session.row())
+
+    def _writer(self):
+        """Потік запису: збирає рядки flush_sec і пише їх однією транзакцією."""
+        conn = self._connect()
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is self._STOP:
+                    break
+                batch = {item[:3]: item}
+                deadline = time.monotonic() + self.flush_sec
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is self._STOP:
+                        stopping = True
+                        break
+                    batch[item[:3]] = item
+                try:
+                    with conn:
+                        conn.executemany(self.UPSERT, batch.values())
+                    self.written += len(batch)
+                except sqlite3.Error as e:
+                    logger.error(f"Помилка запису журналу сесій ({len(batch)} записів): {e}")
+        finally:
+            conn.close()
+
+    def close(self):
+        """Дописує чергу та зупиняє потік запису."""
+        self._queue.put(self._STOP)
+        self._thread.join(timeout=max(30.0, 2 * self.flush_sec))
+
+
+def session_summary(
+    path: str, monthly: bool = False, start: str = "0000-00-00", end: str = "9999-99-99"
+) -> list[tuple]:
+    """
+    Підсумки сесій з журналу за днями або місяцями (лише читання).
+
+    Args:
+        path: Файл бази журналу сесій
+        monthly: False = за днями (YYYY-MM-DD), True = за місяцями (YYYY-MM)
+        start: Перший день періоду (YYYY-MM-DD, включно)
+        end: Кінець періоду (YYYY-MM-DD, не включно)
+
+    Returns:
+        Рядки (період, site, charger, сесій, kWh, з мережі kWh, власні kWh)
+    """
+    period = "substr(day, 1, 7)" if monthly else "day"
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+    try:
+        return conn.execute(SessionLedger.SUMMARY.format(period=period), (start, end)).fetchall()
+    finally:
+        conn.close()
+
+
+class SessionTracker:
+    """
+    Відкриває та закриває сесії однієї зарядки за DPS 101.
+
+    Сесія активна, поки DPS 101 показує зарядку ("charing") - та сама
+    ознака, за якою цикл керування визначає стан зарядки. Енергія - сума
+    приростів DPS 102 між спостереженнями (скидання лічильника пристроєм
+    враховується).
+    Викликається лише з потоку event loop.
+    """
+
+    def __init__(self, site: str, charger: str, ledger: SessionLedger):
+        self.site = site
+        self.charger = charger
+        self.ledger = ledger
+        self.session: Optional[ChargingSession] = None
+        self._last_energy: Optional[float] = None
+        self._last_time: Optional[float] = None
+        self._pending_kwh = 0.0
+
+    @staticmethod
+    def is_active(dps: Dict[str, object]) -> bool:
+        """Чи триває зарядка за DPS 101 (статус)."""
+        return "char" in str(dps.get("101", "")).lower()
+
+    def measure(self, timestamp: float, dps: Dict[str, object]) -> float:
+        """
+        Перший крок спостереження: приріст енергії з попереднього.
+
+        Returns:
+            Середня потужність зарядки з попереднього спостереження (W)
+        """
+        energy_raw = dps.get("102")
+        energy = float(energy_raw) / 1000.0 if energy_raw is not None else None
+        delta = 0.0
+        if self.session is not None and energy is not None and self._last_energy is not None:
+            delta = energy - self._last_energy if energy >= self._last_energy else energy
+        elapsed = 0.0 if self._last_time is None else timestamp - self._last_time
+        self._last_energy, self._last_time = energy, timestamp
+        self._pending_kwh = delta
+        return delta * 3.6e6 / elapsed if elapsed > 0 else 0.0
+
+    def commit(
+        self,
+        timestamp: float,
+        dps: Dict[str, object],
+        battery_soc: float,
+        power_w: float,
+        grid_fraction: float,
+    ):
+        """
+        Другий крок: розподіл приросту між мережею та власною генерацією,
+        відкриття/закриття сесії та постановка її стану в чергу запису.
+        """
+        session = self.session
+        active = self.is_active(dps)
+        if session is None:
+            if not active:
+                return
+            session = self.session = ChargingSession(
+                self.site, self.charger, started_at=timestamp, updated_at=timestamp,
+                start_soc=battery_soc,
+            )
+            logger.info(f"Сесія зарядки {self.site}/{self.charger}: початок")
+        else:
+            delta = self._pending_kwh
+            session.energy_kwh += delta
+            session.grid_kwh += delta * grid_fraction
+            session.solar_kwh += delta * (1.0 - grid_fraction)
+            session.max_power_w = max(session.max_power_w, power_w)
+        session.updated_at = timestamp
+        session.end_soc = battery_soc
+        if not active:
+            session.ended_at = timestamp
+            self.session = None
+            logger.info(
+                f"Сесія зарядки {self.site}/{self.charger}: завершено, "
+                f"{session.energy_kwh:.2f} kWh (з мережі {session.grid_kwh:.2f} kWh, "
+                f"власні {session.solar_kwh:.2f} kWh), "
+                f"{(session.ended_at - session.started_at) / 60:.0f} хв"
+            )
+        self.ledger.save(session)
+
+
+def print_session_summary(argv: list[str]) -> None:
+    """CLI: python main.py sessions [--monthly] [--from YYYY-MM-DD] [--to YYYY-MM-DD]."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py sessions", description="Підсумки сесій зарядки")
+    parser.add_argument("--monthly", action="store_true", help="За місяцями замість днів")
+    parser.add_argument("--from", dest="start", default="0000-00-00", help="Перший день (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="end", default="9999-99-99", help="Кінець періоду, не включно")
+    parser.add_argument("--db", default=SESSION_DB_FILE, help="Файл бази (SESSION_DB_FILE)")
+    args = parser.parse_args(argv)
+    if not args.db or not os.path.exists(args.db):
+        sys.exit(f"Журнал сесій не знайдено: {args.db or 'SESSION_DB_FILE не задано'}")
+
+    rows = session_summary(args.db, args.monthly, args.start, args.end)
+    print(f"{'Період':<10} {'Зарядка':<24} {'Сесій':>6} {'kWh':>9} {'Мережа':>9} {'Власні':>9}")
+    for period_value, site, charger, count, energy, grid, solar in rows:
+        print(
+            f"{period_value:<10} {site + '/' + charger:<24} {count:>6} "
+            f"{energy:>9.2f} {grid:>9.2f} {solar:>9.2f}"
+        )
+
+
+# ============================================================
+# Гістерезис та захист від брязкоту
+# ============================================================
+
+
+@dataclass
+class ChargeDecision:
+    """Результат оцінки ChargeStateMachine."""
+
+    want_charge: bool  # Бажаний стан зарядки
+    command: Optional[bool] = None  # True = увімкнути, False = вимкнути, None = нічого
+    suppressed: Optional[str] = None  # Причина придушення команди
+    reasons: list[str] = field(default_factory=list)
+
+
+class ChargeStateMachine:
+    """
+    Скінченний автомат керування зарядкою з гістерезисом та debounce.
+
+    - Увімкнення: SOC >= soc_on та імпорт < grid_on
+    - Вимкнення: SOC < soc_off або тривалий імпорт > grid_off
+    - Між перемиканнями витримується min_on_sec / min_off_sec
+    - Кількість команд обмежена max_commands_per_hour
+
+    Тому кількість записів у пристрій обмежена незалежно від шуму показів.
+    Автомат не виконує I/O: цикл керування передає фактичний стан через
+    observe(), виконує команду з evaluate() та звітує через record_command().
+    Застарілий безпам'ятний варіант відтворюється з soc_off = soc_on,
+    grid_off = grid_on, нульовими мінімальними часами та без ліміту команд.
+    """
+
+    def __init__(
+        self,
+        soc_on: float = SOC_THRESHOLD,
+        soc_off: float = SOC_OFF_THRESHOLD,
+        grid_on: float = GRID_IMPORT_THRESHOLD,
+        grid_off: float = GRID_IMPORT_OFF_THRESHOLD,
+        min_on_sec: float = MIN_ON_TIME_SEC,
+        min_off_sec: float = MIN_OFF_TIME_SEC,
+        max_commands_per_hour: int = MAX_COMMANDS_PER_HOUR,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            soc_on: Мінімальний SOC для увімкнення (%)
+            soc_off: SOC, нижче якого зарядка вимикається (%)
+            grid_on: Максимальний імпорт для увімкнення (W)
+            grid_off: Імпорт, вище якого зарядка вимикається (W)
+            min_on_sec: Мінімальний час у стані ВВІМК (секунди)
+            min_off_sec: Мінімальний час у стані ВИМК (секунди)
+            max_commands_per_hour: Ліміт команд на годину (0 = без ліміту)
+            clock: Джерело монотонного часу
+        """
+        self.soc_on = soc_on
+        self.soc_off = soc_off
+        self.grid_on = grid_on
+        self.grid_off = grid_off
+        self.min_on_sec = min_on_sec
+        self.min_off_sec = min_off_sec
+        self.max_commands_per_hour = max_commands_per_hour
+        self.clock = clock
+
+        self.is_on: Optional[bool] = None  # None = стан ще невідомий
+        # Час входу в поточний стан (None = невідомо, обмеження не діє)
+        self.state_since: Optional[float] = None
+        self._command_times: deque = deque()
+
+        # Лічильники
+        self.transitions = 0
+        self.suppressed = 0
+        self.commands_sent = 0
+
+    def observe(self, is_charging: bool):
+        """Синхронізує автомат з фактичним станом зарядки."""
+        if self.is_on == is_charging:
+            return
+        if self.is_on is not None:
+            logger.info(
+                f"Стан зарядки змінився поза керуванням: {'ВВІМК' if is_charging else 'ВИМК'}"
+            )
+            self.transitions += 1
+            self.state_since = self.clock()
+        self.is_on = is_charging
+
+    def evaluate(
+        self,
+        battery_soc: float,
+        grid_power: float,
+        grid_direction: str,
+        import_above_sec: Optional[float] = None,
+    ) -> ChargeDecision:
+        """
+        Оцінює умови та вирішує, чи потрібна команда.
+
+        Args:
+            battery_soc: Рівень заряду батареї (%)
+            grid_power: Потужність мережі (W)
+            grid_direction: Напрямок потоку енергії
+            import_above_sec: Час у вікні з імпортом вище порогу (None = без вікна)
+
+        Returns:
+            ChargeDecision з бажаним станом, командою та причинами
+        """
+        import_w = grid_power if grid_direction == "import" else 0.0
+        # Без вікна кожне значення вважається тривалим імпортом
+        sustained = import_above_sec is None or import_above_sec >= GRID_IMPORT_MAX_SEC
+        reasons = []
+
+        if self.is_on:
+            want = True
+            if battery_soc < self.soc_off:
+                want = False
+                reasons.append(f"SOC {battery_soc:.1f}% < {self.soc_off}%")
+            if import_w > self.grid_off and sustained:
+                want = False
+                reasons.append(f"імпорт {import_w:.0f}W > {self.grid_off}W")
+            if want:
+                reasons.append(
+                    f"SOC >= {self.soc_off}% та імпорт <= {self.grid_off}W - утримуємо"
+                )
+        else:
+            soc_ok = battery_soc >= self.soc_on
+            grid_ok = import_w < self.grid_on or not sustained
+            want = soc_ok and grid_ok
+            reasons.append(
+                f"SOC >= {self.soc_on}%: {'ТАК' if soc_ok else 'НІ'}"
+            )
+            reasons.append(
+                f"Імпорт < {self.grid_on}W або експорт: {'ТАК' if grid_ok else 'НІ'}"
+            )
+
+        return self.decide(want, reasons)
+
+    def decide(self, want: bool, reasons: list[str]) -> ChargeDecision:
+        """
+        Команда для бажаного стану з урахуванням мінімального часу у стані
+        та ліміту команд (спільне для порогового правила та плану).
+
+        Args:
+            want: Бажаний стан зарядки
+            reasons: Обґрунтування бажаного стану
+
+        Returns:
+            ChargeDecision з командою або причиною придушення
+        """
+        decision = ChargeDecision(want_charge=want, reasons=reasons)
+        if self.is_on is not None and want == self.is_on:
+            return decision
+
+        now = self.clock()
+        if self.is_on is not None and self.state_since is not None:
+            in_state = now - self.state_since
+            min_time = self.min_on_sec if self.is_on else self.min_off_sec
+            if in_state < min_time:
+                decision.suppressed = (
+                    f"мінімальний час у стані {'ВВІМК' if self.is_on else 'ВИМК'} "
+                    f"({in_state:.0f}/{min_time:.0f} сек)"
+                )
+        if decision.suppressed is None and self.max_commands_per_hour > 0:
+            while self._command_times and now - self._command_times[0] >= 3600:
+                self._command_times.popleft()
+            if len(self._command_times) >= self.max_commands_per_hour:
+                decision.suppressed = (
+                    f"ліміт {self.max_commands_per_hour} команд на годину"
+                )
+
+        if decision.suppressed is not None:
+            self.suppressed += 1
+        else:
+            decision.command = want
+        return decision
+
+    def record_command(self, turn_on: bool, success: bool):
+        """
+        Фіксує надіслану команду (успішну чи ні - обидві входять у ліміт).
+
+        Args:
+            turn_on: True = увімкнення, False = вимкнення
+            success: Чи підтвердив пристрій команду
+        """
+        now = self.clock()
+        # Обрізання і тут: decide() чистить чергу лише при ввімкненому ліміті
+        while self._command_times and now - self._command_times[0] >= 3600:
+            self._command_times.popleft()
+        self._command_times.append(now)
+        self.commands_sent += 1
+        if success:
+            if self.is_on != turn_on:
+                self.transitions += 1
+            self.is_on = turn_on
+            self.state_since = now
+
+    def export_state(self) -> Dict:
+        """Стан автомата для знімка (моменти часу - як вік у секундах)."""
+        now = self.clock()
+        return {
+            "is_on": self.is_on,
+            "in_state_sec": None if self.state_since is None else now - self.state_since,
+            "command_ages_sec": [now - t for t in self._command_times if now - t < 3600],
+            "transitions": self.transitions,
+            "suppressed": self.suppressed,
+            "commands_sent": self.commands_sent,
+        }
+
+    def restore_state(self, state: Dict, elapsed_sec: float):
+        """
+        Відновлює стан зі знімка export_state().
+
+        Args:
+            state: Збережений стан
+            elapsed_sec: Час від збереження знімка (додається до всіх віків)
+        """
+        now = self.clock()
+        self.is_on = state.get("is_on")
+        in_state = state.get("in_state_sec")
+        self.state_since = None if in_state is None else now - (in_state + elapsed_sec)
+        self._command_times = deque(
+            now - (age + elapsed_sec)
+            for age in sorted(state.get("command_ages_sec", ()), reverse=True)
+            if age + elapsed_sec < 3600
+        )
+        self.transitions = int(state.get("transitions", 0))
+        self.suppressed = int(state.get("suppressed", 0))
+        self.commands_sent = int(state.get("commands_sent", 0))
+
+
+# ============================================================
+# Регулятор струму за надлишком PV
+# ============================================================
+
+
+class SurplusCurrentController:
+    """
+    Замкнений регулятор струму зарядки за потужністю мережі (регістр 169).
+
+    Інкрементальний (інтегральний) закон: вимірювана потужність мережі
+    вже враховує поточне споживання зарядки, тому струм змінюється на
+    похибку / (напруга x фази). Зона нечутливості, обмеження кроку та
+    мінімальний інтервал між змінами зменшують кількість команд.
+    """
+
+    def __init__(
+        self,
+        min_current_a: int = MIN_CHARGING_CURRENT_A,
+        max_current_a: int = CHARGING_CURRENT_A,
+        target_grid_w: float = SURPLUS_TARGET_GRID_W,
+        deadband_w: float = SURPLUS_DEADBAND_W,
+        max_step_a: int = SURPLUS_MAX_STEP_A,
+        min_change_interval_sec: float = SURPLUS_MIN_CHANGE_INTERVAL_SEC,
+        interval_sec: float = SURPLUS_INTERVAL_SEC,
+        volts_per_amp: float = CHARGER_VOLTAGE_V * CHARGER_PHASES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            min_current_a: Мінімальний струм зарядки (A)
+            max_current_a: Максимальний струм зарядки (A)
+            target_grid_w: Цільова потужність мережі (W, від'ємне = експорт)
+            deadband_w: Зона нечутливості навколо цілі (W)
+            max_step_a: Максимальна зміна струму за одну команду (A)
+            min_change_interval_sec: Мінімальний інтервал між змінами (секунди)
+            interval_sec: Період роботи регулятора (секунди)
+            volts_per_amp: Потужність на 1 A струму (W/A)
+            clock: Джерело монотонного часу
+        """
+        self.min_current_a = min_current_a
+        self.max_current_a = max_current_a
+        self.target_grid_w = target_grid_w
+        self.deadband_w = deadband_w
+        self.max_step_a = max_step_a
+        self.min_change_interval_sec = min_change_interval_sec
+        self.interval_sec = interval_sec
+        self.volts_per_amp = volts_per_amp
+        self.clock = clock
+
+        self._last_change: Optional[float] = None
+        self.changes_sent = 0
+        self.suppressed = 0
+
+    def update(self, grid_power_w: float, current_a: int) -> Optional[int]:
+        """
+        Обчислює новий струм зарядки.
+
+        Args:
+            grid_power_w: Потужність мережі (W, позитивне = імпорт)
+            current_a: Поточний струм зарядки (A)
+
+        Returns:
+            Новий струм або None, якщо команда не потрібна
+        """
+        error_w = self.target_grid_w - grid_power_w  # > 0: є запас для більшого струму
+        if abs(error_w) <= self.deadband_w:
+            return None
+
+        delta_a = error_w / self.volts_per_amp
+        delta_a = max(-self.max_step_a, min(self.max_step_a, delta_a))
+        new_current = int(round(current_a + delta_a))
+        new_current = max(self.min_current_a, min(self.max_current_a, new_current))
+        if new_current == current_a:
+            return None
+
+        now = self.clock()
+        if (
+            self._last_change is not None
+            and now - self._last_change < self.min_change_interval_sec
+        ):
+            self.suppressed += 1
+            return None
+        return new_current
+
+    def record_change(self, success: bool):
+        """Фіксує надіслану команду зміни струму."""
+        self._last_change = self.clock()
+        if success:
+            self.changes_sent += 1
+
+    async def run(
+        self,
+        charger: AsyncFeyreeCharger,
+        sampler: InverterSampler,
+        state_machine: "ChargeStateMachine",
+    ):
+        """
+        Безкінечний цикл регулювання (запускається як asyncio task).
+
+        Працює лише коли зарядка увімкнена і є свіжі вибірки з інвертора.
+        """
+        ticker = FixedRateTicker(self.interval_sec, "surplus")
+        ticker.reset(ticker.now() + self.interval_sec)
+        while True:
+            await ticker.wait()
+            if not state_machine.is_on or charger.current_setpoint_a is None:
+                continue
+            age = sampler.age_sec()
+            if age is None or age > 2 * sampler.interval_sec:
+                continue
+            new_current = self.update(float(sampler.grid.last), charger.current_setpoint_a)
+            if new_current is None:
+                continue
+            self.record_change(await charger.set_current(new_current))
+
+
+# ============================================================
+# План зарядки за прогнозом PV та навантаження
+# ============================================================
+
+
+def load_forecast(
+    path: str,
+) -> tuple[list[tuple[float, float]], Optional[list[tuple[float, float]]]]:
+    """
+    Прогноз з CSV у форматі еталонних рядів сканера (load_scan_reference()):
+    колонка timestamp (Unix або ISO 8601), pv_w та необов'язкова load_w.
+
+    Returns:
+        (ряд pv_w, ряд load_w або None)
+
+    Raises:
+        OSError: Файл недоступний
+        ValueError: Некоректне значення або немає колонки pv_w
+    """
+    series = load_scan_reference(path)
+    if not series.get("pv_w"):
+        raise ValueError("немає значень у колонці pv_w")
+    return series["pv_w"], series.get("load_w")
+
+
+def resample_series(
+    points: list[tuple[float, float]], start: float, step_sec: float, count: int
+) -> array:
+    """
+    Значення ряду на сітці start + i * step_sec: лінійна інтерполяція між
+    точками (прогноз PV зазвичай погодинний), за межами ряду - крайнє значення.
+    """
+    times = [t for t, _ in points]
+    values = array("d", bytes(8 * count))
+    for i in range(count):
+        t = start + i * step_sec
+        index = bisect.bisect_right(times, t)
+        if index == 0:
+            values[i] = points[0][1]
+        elif index == len(points):
+            values[i] = points[-1][1]
+        else:
+            (t0, v0), (t1, v1) = points[index - 1], points[index]
+            values[i] = v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+    return values
+
+
+def plan_charge_current(
+    soc_pct: float,
+    net_w: array,
+    step_sec: float,
+    capacity_kwh: float,
+    min_soc: float,
+    min_current_a: int,
+    max_current_a: int,
+    volts_per_amp: float,
+) -> tuple[array, array]:
+    """
+    Дозволений струм зарядки на кожному кроці прогнозу.
+
+    Модель батареї: за крок SOC змінюється на (PV - навантаження - зарядка)
+    x крок / ємність і не перевищує 100% (решта - експорт). Зворотний прохід
+    обчислює мінімальний SOC на початку кожного кроку, з яким батарея без
+    зарядки авто не опуститься нижче min_soc до кінця горизонту. Прямий
+    прохід дозволяє на кожному кроці найбільший струм, після якого SOC
+    лишається не нижче цієї межі: енергію, яку батарея до кінця горизонту
+    все одно відновить або експортує, зарядка забирає якомога раніше.
+
+    Args:
+        soc_pct: SOC на початку плану (%)
+        net_w: PV мінус навантаження на кожному кроці (W)
+        step_sec: Крок плану (секунди)
+        capacity_kwh: Корисна ємність батареї (kWh)
+        min_soc: SOC, нижче якого зарядка не розряджає батарею (%)
+        min_current_a: Мінімальний струм зарядки (A)
+        max_current_a: Максимальний струм зарядки (A)
+        volts_per_amp: Потужність на 1 A струму (W/A)
+
+    Returns:
+        (струм на кожному кроці, A, 0 = не заряджати; плановий SOC на межах
+        кроків, на один елемент довший)
+    """
+    pct_per_step_w = step_sec / 3600.0 * 100.0 / (capacity_kwh * 1000.0)
+    delta = array("d", (w * pct_per_step_w for w in net_w))
+    # required[i] - мінімальний SOC на початку кроку i, required[-1] = min_soc
+    required = array(
+        "d",
+        itertools.accumulate(
+            reversed(delta),
+            lambda need, d: min(100.0, max(min_soc, need - d)),
+            initial=min_soc,
+        ),
+    )
+    required.reverse()
+
+    amp_pct = volts_per_amp * pct_per_step_w  # SOC за крок на 1 A зарядки
+    current = array("B", bytes(len(delta)))
+    soc = array("d", bytes(8 * (len(delta) + 1)))
+    soc[0] = level = soc_pct
+    for i, d in enumerate(delta):
+        spare = level + d - required[i + 1]
+        amps = min(max_current_a, int(spare / amp_pct)) if spare > 0 else 0
+        if amps >= min_current_a:
+            current[i] = amps
+            d -= amps * amp_pct
+        level = max(0.0, min(100.0, level + d))
+        soc[i + 1] = level
+    return current, soc
+
+
+@dataclass
+class ChargePlan:
+    """Таблиця плану: крок i діє з start + i * step_sec."""
+
+    start: float
+    step_sec: float
+    current_a: array
+    soc_pct: array
+    net_w: array
+    reason: str
+    created_at: float = field(default_factory=time.time)
+
+    def index(self, timestamp: float) -> Optional[int]:
+        """Номер кроку для моменту timestamp (None - поза планом)."""
+        index = int((timestamp - self.start) // self.step_sec)
+        return index if 0 <= index < len(self.current_a) else None
+
+    def soc_at(self, timestamp: float, index: int) -> float:
+        """Плановий SOC у момент timestamp кроку index (лінійно в межах кроку)."""
+        fraction = (timestamp - self.start) / self.step_sec - index
+        return self.soc_pct[index] + (self.soc_pct[index + 1] - self.soc_pct[index]) * fraction
+
+    def to_dict(self) -> Dict:
+        """Таблиця для файлу plan-<об'єкт>.json."""
+        return {
+            "reason": self.reason,
+            "created_at": self.created_at,
+            "start": self.start,
+            "step_sec": self.step_sec,
+            "current_a": self.current_a.tolist(),
+            "soc_pct": [round(value, 1) for value in self.soc_pct],
+            "net_w": [round(value) for value in self.net_w],
+        }
+
+
+class ChargePlanner:
+    """
+    План зарядки за прогнозом PV та навантаження (режим "plan").
+
+    Таблиця дозволеного струму розраховується заздалегідь, і кожна ітерація
+    циклу лише знаходить у ній крок за часом. План перераховується, коли
+    файл прогнозу змінився більше ніж на forecast_tolerance_w, фактичний
+    SOC відхилився від планового більше ніж на soc_tolerance_pct або план
+    закінчився. Без дійсного плану lookup() повертає None, і рішення
+    приймає порогове правило.
+    """
+
+    def __init__(
+        self,
+        forecast_file: str,
+        min_current_a: int,
+        max_current_a: int,
+        volts_per_amp: float = CHARGER_VOLTAGE_V * CHARGER_PHASES,
+        capacity_kwh: float = BATTERY_CAPACITY_KWH,
+        min_soc: float = PLAN_MIN_SOC,
+        step_sec: float = PLAN_STEP_SEC,
+        horizon_sec: float = PLAN_HORIZON_SEC,
+        default_load_w: float = PLAN_DEFAULT_LOAD_W,
+        soc_tolerance_pct: float = PLAN_SOC_TOLERANCE_PCT,
+        forecast_tolerance_w: float = PLAN_FORECAST_TOLERANCE_W,
+        plan_file: str = "",
+        clock: Callable[[], float] = time.time,
+        log: Optional[logging.LoggerAdapter] = None,
+    ):
+        """
+        Args:
+            forecast_file: CSV прогнозу (див. load_forecast())
+            min_current_a: Мінімальний струм зарядки (A)
+            max_current_a: Максимальний струм зарядки (A)
+            volts_per_amp: Потужність на 1 A струму (W/A)
+            capacity_kwh: Корисна ємність батареї (kWh)
+            min_soc: SOC, нижче якого зарядка не розряджає батарею (%)
+            step_sec: Крок плану (секунди)
+            horizon_sec: Горизонт плану (секунди)
+            default_load_w: Навантаження без колонки load_w у прогнозі (W)
+            soc_tolerance_pct: Відхилення SOC від плану для перерахунку (%)
+            forecast_tolerance_w: Зміна прогнозу для перерахунку (W)
+            plan_file: Файл для таблиці плану (порожньо = не записувати)
+            clock: Джерело часу Unix (прогноз прив'язаний до реального часу)
+            log: Логер об'єкта (None = загальний)
+        """
+        self.forecast_file = forecast_file
+        self.min_current_a = min_current_a
+        self.max_current_a = max_current_a
+        self.volts_per_amp = volts_per_amp
+        self.capacity_kwh = capacity_kwh
+        self.min_soc = min_soc
+        self.step_sec = step_sec
+        self.horizon_sec = horizon_sec
+        self.default_load_w = default_load_w
+        self.soc_tolerance_pct = soc_tolerance_pct
+        self.forecast_tolerance_w = forecast_tolerance_w
+        self.plan_file = plan_file
+        self.clock = clock
+        self.log = log if log is not None else logger
+
+        self.plan: Optional[ChargePlan] = None
+        self.reasons: list[str] = []
+        self._forecast: Optional[tuple] = None
+        self._forecast_mtime: Optional[int] = None
+        # Прогноз не покриває поточний момент: наступна спроба не раніше
+        # (math.inf - лише після зміни файлу прогнозу)
+        self._retry_at = 0.0
+
+    def lookup(self, battery_soc: float) -> Optional[int]:
+        """
+        Дозволений струм для поточного моменту (A, 0 = не заряджати).
+
+        Args:
+            battery_soc: Фактичний SOC батареї (%)
+
+        Returns:
+            Струм з плану або None, якщо дійсного плану немає
+        """
+        now = self.clock()
+        reason = self._replan_reason(now, battery_soc)
+        if reason is not None:
+            self.replan(now, battery_soc, reason)
+        index = None if self.plan is None else self.plan.index(now)
+        if index is None:
+            self.reasons = []
+            return None
+        plan = self.plan
+        allowed = plan.current_a[index]
+        self.reasons = [
+            f"План ({plan.reason}, {time.strftime('%H:%M', time.localtime(plan.created_at))}): "
+            f"крок до {time.strftime('%H:%M', time.localtime(plan.start + (index + 1) * plan.step_sec))}, "
+            + (f"дозволено {allowed}A" if allowed else "зарядка не дозволена"),
+            f"SOC фактичний {battery_soc:.1f}%, плановий {plan.soc_at(now, index):.1f}%",
+        ]
+        return allowed
+
+    def _replan_reason(self, now: float, battery_soc: float) -> Optional[str]:
+        """Причина перерахунку плану (None - план дійсний або прогнозу немає)."""
+        forecast_changed = self._refresh_forecast()
+        if self._forecast is None:
+            return None
+        if self.plan is None:
+            return "start" if forecast_changed or now >= self._retry_at else None
+        index = self.plan.index(now)
+        if index is None:
+            return "expired" if forecast_changed or now >= self._retry_at else None
+        if forecast_changed:
+            remaining = len(self.plan.net_w) - index
+            net = self._forecast_net(self.plan.start + index * self.plan.step_sec, remaining)
+            deviation = max(abs(new - old) for new, old in zip(net, self.plan.net_w[index:]))
+            if deviation > self.forecast_tolerance_w:
+                return "forecast"
+            self.log.info(f"Прогноз оновлено, відхилення {deviation:.0f}W - план без змін")
+        if abs(battery_soc - self.plan.soc_at(now, index)) > self.soc_tolerance_pct:
+            return "soc"
+        return None
+
+    def _refresh_forecast(self) -> bool:
+        """Перечитує файл прогнозу, якщо він змінився (True - новий прогноз)."""
+        try:
+            mtime: Optional[int] = os.stat(self.forecast_file).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._forecast_mtime:
+            return False
+        self._forecast_mtime = mtime
+        if mtime is None:
+            self.log.warning(f"Файл прогнозу {self.forecast_file} недоступний; діє поточний план")
+            return False
+        try:
+            self._forecast = load_forecast(self.forecast_file)
+        except (OSError, ValueError) as e:
+            self.log.error(f"Прогноз {self.forecast_file} не завантажено: {e}; діє попередній")
+            return False
+        self._retry_at = 0.0
+        return True
+
+    def _forecast_net(self, start: float, count: int) -> array:
+        """PV мінус навантаження за прогнозом на сітці плану (W)."""
+        pv, load = self._forecast
+        net = resample_series(pv, start, self.step_sec, count)
+        if load is None:
+            for i in range(count):
+                net[i] -= self.default_load_w
+        else:
+            for i, load_w in enumerate(resample_series(load, start, self.step_sec, count)):
+                net[i] -= load_w
+        return net
+
+    def replan(self, now: float, battery_soc: float, reason: str):
+        """
+        Розраховує таблицю від поточного кроку до кінця горизонту або прогнозу.
+
+        Args:
+            now: Поточний час (Unix)
+            battery_soc: Фактичний SOC батареї (%)
+            reason: Причина (start, forecast, soc, expired) - мітка метрики
+        """
+        started = time.perf_counter()
+        pv = self._forecast[0]
+        start = now - now % self.step_sec
+        count = int((min(start + self.horizon_sec, pv[-1][0]) - start) // self.step_sec)
+        if start < pv[0][0] or count <= 0:
+            self.plan = None
+            self._retry_at = pv[0][0] if start < pv[0][0] else math.inf
+            self.log.warning(
+                f"Прогноз {self.forecast_file} не покриває поточний момент - "
+                f"рішення за пороговим правилом"
+            )
+            return
+        net = self._forecast_net(start, count)
+        current, soc = plan_charge_current(
+            battery_soc,
+            net,
+            self.step_sec,
+            self.capacity_kwh,
+            self.min_soc,
+            self.min_current_a,
+            self.max_current_a,
+            self.volts_per_amp,
+        )
+        self.plan = ChargePlan(start, self.step_sec, current, soc, net, reason, created_at=now)
+        duration = time.perf_counter() - started
+        PLAN_RUNS[reason].inc()
+        PLAN_SECONDS.observe(duration)
+
+        charging_steps = sum(1 for amps in current if amps)
+        energy_kwh = sum(current) * self.volts_per_amp * self.step_sec / 3600.0 / 1000.0
+        self.log.info(
+            f"План зарядки ({reason}): {count} кроків по {self.step_sec:.0f} сек, "
+            f"зарядка {charging_steps * self.step_sec / 3600.0:.1f} год ({energy_kwh:.1f} kWh), "
+            f"SOC {battery_soc:.0f}% → мін. {min(soc):.0f}% → {soc[-1]:.0f}%, "
+            f"розрахунок {duration * 1000:.1f} мс"
+        )
+        if self.plan_file:
+            self.write(self.plan_file)
+
+    def write(self, path: str):
+        """Атомарно записує таблицю плану (тимчасовий файл + os.replace)."""
+        tmp_path = f"{path}.tmp"
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.plan.to_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.log.error(f"Не вдалося записати план {path}: {e}")
+
+
+# ============================================================
+# Основна логіка керування
+# ============================================================
+
+
+async def _test_inverter_connection(inverter: AsyncDeyeInverter, connect: bool = True) -> bool:
+    """
+    Тестове підключення до Deye інвертора. Повертає True при успіху.
+
+    connect=False - лише тестове читання (клієнт уже використовується циклом).
+    """
+    try:
+        logger.info("Тестове підключення до Deye інвертора...")
+        if connect:
+            await inverter.connect()
+        test_state = await inverter.get_battery_and_grid_state()
+        logger.info("Deye інвертор: Підключення УСПІШНЕ")
+        logger.info(f"  Поточний SOC: {test_state['battery_soc_pct']:.1f}%")
+        logger.info(
+            f"  Потужність мережі: {test_state['grid_power_w']:.0f}W ({test_state['grid_direction']})"
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Deye інвертор: Підключення НЕВДАЛЕ - {e}")
+        logger.error("Неможливо продовжити роботу без доступу до інвертора")
+        return False
+
+
+async def _test_charger_connection(charger: AsyncFeyreeCharger) -> bool:
+    """Тестове підключення до Feyree зарядки. Повертає True при успіху."""
+    try:
+        logger.info("Тестове підключення до Feyree зарядки...")
+        test_status = await charger.get_status()
+        if test_status:
+            logger.info("Feyree зарядка: Підключення УСПІШНЕ")
+            if "dps" in test_status:
+                # Показуємо поточний стан головного перемикача (якщо доступний)
+                switch_state = test_status["dps"].get(
+                    str(FEYREE_SWITCH_DPS), "невідомо"
+                )
+                work_mode = test_status["dps"].get(str(FEYREE_MODE_DPS), "невідомо")
+                logger.info(f"  Стан: {'ВВІМК' if switch_state else 'ВИМК'}")
+                logger.info(f"  Режим: {work_mode}")
+        else:
+            logger.warning(
+                "Feyree зарядка: Підключення встановлено, але не отримано статус"
+            )
+            logger.warning("Продовжуємо роботу, але можливі проблеми з керуванням")
+        return True
+    except Exception as e:
+        logger.error(f"Feyree зарядка: Підключення НЕВДАЛЕ - {e}")
+        logger.error("Неможливо продовжити роботу без доступу до зарядки")
+        return False
+
+
+# ============================================================
+# HTTP API стану
+# ============================================================
+
+
+class StateStore:
+    """
+    Останній стан кожного об'єкта в пам'яті для HTTP API.
+
+    Цикл керування публікує документ об'єкта після ітерації; JSON
+    серіалізується один раз при публікації, тому запити клієнтів не
+    звертаються до пристроїв і лише віддають готові байти. Ресурс ""
+    (усі об'єкти) та ресурс кожного об'єкта мають власний ETag, який
+    змінюється разом із вмістом. Усі методи викликаються в потоці event loop.
+    """
+
+    def __init__(self):
+        # Версії починаються з нуля після перезапуску - префікс відрізняє запуски
+        self._boot = f"{time.time_ns():x}"
+        self._version = 0
+        # ресурс -> (ETag, тіло JSON)
+        self._resources: Dict[str, tuple[str, bytes]] = {}
+        self._changed = asyncio.Event()
+        self._render_all()
+
+    def _render_all(self):
+        parts = [
+            json.dumps(site, ensure_ascii=False).encode() + b": " + body
+            for site, (_, body) in self._resources.items()
+            if site
+        ]
+        body = b'{"sites": {' + b", ".join(parts) + b"}}"
+        self._resources[""] = (f'"{self._boot}-{self._version}"', body)
+
+    def publish(self, site: str, document: Dict) -> bool:
+        """
+        Замінює стан об'єкта та будить клієнтів, що очікують змін.
+
+        Returns:
+            True, якщо вміст змінився
+        """
+        body = json.dumps(document, ensure_ascii=False, default=str).encode()
+        current = self._resources.get(site)
+        if current is not None and current[1] == body:
+            return False
+        self._version += 1
+        self._resources[site] = (f'"{self._boot}-{self._version}"', body)
+        self._render_all()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+        return True
+
+    def get(self, resource: str) -> Optional[tuple[str, bytes]]:
+        """(ETag, тіло) ресурсу або None для невідомого об'єкта."""
+        return self._resources.get(resource)
+
+    async def wait_for_change(self, resource: str, etag: str, timeout: float) -> bool:
+        """
+        Чекає, доки ETag ресурсу відрізнятиметься від etag.
+
+        Returns:
+            True, якщо стан змінився до завершення timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            current = self._resources.get(resource)
+            if current is None or current[0] != etag:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Перевіряє заголовок If-None-Match (список ETag, W/ або *)."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+async def start_state_server(
+    store: StateStore,
+    host: str = STATE_API_HOST,
+    port: int = STATE_API_PORT,
+    max_wait_sec: float = STATE_API_MAX_WAIT_SEC,
+) -> asyncio.base_events.Server:
+    """
+    Запускає HTTP API стану у поточному event loop.
+
+    GET /state - усі об'єкти, GET /state/<об'єкт> - один об'єкт (HEAD - лише
+    заголовки). Запит з
+    If-None-Match, що збігається з поточним ETag, отримує 304; з параметром
+    ?wait=N такий запит чекає на зміну стану до N секунд (не більше
+    max_wait_sec) і відповідає 200 з новим станом або 304 після timeout.
+
+    Returns:
+        asyncio Server (закривається викликом close())
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, query, headers = await read_http_request(reader)
+            resource = None
+            if path in ("/state", "/state/"):
+                resource = ""
+            elif path.startswith("/state/"):
+                resource = urllib.parse.unquote(path[len("/state/"):])
+            current = (
+                store.get(resource) if method in ("GET", "HEAD") and resource is not None else None
+            )
+            if current is None:
+                writer.write(
+                    http_response("404 Not Found", b"Not Found\n", "text/plain; charset=utf-8")
+                )
+                await writer.drain()
+                return
+
+            if_none_match = headers.get("if-none-match")
+            if _etag_matches(if_none_match, current[0]) and "wait" in query:
+                try:
+                    wait_sec = min(max(float(query["wait"]), 0.0), max_wait_sec)
+                except ValueError:
+                    wait_sec = 0.0
+                STATE_API_WAITING.inc()
+                try:
+                    await store.wait_for_change(resource, current[0], wait_sec)
+                finally:
+                    STATE_API_WAITING.inc(-1)
+                current = store.get(resource)
+
+            etag, body = current
+            response_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if _etag_matches(if_none_match, etag):
+                STATE_API_NOT_MODIFIED.inc()
+                response = http_response("304 Not Modified", b"", "", response_headers)
+            else:
+                STATE_API_OK.inc()
+                response = http_response(
+                    "200 OK", body, "application/json; charset=utf-8", response_headers
+                )
+                if method == "HEAD":
+                    response = response[: len(response) - len(body)]
+            writer.write(response)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# ============================================================
+# Кілька об'єктів: конфігурація, пул пристроїв, планувальник
+# ============================================================
+
+
+@dataclass
+class SiteSettings:
+    """Параметри керування об'єктом (за замовчуванням - з ENV)."""
+
+    check_interval_sec: float = CHECK_INTERVAL_SEC
+    control_mode: str = CONTROL_MODE
+    soc_threshold: float = SOC_THRESHOLD
+    soc_off_threshold: float = SOC_OFF_THRESHOLD
+    grid_import_threshold: float = GRID_IMPORT_THRESHOLD
+    grid_import_off_threshold: float = GRID_IMPORT_OFF_THRESHOLD
+    charging_current_a: int = CHARGING_CURRENT_A
+    forecast_file: str = FORECAST_FILE
+
+    @classmethod
+    def env_defaults(cls) -> Dict:
+        """Поточні глобальні значення (після перезавантаження налаштувань - нові)."""
+        return {
+            "check_interval_sec": CHECK_INTERVAL_SEC,
+            "control_mode": CONTROL_MODE,
+            "soc_threshold": SOC_THRESHOLD,
+            "soc_off_threshold": SOC_OFF_THRESHOLD,
+            "grid_import_threshold": GRID_IMPORT_THRESHOLD,
+            "grid_import_off_threshold": GRID_IMPORT_OFF_THRESHOLD,
+            "charging_current_a": CHARGING_CURRENT_A,
+            "forecast_file": FORECAST_FILE,
+        }
+
+    @classmethod
+    def from_options(cls, options: Dict) -> "SiteSettings":
+        """
+        Створює параметри з перевизначень у конфігурації об'єкта.
+
+        Пороги вимкнення, не задані явно, зсуваються разом з порогами
+        увімкнення так само, як у глобальних налаштуваннях.
+        """
+        unknown = set(options) - set(cls.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"Невідомі параметри об'єкта: {', '.join(sorted(unknown))}")
+        settings = cls(**{**cls.env_defaults(), **options})
+        if "soc_threshold" in options and "soc_off_threshold" not in options:
+            settings.soc_off_threshold = settings.soc_threshold - (
+                SOC_THRESHOLD - SOC_OFF_THRESHOLD
+            )
+        if "grid_import_threshold" in options and "grid_import_off_threshold" not in options:
+            ratio = GRID_IMPORT_OFF_THRESHOLD / GRID_IMPORT_THRESHOLD if GRID_IMPORT_THRESHOLD else 2
+            settings.grid_import_off_threshold = settings.grid_import_threshold * ratio
+        settings.control_mode = settings.control_mode.strip().lower()
+        if settings.control_mode not in ("threshold", "surplus", "plan"):
+            raise ValueError(
+                f"Невідомий control_mode: {settings.control_mode} (threshold, surplus або plan)"
+            )
+        return settings
+
+
+def env_sites_config() -> Dict:
+    """Конфігурація одного об'єкта з ENV (режим за замовчуванням)."""
+    inverter = {
+        "address": LOGGER_IP,
+        "serial": LOGGER_SN,
+        "port": LOGGER_PORT,
+        "mb_slave_id": MB_SLAVE_ID,
+    }
+    if PROXY_V5_PORT or PROXY_MODBUS_PORT:
+        inverter["proxy"] = {"v5_port": PROXY_V5_PORT, "modbus_port": PROXY_MODBUS_PORT}
+    return {
+        "inverters": {"deye": inverter},
+        "chargers": {
+            "feyree": {
+                "device_id": FEYREE_DEVICE_ID,
+                "address": FEYREE_IP,
+                "local_key": FEYREE_LOCAL_KEY,
+                "version": FEYREE_VERSION,
+                "port": FEYREE_PORT,
+            }
+        },
+        "sites": {
+            "default": {
+                "inverter": "deye",
+                "chargers": ["feyree"],
+                "history_file": HISTORY_FILE,
+            }
+        },
+    }
+
+
+def load_sites_config(path: str) -> Dict:
+    """
+    Завантажує конфігурацію кількох об'єктів з JSON файлу.
+
+    Формат:
+        {
+          "history_dir": "/app/data",
+          "inverters": {"<назва>": {"address": ..., "serial": ..., "port": 8899,
+                                    "mb_slave_id": 1, "register_map": "<json>",
+                                    "proxy": {"v5_port": 8899, "modbus_port": 502,
+                                              "host": "0.0.0.0", "cache_ttl_sec": 5}}},
+          "chargers": {"<назва>": {"address": ..., "device_id": ..., "local_key": ...,
+                                   "version": "3.3", "port": 6668}},
+          "sites": {"<назва>": {"inverter": "<назва>", "chargers": ["<назва>", ...],
+                                "soc_threshold": 90, ...}}
+        }
+
+    Raises:
+        ValueError: Якщо конфігурація некоректна
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    for section in ("inverters", "chargers", "sites"):
+        if not isinstance(config.get(section), dict) or not config[section]:
+            raise ValueError(f"{path}: розділ '{section}' відсутній або порожній")
+    for name, site in config["sites"].items():
+        if site.get("inverter") not in config["inverters"]:
+            raise ValueError(f"Об'єкт {name}: невідомий інвертор {site.get('inverter')}")
+        chargers = site.get("chargers") or []
+        if not chargers:
+            raise ValueError(f"Об'єкт {name}: не вказано жодної зарядки")
+        for charger in chargers:
+            if charger not in config["chargers"]:
+                raise ValueError(f"Об'єкт {name}: невідома зарядка {charger}")
+    return config
+
+
+class DevicePool:
+    """
+    Спільний пул пристроїв для всіх об'єктів.
+
+    Інвертори та зарядки створюються один раз за назвою, тому об'єкти з
+    одним інвертором використовують одне з'єднання та одне фонове
+    опитування. Виклики tinytuya всіх зарядок виконуються у спільному пулі
+    потоків обмеженого розміру замість окремого потоку на кожну зарядку.
+    """
+
+    def __init__(self, tuya_workers: int = 1):
+        """
+        Args:
+            tuya_workers: Кількість потоків для викликів tinytuya
+        """
+        self.inverters: Dict[str, AsyncDeyeInverter] = {}
+        self.chargers: Dict[str, AsyncFeyreeCharger] = {}
+        self.samplers: Dict[str, InverterSampler] = {}
+        self._register_maps: Dict[str, RegisterMap] = {}
+        self._proxy_config: Dict[str, Dict] = {}
+        self.proxies: Dict[str, SolarmanProxy] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, tuya_workers), thread_name_prefix="feyree-io"
+        )
+        self.discovery = TuyaDiscovery(TuyaAddressCache())
+
+    def add_inverter(
+        self, name: str, register_map: str = "", proxy: Optional[Dict] = None, **params
+    ) -> AsyncDeyeInverter:
+        """
+        Створює інвертор (params - аргументи AsyncDeyeInverter).
+
+        Карта регістрів завантажується один раз на файл і спільна для всіх
+        інверторів з нею (порожньо = карта з REGISTER_MAP_FILE або вбудована).
+        proxy - порти проксі logger (v5_port, modbus_port, host, cache_ttl_sec),
+        що відкриваються в start_proxies().
+        """
+        if proxy:
+            unknown = set(proxy) - {"v5_port", "modbus_port", "host", "cache_ttl_sec"}
+            if unknown:
+                raise ValueError(f"Інвертор {name}: невідомі параметри proxy: {', '.join(sorted(unknown))}")
+            self._proxy_config[name] = proxy
+        if register_map not in self._register_maps:
+            self._register_maps[register_map] = (
+                RegisterMap.from_file(register_map) if register_map else load_register_map()
+            )
+        self.inverters[name] = AsyncDeyeInverter(
+            register_map=self._register_maps[register_map], **params
+        )
+        return self.inverters[name]
+
+    def add_charger(self, name: str, **params) -> AsyncFeyreeCharger:
+        """
+        Створює зарядку (params - аргументи FeyreeCharger).
+
+        Якщо зарядку раніше знайдено за іншою адресою, підключення одразу
+        йде за адресою з кешу TuyaAddressCache.
+        """
+        configured = params.get("address", FEYREE_IP)
+        cached = self.discovery.cache.lookup(params.get("device_id", FEYREE_DEVICE_ID), configured)
+        if cached is not None:
+            logger.info(f"Зарядка {name}: адреса з кешу {cached['ip']} (у конфігурації {configured})")
+            params = {**params, "address": cached["ip"], "version": cached["version"]}
+        self.chargers[name] = AsyncFeyreeCharger(
+            FeyreeCharger(**params), executor=self._executor
+        )
+        self.discovery.watch(self.chargers[name], configured)
+        return self.chargers[name]
+
+    def sampler(self, name: str, interval_sec: float, import_threshold: float) -> InverterSampler:
+        """Фонове опитування інвертора (одне на інвертор, запускається один раз)."""
+        if name not in self.samplers:
+            sampler = InverterSampler(
+                self.inverters[name],
+                interval_sec=interval_sec,
+                import_threshold=import_threshold,
+            )
+            self.samplers[name] = sampler
+            self.start_task(sampler.run(), f"inverter-sampler-{name}")
+            logger.info(
+                f"Опитування інвертора {name} кожні {interval_sec} сек "
+                f"(вікно {SAMPLE_WINDOW_SEC} сек, EMA {GRID_EMA_TAU_SEC} сек)"
+            )
+        return self.samplers[name]
+
+    def start_task(self, coro, name: str) -> asyncio.Task:
+        """Фонова задача, що скасовується при close()."""
+        task = asyncio.create_task(coro, name=name)
+        self._tasks.append(task)
+        return task
+
+    async def start_proxies(self):
+        """Відкриває порти проксі logger для інверторів з параметром proxy."""
+        for name, config in self._proxy_config.items():
+            proxy = SolarmanProxy(
+                self.inverters[name],
+                RegisterCache(float(config.get("cache_ttl_sec", PROXY_CACHE_TTL_SEC))),
+            )
+            self.proxies[name] = proxy
+            await proxy.start(
+                config.get("host", PROXY_HOST),
+                int(config.get("v5_port", 0)),
+                int(config.get("modbus_port", 0)),
+            )
+
+    async def start_discovery(self):
+        """Запускає пошук зарядок за UDP broadcast (FEYREE_DISCOVERY)."""
+        if FEYREE_DISCOVERY and self.chargers:
+            await self.discovery.start()
+
+    def open_inverters(self):
+        """
+        Підключає інвертори у фоні (теплий старт). Якщо підключення не
+        вдалося, перше читання перепідключається звичайним механізмом повторів.
+        """
+        for name, inverter in self.inverters.items():
+            if inverter.client is None:
+                inverter._connect()
+                self.start_task(inverter.connect_exclusive(), f"inverter-connect-{name}")
+
+    async def check_connections(self, connect_inverters: bool = True) -> bool:
+        """Паралельна перевірка підключення до всіх пристроїв."""
+        results = await asyncio.gather(
+            *(
+                _test_inverter_connection(inverter, connect=connect_inverters)
+                for inverter in self.inverters.values()
+            ),
+            *(_test_charger_connection(charger) for charger in self.chargers.values()),
+        )
+        return all(results)
+
+    async def close(self):
+        """Зупиняє фонові задачі та закриває всі з'єднання."""
+        for proxy in self.proxies.values():
+            proxy.close()
+        self.discovery.close()
+        for task in self._tasks:
+            task.cancel()
+        for inverter in self.inverters.values():
+            try:
+                await inverter.disconnect()
+            except Exception as e:
+                logger.warning(f"Помилка закриття з'єднання з інвертором: {e}")
+        for charger in self.chargers.values():
+            charger.close()
+        self._executor.shutdown(wait=True)
+
+
+class IterationEventLog:
+    """
+    Структуровані записи ітерацій для LOG_FORMAT=json.
+
+    Запис об'єкта пишеться лише коли змінився його стан (SOC з кроком 1%,
+    напрям мережі, стан, рішення та команди зарядок, помилка, застарілі
+    дані) або минуло heartbeat_sec від попереднього запису. Словник полів
+    серіалізується в потоці логування, а не в циклі керування.
+    """
+
+    def __init__(
+        self,
+        heartbeat_sec: float = LOG_HEARTBEAT_SEC,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.heartbeat_sec = heartbeat_sec
+        self.clock = clock
+        # site -> (ключ стану, час запису, пропущено ітерацій)
+        self._last: Dict[str, tuple] = {}
+
+    @staticmethod
+    def _change_key(info: Dict) -> tuple:
+        soc = info.get("battery_soc_pct")
+        return (
+            None if soc is None else int(soc),
+            info.get("grid_direction"),
+            info.get("stale_age_sec") is not None,
+            info.get("error"),
+            tuple(
+                (
+                    name,
+                    unit.get("state"),
+                    unit.get("want_charge"),
+                    unit.get("command"),
+                    unit.get("command_ok"),
+                    unit.get("suppressed"),
+                    unit.get("current_a"),
+                )
+                for name, unit in info["chargers"].items()
+            ),
+        )
+
+    def record(self, info: Dict) -> bool:
+        """
+        Пише запис ітерації, якщо стан змінився або настав heartbeat.
+
+        Args:
+            info: Словник ітерації з SiteController.run_iteration()
+
+        Returns:
+            True, якщо запис зроблено
+        """
+        site = info["site"]
+        key = self._change_key(info)
+        now = self.clock()
+        last_key, last_at, skipped = self._last.get(site, (None, -math.inf, 0))
+        if key == last_key and now - last_at < self.heartbeat_sec:
+            self._last[site] = (last_key, last_at, skipped + 1)
+            return False
+        self._last[site] = (key, now, 0)
+
+        fields = {
+            "site": site,
+            "iteration": info["iteration"],
+            "heartbeat": key == last_key,
+            "skipped": skipped,
+            "duration_ms": round(info["duration_sec"] * 1000, 1),
+        }
+        for name in ("battery_soc_pct", "grid_power_w", "grid_direction", "stale_age_sec", "error"):
+            if info.get(name) is not None:
+                fields[name] = info[name]
+        fields["chargers"] = {
+            name: {k: v for k, v in unit.items() if k != "decided_at"}
+            for name, unit in info["chargers"].items()
+        }
+        events.info("iteration", extra={"fields": fields})
+        return True
+
+
+class _PrefixLogger(logging.LoggerAdapter):
+    """Додає префікс об'єкта до повідомлень (порожній в режимі одного об'єкта)."""
+
+    def process(self, msg, kwargs):
+        return f"{self.extra['prefix']}{msg}", kwargs
+
+
+@dataclass
+class ChargerUnit:
+    """Зарядка об'єкта разом з її автоматом, історією та метриками."""
+
+    name: str
+    charger: AsyncFeyreeCharger
+    state_machine: ChargeStateMachine
+    history: TelemetryHistory
+    start_current_a: int
+    state_gauge: Gauge
+    current_gauge: Gauge
+    log: logging.LoggerAdapter
+    surplus: Optional[SurplusCurrentController] = None
+    # План зарядки за прогнозом (None = порогове правило)
+    planner: Optional[ChargePlanner] = None
+    # Останній відомий кеш DPS та обґрунтування рішення (для HTTP API стану)
+    dps: Dict[str, object] = field(default_factory=dict)
+    reasons: list[str] = field(default_factory=list)
+    # Облік сесій зарядки (None = журнал сесій вимкнено)
+    session: Optional[SessionTracker] = None
+
+
+class SiteController:
+    """
+    Цикл керування одного об'єкта: інвертор та одна або кілька зарядок.
+
+    Ітерація одночасно зчитує інвертор та статуси всіх зарядок, після чого
+    кожна зарядка приймає рішення власним автоматом гістерезису. Момент
+    запуску ітерацій визначає спільний планувальник run_sites().
+    """
+
+    def __init__(
+        self,
+        name: str,
+        inverter: AsyncDeyeInverter,
+        units: list[ChargerUnit],
+        settings: SiteSettings,
+        sampler: Optional[InverterSampler] = None,
+        soc_gauge: Gauge = BATTERY_SOC,
+        grid_gauge: Gauge = GRID_POWER,
+        log_prefix: str = "",
+        event_log: Optional["IterationEventLog"] = None,
+        state_store: Optional[StateStore] = None,
+    ):
+        self.name = name
+        self.inverter = inverter
+        self.units = units
+        self.settings = settings
+        self.sampler = sampler
+        self.soc_gauge = soc_gauge
+        self.grid_gauge = grid_gauge
+        self.log = _PrefixLogger(logger, {"prefix": log_prefix})
+        self.event_log = event_log
+        self.state_store = state_store
+        if state_store is not None:
+            state_store.publish(name, {"site": name, "iteration": 0, "chargers": {}})
+
+        self.iteration = 0
+        # Планові ітерації на сітці check_interval_sec (позачергові її не зсувають)
+        self.ticker = FixedRateTicker(settings.check_interval_sec, "control")
+        self.phase_overruns: Dict[str, int] = {phase: 0 for phase in PHASE_DEADLINES}
+        self.wake_requested = False
+        self._scheduler_wake: Optional[asyncio.Event] = None
+        # Останні успішно зчитані дані інвертора (для роботи при його недоступності)
+        self._last_state: Optional[Dict] = None
+        self._last_state_at: Optional[float] = None
+
+    def request_wake(self):
+        """Запит позачергової ітерації (викликається в потоці event loop)."""
+        self.wake_requested = True
+        if self._scheduler_wake is not None:
+            self._scheduler_wake.set()
+
+    def start_listeners(self):
+        """Запускає слухачів push-повідомлень зарядок об'єкта."""
+        loop = asyncio.get_running_loop()
+        for unit in self.units:
+            if unit.charger.charger.listener is None:
+                unit.charger.start_listener(
+                    on_change=lambda code, old, new: loop.call_soon_threadsafe(self.request_wake)
+                )
+                unit.log.info(
+                    f"Слухач push-повідомлень Feyree запущено (heartbeat: {FEYREE_HEARTBEAT_SEC} сек)"
+                )
+
+    def _account_phase(self, phase: str, duration: float):
+        """Записує тривалість фази та фіксує перевищення її дедлайну."""
+        CONTROL_PHASE_SECONDS[phase].observe(duration)
+        deadline = PHASE_DEADLINES[phase]
+        if duration > deadline:
+            CONTROL_PHASE_OVERRUNS[phase].inc()
+            self.phase_overruns[phase] += 1
+            self.log.warning(
+                f"Фаза {phase} тривала {duration:.2f} сек (дедлайн {deadline:.2f} сек)"
+            )
+
+    async def run_iteration(self, lateness_sec: Optional[float] = None) -> Dict:
+        """
+        Одна ітерація керування об'єктом.
+
+        Args:
+            lateness_sec: Запізнення планового тику (None = позачергова ітерація)
+
+        Returns:
+            Словник iteration, site, duration_sec, lateness_sec, phases
+            ({фаза: секунди}) та chargers ({назва: decided_at, command,
+            command_ok}); для об'єкта з однією зарядкою ключі зарядки також
+            на верхньому рівні
+        """
+        log = self.log
+        verbose = log.isEnabledFor(logging.INFO)
+        self.iteration += 1
+        iteration_started = time.monotonic()
+        iteration_info: Dict = {
+            "iteration": self.iteration,
+            "site": self.name,
+            "decided_at": None,
+            "command": None,
+            "command_ok": False,
+            "chargers": {},
+            "lateness_sec": lateness_sec,
+            "phases": {},
+        }
+        log.info("-" * 60)
+        log.info(f"Ітерація #{self.iteration} - {time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        try:
+            # Крок 1: Одночасне отримання даних з інвертора та зарядок
+            # (при активному слухачі статус зарядки береться з кешу)
+            log.info("Читання даних з Deye інвертора та Feyree зарядки...")
+            state, *statuses = await asyncio.gather(
+                PROFILER.timed("inverter", self._read_state()),
+                *(PROFILER.timed("status", unit.charger.get_status()) for unit in self.units),
+                return_exceptions=True,
+            )
+            iteration_info["phases"]["sample"] = time.monotonic() - iteration_started
+            stale_age: Optional[float] = None
+            if isinstance(state, BaseException):
+                state, stale_age = await self._fallback_state(state, statuses)
+            else:
+                self._last_state, self._last_state_at = state, time.monotonic()
+            iteration_info["stale_age_sec"] = stale_age
+
+            battery_soc: float = float(state["battery_soc_pct"])
+            grid_power: float = float(state["grid_power_w"])
+            grid_direction: str = str(state["grid_direction"])
+            self.soc_gauge.set(battery_soc)
+            self.grid_gauge.set(grid_power)
+            iteration_info["battery_soc_pct"] = battery_soc
+            iteration_info["grid_power_w"] = grid_power
+            iteration_info["grid_direction"] = grid_direction
+
+            import_above_sec: Optional[float] = state.get("import_above_sec")
+
+            if verbose:
+                log.info("Стан системи:" if stale_age is None else f"Стан системи ({stale_age:.0f} сек тому):")
+                log.info(f"  - Батарея: {battery_soc:.1f}%")
+                log.info(f"  - Мережа: {grid_power:.0f}W ({grid_direction})")
+            snapshot = self.inverter.last_snapshot
+            if verbose and snapshot is not None:
+                details = [
+                    f"{label} {value:.0f}W"
+                    for label, value in (
+                        ("PV", snapshot.pv_power_w),
+                        ("навантаження", snapshot.load_power_w),
+                        ("батарея", snapshot.battery_power_w),
+                    )
+                    if value is not None
+                ]
+                if details:
+                    log.info(f"  - {', '.join(details)}")
+            if verbose and import_above_sec is not None:
+                log.info(
+                    f"  - Вікно ({state['samples']} вибірок): остання {state['grid_power_raw_w']:.0f}W, "
+                    f"середня {state['grid_mean_w']:.0f}W, макс {state['grid_max_w']:.0f}W, "
+                    f"імпорт > {self.settings.grid_import_threshold}W: {import_above_sec:.0f} сек"
+                )
+
+            # Кроки 2-4 для кожної зарядки; команди різним зарядкам надсилаються паралельно
+            for unit, status_before in zip(self.units, statuses):
+                if isinstance(status_before, BaseException):
+                    unit.log.error(f"Помилка отримання статусу Feyree: {status_before}")
+            unit_results = await asyncio.gather(
+                *(
+                    self._control_unit(
+                        unit,
+                        None if isinstance(status_before, BaseException) else status_before,
+                        battery_soc,
+                        grid_power,
+                        grid_direction,
+                        import_above_sec,
+                        stale_age,
+                    )
+                    for unit, status_before in zip(self.units, statuses)
+                )
+            )
+            for unit, unit_info in zip(self.units, unit_results):
+                iteration_info["chargers"][unit.name] = unit_info
+            self._account_sessions(statuses, battery_soc, grid_power, grid_direction)
+            for phase in ("decide", "actuate"):
+                iteration_info["phases"][phase] = max(
+                    unit_info.pop(f"{phase}_sec") for unit_info in unit_results
+                )
+            if len(self.units) == 1:
+                iteration_info.update(unit_results[0])
+
+        except NoSocketAvailableError as e:
+            iteration_info["error"] = str(e)
+            log.error(f"З'єднання з інвертором закрите: {e}")
+            log.info("Спроба перепідключення в наступній ітерації...")
+        except V5FrameError as e:
+            iteration_info["error"] = str(e)
+            log.error(f"Помилка зв'язку з інвертором: {e}")
+        except Exception as e:
+            iteration_info["error"] = str(e)
+            log.error(f"Неочікувана помилка в циклі: {e}", exc_info=True)
+
+        iteration_info["duration_sec"] = time.monotonic() - iteration_started
+        CONTROL_ITERATION_SECONDS.observe(iteration_info["duration_sec"])
+        for phase, duration in iteration_info["phases"].items():
+            self._account_phase(phase, duration)
+        log.info(f"Тривалість ітерації: {iteration_info['duration_sec']:.2f} сек")
+        if self.event_log is not None:
+            self.event_log.record(iteration_info)
+        if self.state_store is not None:
+            self.state_store.publish(self.name, self.state_document(iteration_info))
+
+        # Зміни стану, спричинені власними командами ітерації, не потребують повторної перевірки
+        self.wake_requested = False
+        return iteration_info
+
+    def _account_sessions(
+        self, statuses: list, battery_soc: float, grid_power: float, grid_direction: str
+    ):
+        """
+        Облік сесій зарядки об'єкта за статусами ітерації.
+
+        Імпорт з мережі розподіляється між зарядками пропорційно їх
+        потужності: частка з мережі = min(1, імпорт / сумарна потужність
+        зарядок), решта енергії - власна генерація (PV або батарея).
+        """
+        observed = [
+            (unit, status["dps"])
+            for unit, status in zip(self.units, statuses)
+            if unit.session is not None and isinstance(status, dict) and "dps" in status
+        ]
+        if not observed:
+            return
+        now = time.time()
+        powers = [unit.session.measure(now, dps) for unit, dps in observed]
+        total_power = sum(powers)
+        import_w = grid_power if grid_direction == "import" else 0.0
+        grid_fraction = min(1.0, import_w / total_power) if total_power > 0 else 0.0
+        for (unit, dps), power in zip(observed, powers):
+            unit.session.commit(now, dps, battery_soc, power, grid_fraction)
+
+    def state_document(self, iteration_info: Dict) -> Dict:
+        """
+        Стан об'єкта для HTTP API: дані інвертора, кеш DPS зарядок та
+        останні рішення з обґрунтуванням. Будується з пам'яті без I/O.
+        """
+        snapshot = self.inverter.last_snapshot
+        document: Dict = {
+            "site": self.name,
+            "iteration": iteration_info["iteration"],
+            "updated_at": time.time(),
+            "duration_ms": round(iteration_info["duration_sec"] * 1000, 1),
+            "error": iteration_info.get("error"),
+            "stale_age_sec": iteration_info.get("stale_age_sec"),
+            "inverter": {
+                "battery_soc_pct": iteration_info.get("battery_soc_pct"),
+                "grid_power_w": iteration_info.get("grid_power_w"),
+                "grid_direction": iteration_info.get("grid_direction"),
+                "breaker": ("closed", "open", "half_open")[self.inverter.breaker.state],
+                "snapshot": None if snapshot is None else asdict(snapshot),
+            },
+            "chargers": {},
+        }
+        for unit in self.units:
+            unit_info = iteration_info["chargers"].get(unit.name, {})
+            document["chargers"][unit.name] = {
+                "state": unit_info.get("state"),
+                "current_a": unit_info.get("current_a"),
+                "energy_kwh": unit_info.get("energy_kwh"),
+                "dps": unit.dps,
+                "session": (
+                    None
+                    if unit.session is None or unit.session.session is None
+                    else asdict(unit.session.session)
+                ),
+                "decision": {
+                    "want_charge": unit_info.get("want_charge"),
+                    "command": unit_info.get("command"),
+                    "command_ok": unit_info.get("command_ok"),
+                    "suppressed": unit_info.get("suppressed"),
+                    "reasons": unit.reasons,
+                },
+            }
+        return document
+
+    async def _control_unit(
+        self,
+        unit: ChargerUnit,
+        status_before: Optional[Dict],
+        battery_soc: float,
+        grid_power: float,
+        grid_direction: str,
+        import_above_sec: Optional[float],
+        stale_age: Optional[float] = None,
+    ) -> Dict:
+        """
+        Кроки 2-4 ітерації для однієї зарядки. Повертає decided_at, command,
+        command_ok та тривалості фаз decide_sec / actuate_sec.
+
+        За застарілими даними інвертора (stale_age) зарядка не вмикається.
+        """
+        log = unit.log
+        verbose = log.isEnabledFor(logging.INFO)
+        charger = unit.charger
+        state_machine = unit.state_machine
+        unit_info: Dict = {"decided_at": None, "command": None, "command_ok": False}
+        decide_started = time.monotonic()
+
+        # Поточний стан пристрою (отриманий паралельно з інвертором)
+        charge_status = None
+        if status_before and "dps" in status_before:
+            unit.dps = dict(status_before["dps"])
+            charger.display_device_status(status_before, prefix=f"{log.extra['prefix']}[ДО]")
+            # Оновлюємо current_state з реального стану пристрою
+            actual_state = status_before.get("dps", {}).get(str(FEYREE_SWITCH_DPS), None)
+            charge_status = status_before.get("dps", {}).get("101", None)  # Реальний статус зарядки
+            if actual_state is not None:
+                charger.current_state = actual_state
+            # Струм, встановлений поза циклом (напр. після перезапуску)
+            device_current = status_before["dps"].get(str(FEYREE_CURRENT_DPS))
+            if FEYREE_CURRENT_DPS and device_current is not None:
+                charger.current_setpoint_a = int(device_current)
+
+        # Визначаємо чи зарядка вже відбувається (DPS 101 = "charing")
+        is_already_charging = bool(charge_status and "char" in str(charge_status).lower())
+        state_machine.observe(is_already_charging)
+
+        # Запис стану в історію телеметрії
+        if status_before is None:
+            charger_state_code = CHARGER_STATE_UNKNOWN
+        elif is_already_charging:
+            charger_state_code = CHARGER_STATE_CHARGING
+        else:
+            charger_state_code = CHARGER_STATE_ON if charger.current_state else CHARGER_STATE_OFF
+        unit.state_gauge.set(charger_state_code)
+        unit.current_gauge.set(
+            math.nan if charger.current_setpoint_a is None else charger.current_setpoint_a
+        )
+        energy_raw = (status_before or {}).get("dps", {}).get("102")
+        energy_kwh = float(energy_raw) / 1000.0 if energy_raw is not None else None
+        unit.history.append(
+            time.time(),
+            battery_soc,
+            grid_power,
+            charger_state_code,
+            charger.current_setpoint_a,
+            energy_kwh,
+        )
+        unit_info["state"] = charger_state_code
+        unit_info["current_a"] = charger.current_setpoint_a
+        unit_info["energy_kwh"] = energy_kwh
+
+        # Крок 2: Прийняття рішення (план за прогнозом або пороги; гістерезис + debounce)
+        planned_a = None if unit.planner is None else unit.planner.lookup(battery_soc)
+        if planned_a is not None:
+            decision = state_machine.decide(planned_a > 0, unit.planner.reasons)
+        else:
+            decision = state_machine.evaluate(battery_soc, grid_power, grid_direction, import_above_sec)
+            if unit.planner is not None:
+                PLAN_FALLBACK.inc()
+                decision.reasons.insert(0, "Немає дійсного плану - порогове правило")
+        if decision.command is True and stale_age is not None:
+            decision.command = None
+            decision.suppressed = f"дані інвертора застарілі ({stale_age:.0f} сек)"
+            state_machine.suppressed += 1
+        unit_info["decided_at"] = time.monotonic()
+        unit_info["decide_sec"] = unit_info["decided_at"] - decide_started
+        PROFILER.record_wall("decide", unit_info["decide_sec"])
+        unit_info["command"] = decision.command
+        unit_info["want_charge"] = decision.want_charge
+        unit_info["suppressed"] = decision.suppressed
+        unit.reasons = decision.reasons
+
+        if verbose:
+            log.info("Аналіз умов зарядки:")
+            for reason in decision.reasons:
+                log.info(f"  - {reason}")
+            log.info(f"Рішення: {'УВІМКНУТИ зарядку' if decision.want_charge else 'ВИМКНУТИ зарядку'}")
+
+        # Крок 3: Виконання команди
+        command_executed = False
+
+        if decision.command is True:
+            # Потрібно увімкнути зарядку (тільки якщо вона ще не заряджається)
+            command_executed = await charger.turn_on(planned_a or unit.start_current_a)
+            state_machine.record_command(True, command_executed)
+        elif decision.command is False:
+            # Потрібно вимкнути зарядку (тільки якщо вона заряджається)
+            command_executed = await charger.turn_off()
+            state_machine.record_command(False, command_executed)
+        elif (
+            planned_a
+            and FEYREE_CURRENT_DPS
+            and state_machine.is_on
+            and charger.current_setpoint_a not in (None, planned_a)
+        ):
+            # Зарядка триває, змінився лише дозволений планом струм
+            if await charger.set_current(planned_a):
+                unit_info["current_a"] = planned_a
+        elif decision.suppressed is not None:
+            log.info(f"Команду придушено: {decision.suppressed}")
+        else:
+            # Стан не змінився
+            if is_already_charging:
+                log.info(f"Зарядка вже відбувається (DPS 101 = {charge_status})")
+            else:
+                log.info(
+                    f"Стан зарядки не змінився (залишається: {'ВВІМК' if charger.current_state else 'ВИМК'})"
+                )
+
+        if verbose:
+            log.info(
+                f"Автомат: переходів {state_machine.transitions}, "
+                f"команд {state_machine.commands_sent}, придушено {state_machine.suppressed}"
+            )
+
+        # Крок 4: Команда вважається виконаною лише після підтвердження DPS
+        unit_info["command_ok"] = command_executed
+        unit_info["actuate_sec"] = time.monotonic() - unit_info["decided_at"]
+        if decision.command is not None:
+            PROFILER.record_wall("actuate", unit_info["actuate_sec"])
+        if command_executed:
+            log.info(f"Час від команди до підтвердження: {charger.last_command_latency_sec:.2f} сек")
+        return unit_info
+
+    async def _read_state(self) -> Dict[str, float | str]:
+        """Стан інвертора: з вибірок (import_above_sec за порогом цього об'єкта) або прямим читанням."""
+        if self.sampler is not None:
+            return await self.sampler.get_battery_and_grid_state(self.settings.grid_import_threshold)
+        return await self.inverter.get_battery_and_grid_state()
+
+    async def _fallback_state(
+        self, error: BaseException, statuses: list
+    ) -> tuple[Dict, float]:
+        """
+        Політика при недоступному інверторі.
+
+        Дані, не старші за STALE_READING_MAX_SEC, використовуються замість
+        свіжих. Якщо даних немає або вони старші, увімкнені зарядки
+        переводяться у безпечний стан (ВИМК, при STALE_SAFE_OFF), а помилка
+        передається далі.
+
+        Returns:
+            (останній стан інвертора, його вік у секундах)
+        """
+        age = None if self._last_state_at is None else time.monotonic() - self._last_state_at
+        if age is not None and age <= STALE_READING_MAX_SEC:
+            INVERTER_FALLBACK_CACHED.inc()
+            self.log.warning(f"Інвертор недоступний ({error}); рішення за даними {age:.0f} сек тому")
+            return self._last_state, age
+
+        if STALE_SAFE_OFF:
+            for unit, status in zip(self.units, statuses):
+                charger = unit.charger
+                if isinstance(status, dict) and "dps" in status:
+                    actual_state = status["dps"].get(str(FEYREE_SWITCH_DPS))
+                    if actual_state is not None:
+                        charger.current_state = actual_state
+                if not charger.current_state:
+                    continue
+                INVERTER_FALLBACK_SAFE_OFF.inc()
+                unit.log.warning(
+                    "Немає даних інвертора"
+                    + ("" if age is None else f" понад {STALE_READING_MAX_SEC:.0f} сек")
+                    + " - вимкнення зарядки (безпечний стан)"
+                )
+                command_executed = await charger.turn_off()
+                unit.state_machine.record_command(False, command_executed)
+        raise error
+
+    def export_state(self) -> Dict:
+        """Стан об'єкта для знімка теплого старту (без I/O)."""
+        snapshot = self.inverter.last_snapshot
+        return {
+            "last_state": self._last_state,
+            "last_state_age_sec": (
+                None if self._last_state_at is None else time.monotonic() - self._last_state_at
+            ),
+            "inverter_snapshot": None if snapshot is None else asdict(snapshot),
+            "chargers": {
+                unit.name: {
+                    "state_machine": unit.state_machine.export_state(),
+                    "current_state": unit.charger.current_state,
+                    "current_setpoint_a": unit.charger.current_setpoint_a,
+                    "dps": unit.dps,
+                }
+                for unit in self.units
+            },
+        }
+
+    def restore_state(self, state: Dict, elapsed_sec: float):
+        """
+        Відновлює стан зі знімка export_state().
+
+        Останні дані інвертора використовуються, як і при його
+        недоступності, лише поки вони не старші за STALE_READING_MAX_SEC.
+        """
+        age = state.get("last_state_age_sec")
+        if state.get("last_state") and age is not None:
+            self._last_state = state["last_state"]
+            self._last_state_at = time.monotonic() - (age + elapsed_sec)
+        if state.get("inverter_snapshot") and self.inverter.last_snapshot is None:
+            try:
+                self.inverter.last_snapshot = InverterSnapshot(**state["inverter_snapshot"])
+            except TypeError:
+                pass  # Знімок зі старою схемою полів
+        for unit in self.units:
+            unit_state = state.get("chargers", {}).get(unit.name)
+            if unit_state is None:
+                continue
+            unit.state_machine.restore_state(unit_state["state_machine"], elapsed_sec)
+            unit.charger.current_state = unit_state.get("current_state")
+            unit.charger.current_setpoint_a = unit_state.get("current_setpoint_a")
+            unit.dps = unit_state.get("dps") or {}
+
+    def close(self):
+        """Закриває історію зарядок об'єкта (з'єднання закриває DevicePool)."""
+        for unit in self.units:
+            unit.history.close()
+
+
+def _open_history(path: str, log: logging.LoggerAdapter) -> TelemetryHistory:
+    """Відкриває історію телеметрії; при помилці файлу - лише в пам'яті."""
+    try:
+        history = TelemetryHistory(path, HISTORY_CAPACITY)
+    except OSError as e:
+        log.error(f"Не вдалося відкрити файл історії {path}: {e}")
+        log.warning("Історія зберігається лише в пам'яті")
+        history = TelemetryHistory("", HISTORY_CAPACITY)
+    history_location = history.path or "лише в пам'яті"
+    log.info(
+        f"Історія телеметрії: {history_location}, "
+        f"{history.count}/{history.capacity} записів"
+    )
+    return history
+
+
+def build_sites(
+    config: Dict,
+    pool: DevicePool,
+    multi_site: bool,
+    state_store: Optional[StateStore] = None,
+    ledger: Optional[SessionLedger] = None,
+) -> list[SiteController]:
+    """
+    Створює пристрої в пулі та контролери об'єктів з конфігурації.
+
+    Args:
+        config: Конфігурація (env_sites_config() або load_sites_config())
+        pool: Пул пристроїв
+        multi_site: True = метрики з міткою site/charger та префікс у логах
+        state_store: Сховище стану для HTTP API (None = вимкнено)
+        ledger: Журнал сесій зарядки (None = вимкнено)
+
+    Raises:
+        ValueError: Некоректна конфігурація
+    """
+    for name, params in config["inverters"].items():
+        breaker = None
+        if multi_site:
+            breaker = CircuitBreaker(
+                name=f"Deye інвертор {name}",
+                state_gauge=METRICS.gauge("deye_breaker_state", DEYE_BREAKER_STATE.help, inverter=name),
+                opens=METRICS.counter("deye_breaker_opens_total", DEYE_BREAKER_OPENS.help, inverter=name),
+                rejected=METRICS.counter(
+                    "deye_breaker_rejected_total", DEYE_BREAKER_REJECTED.help, inverter=name
+                ),
+            )
+        pool.add_inverter(name, breaker=breaker, **params)
+    for name, params in config["chargers"].items():
+        pool.add_charger(name, **params)
+
+    settings_by_site = {
+        name: SiteSettings.from_options(
+            {k: v for k, v in site.items() if k not in ("inverter", "chargers", "history_file")}
+        )
+        for name, site in config["sites"].items()
+    }
+
+    # Одне фонове опитування на інвертор з найменшим потрібним інтервалом
+    # ("surplus" потребує вибірок не рідше за період регулятора); час імпорту
+    # вище порогу кожен об'єкт рахує з вікна за власним порогом
+    sample_intervals: Dict[str, float] = {}
+    for name, site in config["sites"].items():
+        settings = settings_by_site[name]
+        interval = SAMPLE_INTERVAL_SEC
+        if settings.control_mode == "surplus":
+            if not FEYREE_CURRENT_DPS:
+                raise ValueError("Режим surplus потребує FEYREE_CURRENT_DPS (напр. 115)")
+            if len(site["chargers"]) != 1:
+                raise ValueError(f"Об'єкт {name}: режим surplus підтримує лише одну зарядку")
+            if not 0 < interval <= SURPLUS_INTERVAL_SEC:
+                interval = SURPLUS_INTERVAL_SEC
+        elif settings.control_mode == "plan":
+            if not settings.forecast_file:
+                raise ValueError(f"Об'єкт {name}: режим plan потребує FORECAST_FILE")
+            if len(site["chargers"]) != 1:
+                raise ValueError(f"Об'єкт {name}: режим plan підтримує лише одну зарядку")
+            if not 60 <= PLAN_STEP_SEC <= 300:
+                raise ValueError("PLAN_STEP_SEC має бути в межах 60-300 секунд")
+        if interval > 0:
+            inverter_name = site["inverter"]
+            sample_intervals[inverter_name] = min(
+                interval, sample_intervals.get(inverter_name, interval)
+            )
+
+    history_dir = config.get("history_dir", "")
+    event_log = IterationEventLog() if LOG_FORMAT == "json" else None
+    sites = []
+    for name, site in config["sites"].items():
+        settings = settings_by_site[name]
+        inverter_name = site["inverter"]
+        site_prefix = f"[{name}] " if multi_site else ""
+        site_log = _PrefixLogger(logger, {"prefix": site_prefix})
+        sampler = None
+        if inverter_name in sample_intervals:
+            sampler = pool.sampler(
+                inverter_name, sample_intervals[inverter_name], settings.grid_import_threshold
+            )
+
+        units = []
+        for charger_name in site["chargers"]:
+            if multi_site and len(site["chargers"]) > 1:
+                unit_log = _PrefixLogger(logger, {"prefix": f"[{name}/{charger_name}] "})
+            else:
+                unit_log = site_log
+            if "history_file" in site:
+                history_path = site["history_file"]
+            elif history_dir:
+                history_path = os.path.join(history_dir, f"{name}-{charger_name}.bin")
+            else:
+                history_path = ""
+            if multi_site:
+                labels = {"site": name, "charger": charger_name}
+                state_gauge = METRICS.gauge("charger_state", CHARGER_STATE.help, **labels)
+                current_gauge = METRICS.gauge("charger_current_amps", CHARGER_CURRENT.help, **labels)
+                state_gauge.set(CHARGER_STATE_UNKNOWN)
+                current_gauge.set(math.nan)
+            else:
+                state_gauge, current_gauge = CHARGER_STATE, CHARGER_CURRENT
+            unit = ChargerUnit(
+                name=charger_name,
+                charger=pool.chargers[charger_name],
+                state_machine=ChargeStateMachine(
+                    soc_on=settings.soc_threshold,
+                    soc_off=settings.soc_off_threshold,
+                    grid_on=settings.grid_import_threshold,
+                    grid_off=settings.grid_import_off_threshold,
+                ),
+                history=_open_history(history_path, unit_log),
+                start_current_a=settings.charging_current_a,
+                state_gauge=state_gauge,
+                current_gauge=current_gauge,
+                log=unit_log,
+                session=None if ledger is None else SessionTracker(name, charger_name, ledger),
+            )
+            # Регулятор струму за надлишком PV
+            if settings.control_mode == "surplus":
+                unit.surplus = SurplusCurrentController(max_current_a=settings.charging_current_a)
+                unit.start_current_a = unit.surplus.min_current_a
+                pool.start_task(
+                    unit.surplus.run(unit.charger, sampler, unit.state_machine),
+                    f"surplus-control-{name}-{charger_name}",
+                )
+                unit_log.info(
+                    f"Режим surplus: струм {unit.surplus.min_current_a}-{unit.surplus.max_current_a}A, "
+                    f"ціль {SURPLUS_TARGET_GRID_W:.0f}W ± {SURPLUS_DEADBAND_W:.0f}W, "
+                    f"період {SURPLUS_INTERVAL_SEC} сек"
+                )
+            # План за прогнозом; без DPS струму - лише ВВІМК/ВИМК на charging_current_a
+            elif settings.control_mode == "plan":
+                unit.planner = ChargePlanner(
+                    settings.forecast_file,
+                    min_current_a=(
+                        min(MIN_CHARGING_CURRENT_A, settings.charging_current_a)
+                        if FEYREE_CURRENT_DPS
+                        else settings.charging_current_a
+                    ),
+                    max_current_a=settings.charging_current_a,
+                    plan_file=os.path.join(PLAN_DIR, f"plan-{name}.json") if PLAN_DIR else "",
+                    log=unit_log,
+                )
+                unit_log.info(
+                    f"Режим plan: прогноз {settings.forecast_file}, струм "
+                    f"{unit.planner.min_current_a}-{unit.planner.max_current_a}A, "
+                    f"крок {PLAN_STEP_SEC:.0f} сек, батарея {BATTERY_CAPACITY_KWH} kWh, "
+                    f"мін. SOC {PLAN_MIN_SOC}%"
+                )
+            units.append(unit)
+
+        if multi_site:
+            soc_gauge = METRICS.gauge("battery_soc_percent", BATTERY_SOC.help, site=name)
+            grid_gauge = METRICS.gauge("grid_power_watts", GRID_POWER.help, site=name)
+            site_log.info(
+                f"Інвертор {inverter_name}, зарядки: {', '.join(site['chargers'])}; "
+                f"SOC {settings.soc_threshold}/{settings.soc_off_threshold}%, "
+                f"імпорт {settings.grid_import_threshold}/{settings.grid_import_off_threshold}W, "
+                f"інтервал {settings.check_interval_sec} сек, режим {settings.control_mode}"
+            )
+        else:
+            soc_gauge, grid_gauge = BATTERY_SOC, GRID_POWER
+        sites.append(
+            SiteController(
+                name,
+                pool.inverters[inverter_name],
+                units,
+                settings,
+                sampler=sampler,
+                soc_gauge=soc_gauge,
+                grid_gauge=grid_gauge,
+                log_prefix=site_prefix,
+                event_log=event_log,
+                state_store=state_store,
+            )
+        )
+    return sites
+
+
+async def run_sites(
+    sites: list[SiteController],
+    max_iterations: Optional[int] = None,
+    on_iteration: Optional[Callable[[Dict], None]] = None,
+) -> None:
+    """
+    Спільний планувальник ітерацій усіх об'єктів.
+
+    Один event loop обслуговує всі об'єкти: планові ітерації запускаються
+    на сітці check_interval_sec (FixedRateTicker), позачергові - коли слухач
+    зарядки запросив перевірку. Ітерації різних об'єктів виконуються
+    паралельно, тому повільний пристрій одного об'єкта не затримує інших.
+    Після кожної ітерації оновлюється файл живості (LIVENESS_FILE).
+
+    Args:
+        sites: Контролери об'єктів
+        max_iterations: Зупинитись після N ітерацій кожного об'єкта (None = безкінечно)
+        on_iteration: Викликається після кожної ітерації з її словником
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    running: Dict[str, asyncio.Task] = {}
+
+    def finished(site: SiteController) -> bool:
+        return max_iterations is not None and site.iteration >= max_iterations
+
+    def liveness_window() -> float:
+        """Найдовша очікувана пауза між ітераціями (за поточними, можливо перечитаними, налаштуваннями)."""
+        return 2 * max(site.settings.check_interval_sec for site in sites) + sum(
+            PHASE_DEADLINES.values()
+        )
+
+    async def run_one(site: SiteController, lateness: Optional[float]):
+        iteration_info = await site.run_iteration(lateness)
+        if LIVENESS_FILE:
+            touch_liveness(LIVENESS_FILE, time.time() + liveness_window())
+        if on_iteration is not None:
+            on_iteration(iteration_info)
+        if not finished(site):
+            # Крок 5: Очікування до наступної перевірки
+            remaining = max(0.0, site.ticker.next_due - loop.time())
+            site.log.info(f"Очікування {remaining:.1f} секунд до наступної перевірки...")
+
+    def done(task: asyncio.Task, site: SiteController):
+        running.pop(site.name, None)
+        if not task.cancelled() and task.exception() is not None:
+            site.log.error(f"Помилка ітерації об'єкта: {task.exception()}")
+        wake.set()
+
+    for site in sites:
+        site._scheduler_wake = wake
+        site.ticker.reset(loop.time())
+
+    try:
+        while True:
+            wake.clear()
+            now = loop.time()
+            for site in sites:
+                if site.name in running or finished(site):
+                    continue
+                lateness = None
+                if site.ticker.next_due <= now:
+                    lateness = site.ticker.tick(now)
+                elif site.wake_requested:
+                    site.log.info("Стан зарядки змінився - позачергова перевірка")
+                else:
+                    continue
+                site.wake_requested = False
+                task = asyncio.create_task(run_one(site, lateness), name=f"site-{site.name}")
+                running[site.name] = task
+                task.add_done_callback(functools.partial(done, site=site))
+
+            waiting = [s.ticker.next_due for s in sites if s.name not in running and not finished(s)]
+            if not running and not waiting:
+                return
+            timeout = max(0.0, min(waiting) - loop.time()) if waiting else None
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for task in list(running.values()):
+            task.cancel()
+        if running:
+            await asyncio.gather(*running.values(), return_exceptions=True)
+        for site in sites:
+            overruns = ", ".join(f"{phase} {count}" for phase, count in site.phase_overruns.items())
+            site.log.info(
+                f"Планувальник: тиків {site.ticker.ticks}, пропущено {site.ticker.skipped}, "
+                f"макс. запізнення {site.ticker.max_lateness_sec * 1000:.0f} мс; "
+                f"перевищень дедлайнів: {overruns}"
+            )
+
+
+def touch_liveness(path: str, expires_at: float):
+    """
+    Записує у файл живості час (Unix), до якого очікується наступне оновлення.
+
+    Запис атомарний (тимчасовий файл + os.replace), тому HEALTHCHECK
+    ніколи не читає частково записаний файл.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(f"{expires_at:.0f}\n")
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"Не вдалося оновити файл живості {path}: {e}")
 
-# ============================================================
-# Основна логіка керування
-# ============================================================
 
+# ============================================================
+# Теплий старт (знімок стану)
+# ============================================================
 
-def control_loop() -> None:
+
+def state_snapshot(sites: list[SiteController]) -> Dict:
+    """Знімок стану всіх об'єктів (будується в потоці event loop)."""
+    return {
+        "saved_at": time.time(),
+        "sites": {site.name: site.export_state() for site in sites},
+    }
+
+
+def write_state_snapshot(path: str, snapshot: Dict):
+    """Атомарно записує знімок стану (тимчасовий файл + os.replace)."""
+    tmp_path = f"{path}.tmp"
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.error(f"Не вдалося записати знімок стану {path}: {e}")
+
+
+def restore_state_snapshot(path: str, sites: list[SiteController]) -> Optional[float]:
+    """
+    Відновлює стан об'єктів зі знімка.
+
+    Returns:
+        Вік знімка (секунди) або None, якщо знімка немає чи він пошкоджений
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+        elapsed = max(0.0, time.time() - float(snapshot["saved_at"]))
+        for site in sites:
+            if site.name in snapshot["sites"]:
+                site.restore_state(snapshot["sites"][site.name], elapsed)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Знімок стану {path} не відновлено: {e}")
+        return None
+    return elapsed
+
+
+async def state_snapshot_loop(path: str, sites: list[SiteController], interval_sec: float):
+    """Періодичне збереження знімка стану (запис файлу - у потоці)."""
+    while True:
+        await asyncio.sleep(interval_sec)
+        await asyncio.to_thread(write_state_snapshot, path, state_snapshot(sites))
+
+
+async def check_connections_in_background(pool: DevicePool):
+    """Перевірка пристроїв після теплого старту: лише звіт, цикл уже працює."""
+    if await pool.check_connections(connect_inverters=False):
+        logger.info("Фонова перевірка пристроїв: усі пристрої доступні")
+    else:
+        logger.warning(
+            "Фонова перевірка пристроїв: є недоступні пристрої, "
+            "рішення приймаються за останніми відомими даними"
+        )
+
+
+# ============================================================
+# Перезавантаження налаштувань (SIGHUP / зміна файлу)
+# ============================================================
+
+# Глобальні параметри, що змінюються без перезапуску та розриву з'єднань
+RELOADABLE_SETTINGS = (
+    "SOC_THRESHOLD",
+    "SOC_OFF_THRESHOLD",
+    "GRID_IMPORT_THRESHOLD",
+    "GRID_IMPORT_OFF_THRESHOLD",
+    "CHECK_INTERVAL_SEC",
+    "CHARGING_CURRENT_A",
+    "MIN_ON_TIME_SEC",
+    "MIN_OFF_TIME_SEC",
+    "MAX_COMMANDS_PER_HOUR",
+    "GRID_IMPORT_MAX_SEC",
+    "MAX_ATTEMPTS",
+    "RETRY_DELAY_SEC",
+    "RETRY_MAX_DELAY_SEC",
+    "READ_BUDGET_SEC",
+    "CONNECTION_TIMEOUT_SEC",
+    "COMMAND_ACK_TIMEOUT_SEC",
+    "BREAKER_FAILURE_THRESHOLD",
+    "BREAKER_RESET_SEC",
+    "STALE_READING_MAX_SEC",
+    "STALE_SAFE_OFF",
+    "DEADLINE_SAMPLE_SEC",
+    "DEADLINE_DECIDE_SEC",
+    "DEADLINE_ACTUATE_SEC",
+)
+
+
+class ConfigReloader:
+    """
+    Перезавантаження налаштувань працюючого сервісу.
+
+    Значення з CONFIG_RELOAD_FILE (формат .env) перекривають ті, з якими
+    сервіс запущено; ключ, видалений з файлу, повертає стартове значення.
+    SITES_FILE перечитується повністю. Нові значення перевіряються разом
+    і застосовуються до автоматів, планувальника, інверторів та зарядок без
+    розриву з'єднань; при будь-якій помилці діють попередні.
+    """
+
+    # Похідні значення, що без явного завдання слідують за базовими
+    # (як значення за замовчуванням при запуску): (похідне, базове)
+    DERIVED = (
+        ("GRID_IMPORT_OFF_THRESHOLD", "GRID_IMPORT_THRESHOLD"),
+        ("DEADLINE_SAMPLE_SEC", "READ_BUDGET_SEC"),
+        ("DEADLINE_ACTUATE_SEC", "COMMAND_ACK_TIMEOUT_SEC"),
+    )
+
+    def __init__(
+        self,
+        sites: list[SiteController],
+        pool: DevicePool,
+        config: Dict,
+        path: str = CONFIG_RELOAD_FILE,
+        sites_file: str = SITES_FILE,
+    ):
+        self.sites = sites
+        self.pool = pool
+        self.config = config
+        self.path = path
+        self.sites_file = sites_file
+        self.startup = {name: globals()[name] for name in RELOADABLE_SETTINGS}
+        self.reloads = 0
+        self._requested = asyncio.Event()
+        self._mtimes = self._file_mtimes()
+
+    def _file_mtimes(self) -> Dict[str, Optional[int]]:
+        mtimes = {}
+        for path in (self.path, self.sites_file):
+            if path:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtimes[path] = None
+        return mtimes
+
+    def request(self):
+        """Запит перезавантаження (обробник SIGHUP у потоці event loop)."""
+        self._requested.set()
+
+    def read_settings(self) -> Dict[str, object]:
+        """
+        Нові значення RELOADABLE_SETTINGS.
+
+        Raises:
+            ValueError: Значення не розбирається або не проходить перевірку
+        """
+        overrides = {}
+        if self.path and os.path.exists(self.path):
+            overrides = {k: v for k, v in dotenv_values(self.path).items() if v not in (None, "")}
+        values: Dict[str, object] = {}
+        for name, startup in self.startup.items():
+            raw = overrides.get(name)
+            if raw is None:
+                values[name] = startup
+            elif isinstance(startup, bool):
+                values[name] = raw.strip().lower() in ("1", "true", "yes", "on")
+            else:
+                try:
+                    values[name] = type(startup)(raw)
+                except ValueError:
+                    raise ValueError(f"{name}={raw}: очікується {type(startup).__name__}") from None
+
+        def explicit(name: str) -> bool:
+            return name in overrides or name in os.environ
+
+        if not explicit("SOC_OFF_THRESHOLD"):
+            values["SOC_OFF_THRESHOLD"] = values["SOC_THRESHOLD"] - (
+                self.startup["SOC_THRESHOLD"] - self.startup["SOC_OFF_THRESHOLD"]
+            )
+        for derived, base in self.DERIVED:
+            if not explicit(derived) and self.startup[base]:
+                values[derived] = values[base] * self.startup[derived] / self.startup[base]
+        self.validate(values)
+        return values
+
+    @staticmethod
+    def validate(values: Dict[str, object]):
+        """Перевіряє узгодженість значень (ValueError з описом першої проблеми)."""
+        if not 0 <= values["SOC_OFF_THRESHOLD"] <= values["SOC_THRESHOLD"] <= 100:
+            raise ValueError("очікується 0 <= SOC_OFF_THRESHOLD <= SOC_THRESHOLD <= 100")
+        if not 0 <= values["GRID_IMPORT_THRESHOLD"] <= values["GRID_IMPORT_OFF_THRESHOLD"]:
+            raise ValueError("очікується 0 <= GRID_IMPORT_THRESHOLD <= GRID_IMPORT_OFF_THRESHOLD")
+        for name in (
+            "CHECK_INTERVAL_SEC",
+            "CHARGING_CURRENT_A",
+            "MAX_ATTEMPTS",
+            "READ_BUDGET_SEC",
+            "CONNECTION_TIMEOUT_SEC",
+            "COMMAND_ACK_TIMEOUT_SEC",
+            "DEADLINE_SAMPLE_SEC",
+            "DEADLINE_DECIDE_SEC",
+            "DEADLINE_ACTUATE_SEC",
+        ):
+            if values[name] <= 0:
+                raise ValueError(f"{name} має бути більшим за 0")
+        for name in RELOADABLE_SETTINGS:
+            if not isinstance(values[name], bool) and values[name] < 0:
+                raise ValueError(f"{name} не може бути від'ємним")
+
+    @staticmethod
+    def _topology(config: Dict) -> tuple:
+        """Пристрої та зв'язки об'єктів (змінюються лише перезапуском)."""
+        return (
+            config["inverters"],
+            config["chargers"],
+            {name: (site["inverter"], site["chargers"]) for name, site in config["sites"].items()},
+        )
+
+    def read_sites_config(self) -> Dict:
+        """Нова конфігурація об'єктів; зміни пристроїв та зв'язків лише логуються."""
+        if not self.sites_file:
+            return self.config
+        config = load_sites_config(self.sites_file)
+        if self._topology(config) != self._topology(self.config):
+            logger.warning(
+                "Зміни інверторів, зарядок або їх зв'язків у SITES_FILE "
+                "застосовуються лише після перезапуску"
+            )
+        return config
+
+    async def reload(self, reason: str) -> bool:
+        """
+        Перечитує та застосовує налаштування.
+
+        Returns:
+            True якщо нові значення застосовано
+        """
+        previous = {name: globals()[name] for name in RELOADABLE_SETTINGS}
+        try:
+            values = self.read_settings()
+            config = self.read_sites_config()
+            # Параметри об'єктів будуються від нових глобальних значень
+            globals().update(values)
+            settings = {
+                name: SiteSettings.from_options(
+                    {k: v for k, v in site.items() if k not in ("inverter", "chargers", "history_file")}
+                )
+                for name, site in config["sites"].items()
+            }
+            for site_settings in settings.values():
+                self.validate(
+                    {
+                        **values,
+                        "SOC_THRESHOLD": site_settings.soc_threshold,
+                        "SOC_OFF_THRESHOLD": site_settings.soc_off_threshold,
+                        "GRID_IMPORT_THRESHOLD": site_settings.grid_import_threshold,
+                        "GRID_IMPORT_OFF_THRESHOLD": site_settings.grid_import_off_threshold,
+                        "CHECK_INTERVAL_SEC": site_settings.check_interval_sec,
+                        "CHARGING_CURRENT_A": site_settings.charging_current_a,
+                    }
+                )
+        except (OSError, ValueError, TypeError) as e:
+            globals().update(previous)
+            CONFIG_RELOADS_FAILED.inc()
+            logger.error(f"Налаштування не перезавантажено ({reason}): {e}; діють попередні")
+            return False
+
+        changes = [
+            f"{name} {previous[name]} → {values[name]}"
+            for name in RELOADABLE_SETTINGS
+            if values[name] != previous[name]
+        ]
+        self.apply_sites(settings)
+        await self.apply_devices()
+        self.config = config
+        self.reloads += 1
+        CONFIG_RELOADS_OK.inc()
+        logger.info(
+            f"Налаштування перезавантажено ({reason}): "
+            + (", ".join(changes) if changes else "глобальні значення без змін")
+        )
+        return True
+
+    def apply_sites(self, settings: Dict[str, SiteSettings]):
+        """Нові параметри автоматів та планувальника кожного об'єкта."""
+        for site in self.sites:
+            new = settings.get(site.name)
+            if new is None:
+                continue
+            if new.control_mode != site.settings.control_mode:
+                site.log.warning(
+                    f"Зміна control_mode ({site.settings.control_mode} → {new.control_mode}) "
+                    f"застосовується лише після перезапуску"
+                )
+                new.control_mode = site.settings.control_mode
+            if new != site.settings:
+                site.log.info(
+                    f"Параметри об'єкта: SOC {new.soc_threshold}/{new.soc_off_threshold}%, "
+                    f"імпорт {new.grid_import_threshold}/{new.grid_import_off_threshold}W, "
+                    f"інтервал {new.check_interval_sec} сек, струм {new.charging_current_a}A"
+                )
+            site.settings = new
+            # Новий інтервал діє з наступного тику
+            site.ticker.interval_sec = new.check_interval_sec
+            for unit in site.units:
+                machine = unit.state_machine
+                machine.soc_on, machine.soc_off = new.soc_threshold, new.soc_off_threshold
+                machine.grid_on, machine.grid_off = (
+                    new.grid_import_threshold,
+                    new.grid_import_off_threshold,
+                )
+                machine.min_on_sec, machine.min_off_sec = MIN_ON_TIME_SEC, MIN_OFF_TIME_SEC
+                machine.max_commands_per_hour = MAX_COMMANDS_PER_HOUR
+                if unit.surplus is not None:
+                    unit.surplus.max_current_a = new.charging_current_a
+                else:
+                    unit.start_current_a = new.charging_current_a
+                if unit.planner is not None:
+                    # Нові межі струму діють з наступного перерахунку плану
+                    unit.planner.forecast_file = new.forecast_file
+                    unit.planner.max_current_a = new.charging_current_a
+                    unit.planner.min_current_a = (
+                        min(MIN_CHARGING_CURRENT_A, new.charging_current_a)
+                        if FEYREE_CURRENT_DPS
+                        else new.charging_current_a
+                    )
+        PHASE_DEADLINES.update(
+            sample=DEADLINE_SAMPLE_SEC, decide=DEADLINE_DECIDE_SEC, actuate=DEADLINE_ACTUATE_SEC
+        )
+
+    async def apply_devices(self):
+        """Таймаути та circuit breaker наявних з'єднань (без перепідключення)."""
+        for inverter in self.pool.inverters.values():
+            inverter.breaker.failure_threshold = BREAKER_FAILURE_THRESHOLD
+            inverter.breaker.reset_sec = BREAKER_RESET_SEC
+            if inverter.client is not None:
+                inverter.client.socket_timeout = CONNECTION_TIMEOUT_SEC
+        await asyncio.gather(
+            *(charger.set_timeout(CONNECTION_TIMEOUT_SEC) for charger in self.pool.chargers.values())
+        )
+
+    async def run(self, watch_sec: float = CONFIG_WATCH_SEC):
+        """Чекає SIGHUP або зміни файлів налаштувань і перезавантажує їх."""
+        while True:
+            try:
+                await asyncio.wait_for(self._requested.wait(), watch_sec if watch_sec > 0 else None)
+                reason = "SIGHUP"
+            except asyncio.TimeoutError:
+                mtimes = self._file_mtimes()
+                if mtimes == self._mtimes:
+                    continue
+                changed = [path for path, mtime in mtimes.items() if self._mtimes.get(path) != mtime]
+                reason = f"змінено {', '.join(changed)}"
+            self._requested.clear()
+            self._mtimes = self._file_mtimes()
+            await self.reload(reason)
+
+
+async def async_control_loop(
+    max_iterations: Optional[int] = None,
+    on_iteration: Optional[Callable[[Dict], None]] = None,
+) -> None:
     """
-    Основний цикл керування зарядкою EV.
+    Основний цикл керування зарядкою EV (asyncio).
 
-    Безкінечний цикл, що:
-    1. Зчитує стан батареї та мережі з Deye інвертора
+    Безкінечний цикл, що для кожного об'єкта:
+    1. Одночасно зчитує стан Deye інвертора та поточний стан Feyree
     2. Приймає рішення про увімкнення/вимкнення зарядки
-    3. Отримує поточний стан Feyree перед виконанням команди
-    4. Виконує відповідні команди (якщо потрібно)
-    5. Отримує стан Feyree після виконання команди
-    6. Чекає CHECK_INTERVAL_SEC перед наступною перевіркою
+    3. Виконує відповідні команди (якщо потрібно)
+    4. Чекає підтвердження команди від Feyree (без фіксованих пауз)
+    5. Чекає наступного моменту сітки CHECK_INTERVAL_SEC (без дрейфу)
+
+    Тривалість ітерації визначається найповільнішим пристроєм, а не сумою
+    часу опитування обох. Без SITES_FILE керується один об'єкт з ENV,
+    з SITES_FILE - усі об'єкти файлу спільним планувальником.
+
+    Args:
+        max_iterations: Зупинитись після N ітерацій (None = безкінечно)
+        on_iteration: Викликається після кожної ітерації зі словником
+            iteration, site, duration_sec, decided_at, command, command_ok
     """
     logger.info("=" * 60)
     logger.info("Запуск системи керування зарядкою Feyree EV")
     logger.info("=" * 60)
     logger.info("Порогові значення:")
     logger.info(f"  - Мінімальний SOC для зарядки: {SOC_THRESHOLD}%")
+    logger.info(f"  - SOC для вимкнення зарядки: < {SOC_OFF_THRESHOLD}%")
     logger.info(f"  - Максимальний імпорт з мережі: {GRID_IMPORT_THRESHOLD}W")
+    logger.info(f"  - Імпорт для вимкнення зарядки: > {GRID_IMPORT_OFF_THRESHOLD}W")
+    logger.info(
+        f"  - Мінімальний час ВВІМК/ВИМК: {MIN_ON_TIME_SEC:.0f}/{MIN_OFF_TIME_SEC:.0f} сек"
+    )
+    logger.info(f"  - Ліміт команд на годину: {MAX_COMMANDS_PER_HOUR or 'без ліміту'}")
     logger.info(f"  - Інтервал перевірки: {CHECK_INTERVAL_SEC} сек")
     logger.info(f"  - Сила струму зарядки: {CHARGING_CURRENT_A}A")
+    logger.info(f"  - Режим керування: {CONTROL_MODE}")
+    if SITES_FILE:
+        logger.info(f"  - Об'єкти: {SITES_FILE} (значення вище - за замовчуванням)")
     logger.info("=" * 60)
+    events.info(
+        "startup",
+        extra={
+            "fields": {
+                "soc_threshold": SOC_THRESHOLD,
+                "soc_off_threshold": SOC_OFF_THRESHOLD,
+                "grid_import_threshold": GRID_IMPORT_THRESHOLD,
+                "grid_import_off_threshold": GRID_IMPORT_OFF_THRESHOLD,
+                "check_interval_sec": CHECK_INTERVAL_SEC,
+                "charging_current_a": CHARGING_CURRENT_A,
+                "control_mode": CONTROL_MODE,
+                "sites_file": SITES_FILE or None,
+                "log_heartbeat_sec": LOG_HEARTBEAT_SEC,
+            }
+        },
+    )
 
     # Ініціалізація компонентів
+    pool: Optional[DevicePool] = None
+    ledger: Optional[SessionLedger] = None
     try:
-        inverter = DeyeInverter()
-        charger = FeyreeCharger()
-    except ValueError as e:
+        if SITES_FILE:
+            config = load_sites_config(SITES_FILE)
+        else:
+            config = env_sites_config()
+        pool = DevicePool(tuya_workers=min(TUYA_POOL_SIZE, len(config["chargers"])))
+        state_store = StateStore() if STATE_API_PORT else None
+        if SESSION_DB_FILE:
+            ledger = SessionLedger(SESSION_DB_FILE)
+            logger.info(f"Журнал сесій зарядки: {SESSION_DB_FILE}")
+        sites = build_sites(
+            config, pool, multi_site=bool(SITES_FILE), state_store=state_store, ledger=ledger
+        )
+    except (ValueError, OSError, sqlite3.Error) as e:
         logger.error(f"Помилка ініціалізації: {e}")
         logger.error("Припинення роботи програми")
+        if pool is not None:
+            await pool.close()
         sys.exit(1)
     except Exception as e:
         logger.error(f"Неочікувана помилка ініціалізації: {e}")
+        if pool is not None:
+            await pool.close()
         sys.exit(1)
 
-    # Перевірка підключення до пристроїв
-    logger.info("-" * 60)
-    logger.info("Перевірка підключення до пристроїв...")
-    logger.info("-" * 60)
-
-    # Тест підключення до Deye інвертора
-    try:
-        logger.info("Тестове підключення до Deye інвертора...")
-        test_state = inverter.get_battery_and_grid_state()
-        logger.info("Deye інвертор: Підключення УСПІШНЕ")
-        logger.info(f"  Поточний SOC: {test_state['battery_soc_pct']:.1f}%")
-        logger.info(
-            f"  Потужність мережі: {test_state['grid_power_w']:.0f}W ({test_state['grid_direction']})"
-        )
-    except Exception as e:
-        logger.error(f"Deye інвертор: Підключення НЕВДАЛЕ - {e}")
-        logger.error("Неможливо продовжити роботу без доступу до інвертора")
-        sys.exit(1)
-
-    # Тест підключення до Feyree зарядки
+    metrics_server = None
+    state_server = None
+    # Теплий старт: стан автоматів та останні дані зі знімка попереднього запуску
+    snapshot_age = restore_state_snapshot(STATE_SNAPSHOT_FILE, sites) if STATE_SNAPSHOT_FILE else None
+    warm_start = snapshot_age is not None and snapshot_age <= WARM_START_MAX_AGE_SEC
+    loop_started = False
     try:
-        logger.info("Тестове підключення до Feyree зарядки...")
-        test_status = charger.get_status()
-        if test_status:
-            logger.info("Feyree зарядка: Підключення УСПІШНЕ")
-            if "dps" in test_status:
-                # Показуємо поточний стан головного перемикача (якщо доступний)
-                switch_state = test_status["dps"].get(
-                    str(FEYREE_SWITCH_DPS), "невідомо"
-                )
-                work_mode = test_status["dps"].get(str(FEYREE_MODE_DPS), "невідомо")
-                logger.info(f"  Стан: {'ВВІМК' if switch_state else 'ВИМК'}")
-                logger.info(f"  Режим: {work_mode}")
-        else:
-            logger.warning(
-                "Feyree зарядка: Підключення встановлено, але не отримано статус"
+        if warm_start:
+            # Цикл стартує одразу, пристрої перевіряються паралельно з ним
+            logger.info(
+                f"Теплий старт: знімок стану {snapshot_age:.0f} сек тому, перевірка пристроїв у фоні"
             )
-            logger.warning("Продовжуємо роботу, але можливі проблеми з керуванням")
-    except Exception as e:
-        logger.error(f"Feyree зарядка: Підключення НЕВДАЛЕ - {e}")
-        logger.error("Неможливо продовжити роботу без доступу до зарядки")
-        sys.exit(1)
+            pool.open_inverters()
+            await pool.start_discovery()
+            pool.start_task(check_connections_in_background(pool), "device-check")
+        else:
+            if snapshot_age is not None:
+                logger.info(f"Знімок стану застарілий ({snapshot_age:.0f} сек) - повна перевірка пристроїв")
+            # Перевірка підключення до пристроїв (паралельно)
+            logger.info("-" * 60)
+            logger.info("Перевірка підключення до пристроїв...")
+            logger.info("-" * 60)
+            await pool.start_discovery()
+            if not await pool.check_connections():
+                sys.exit(1)
 
-    logger.info("Всі пристрої підключені успішно. Запуск основного циклу...")
+        # Проксі logger для інших клієнтів (одне з'єднання з logger на всіх)
+        try:
+            await pool.start_proxies()
+        except OSError as e:
+            logger.error(f"Не вдалося запустити проксі logger: {e}")
 
-    # Основний цикл
-    iteration = 0
-    try:
-        while True:
-            iteration += 1
-            logger.info("-" * 60)
-            logger.info(f"Ітерація #{iteration} - {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        # Позачергова ітерація при зміні стану зарядки ззовні
+        if FEYREE_PUSH_LISTENER:
+            for site in sites:
+                site.start_listeners()
 
+        # Профілювання за запитом: SIGUSR1, POST /profile/start або PROFILE_ON_START
+        profiler = PROFILER if PROFILE_DIR else None
+        if profiler is not None:
+            register_profile_phases(profiler)
+            if hasattr(signal, "SIGUSR1"):
+                asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+            logger.info(
+                f"Профілювання: SIGUSR1"
+                f"{' або POST /profile/start' if PROFILE_HTTP_CONTROL else ''}, файли в {PROFILE_DIR}"
+            )
+            if PROFILE_ON_START:
+                profiler.start("PROFILE_ON_START")
+
+        # HTTP endpoint /metrics для Prometheus
+        if METRICS_PORT:
             try:
-                # Крок 1: Отримання даних з інвертора
-                logger.info("Читання даних з Deye інвертора...")
-                state = inverter.get_battery_and_grid_state()
+                metrics_server = await start_metrics_server(
+                    METRICS, METRICS_HOST, METRICS_PORT, profiler=profiler
+                )
+                logger.info(f"Метрики Prometheus: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+            except OSError as e:
+                logger.error(f"Не вдалося запустити сервер метрик на порту {METRICS_PORT}: {e}")
 
-                battery_soc: float = float(state["battery_soc_pct"])
-                grid_power: float = float(state["grid_power_w"])
-                grid_direction: str = str(state["grid_direction"])
+        # HTTP API стану (JSON з пам'яті, без звернень до пристроїв)
+        if state_store is not None:
+            try:
+                state_server = await start_state_server(state_store, STATE_API_HOST, STATE_API_PORT)
+                logger.info(f"API стану: http://{STATE_API_HOST}:{STATE_API_PORT}/state")
+            except OSError as e:
+                logger.error(f"Не вдалося запустити API стану на порту {STATE_API_PORT}: {e}")
 
-                logger.info("Стан системи:")
-                logger.info(f"  - Батарея: {battery_soc:.1f}%")
-                logger.info(f"  - Мережа: {grid_power:.0f}W ({grid_direction})")
+        if STATE_SNAPSHOT_FILE:
+            pool.start_task(
+                state_snapshot_loop(STATE_SNAPSHOT_FILE, sites, STATE_SNAPSHOT_SEC), "state-snapshot"
+            )
 
-                # Крок 2: Прийняття рішення
-                should_charge = charger.should_charge(
-                    battery_soc, grid_power, grid_direction
-                )
+        # Перезавантаження налаштувань без перезапуску: SIGHUP або зміна файлів
+        reloader = ConfigReloader(sites, pool, config)
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reloader.request)
+        pool.start_task(reloader.run(), "config-reload")
+        if CONFIG_RELOAD_FILE or SITES_FILE:
+            watched = ", ".join(path for path in (CONFIG_RELOAD_FILE, SITES_FILE) if path)
+            logger.info(f"Перезавантаження налаштувань: SIGHUP або зміна {watched}")
 
-                logger.info("Аналіз умов зарядки:")
-                logger.info(
-                    f"  - SOC >= {SOC_THRESHOLD}%: {'ТАК' if battery_soc >= SOC_THRESHOLD else 'НІ'}"
-                )
-                logger.info(
-                    f"  - Імпорт < {GRID_IMPORT_THRESHOLD}W або експорт: {'ТАК' if (grid_direction != 'import' or grid_power < GRID_IMPORT_THRESHOLD) else 'НІ'}"
-                )
-                logger.info(
-                    f"Рішення: {'УВІМКНУТИ зарядку' if should_charge else 'ВИМКНУТИ зарядку'}"
-                )
+        if warm_start:
+            logger.info("Запуск основного циклу...")
+        else:
+            logger.info("Всі пристрої підключені успішно. Запуск основного циклу...")
+        loop_started = True
+        await run_sites(sites, max_iterations=max_iterations, on_iteration=on_iteration)
 
-                # Крок 3: Отримання поточного стану перед виконанням команди
-                logger.info("Отримання стану пристрою...")
-                status_before = charger.get_status()
-                charge_status = None
-                if status_before and "dps" in status_before:
-                    charger.display_device_status(status_before, prefix="[ДО]")
-                    # Оновлюємо current_state з реального стану пристрою
-                    actual_state = status_before.get("dps", {}).get(
-                        str(FEYREE_SWITCH_DPS), None
-                    )
-                    charge_status = status_before.get("dps", {}).get(
-                        "101", None
-                    )  # Реальний статус зарядки
-                    if actual_state is not None:
-                        charger.current_state = actual_state
+    finally:
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        if PROFILE_DIR and hasattr(signal, "SIGUSR1"):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        PROFILER.stop("завершення роботи")
+        if STATE_SNAPSHOT_FILE and loop_started:
+            write_state_snapshot(STATE_SNAPSHOT_FILE, state_snapshot(sites))
+        # Закриття з'єднань
+        await pool.close()
+        for site in sites:
+            site.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if state_server is not None:
+            state_server.close()
+        if ledger is not None:
+            ledger.close()
 
-                # Крок 4: Виконання команди
-                command_executed = False
 
-                # Визначаємо чи зарядка вже відбувається (DPS 101 = "charing")
-                is_already_charging = (
-                    charge_status and "char" in str(charge_status).lower()
-                )
+def register_profile_phases(profiler: ContinuousProfiler):
+    """
+    Маркери фаз циклу для профілювальника: читання інвертора, статусу
+    зарядки, прийняття рішення та виконання команд. Фаза стеку визначається
+    найглибшим маркером, тож команда всередині _control_unit - actuate.
+    """
+    profiler.mark(
+        "inverter",
+        AsyncDeyeInverter.get_battery_and_grid_state,
+        AsyncDeyeInverter.get_snapshot,
+        AsyncDeyeInverter.read_registers,
+        InverterSampler.run,
+        InverterSampler.get_battery_and_grid_state,
+    )
+    profiler.mark(
+        "status",
+        FeyreeCharger.get_status,
+        AsyncFeyreeCharger.get_status,
+        FeyreeStatusListener.run,
+    )
+    profiler.mark(
+        "decide",
+        SiteController._control_unit,
+        ChargeStateMachine.evaluate,
+        SurplusCurrentController.update,
+    )
+    profiler.mark(
+        "actuate",
+        FeyreeCharger.turn_on,
+        FeyreeCharger.turn_off,
+        FeyreeCharger.set_current,
+        AsyncFeyreeCharger.turn_on,
+        AsyncFeyreeCharger.turn_off,
+        AsyncFeyreeCharger.set_current,
+    )
 
-                # Визначаємо чи потрібно виконати команду
-                if should_charge and not is_already_charging:
-                    # Потрібно увімкнути зарядку (тільки якщо вона ще не заряджається)
-                    command_executed = charger.turn_on(CHARGING_CURRENT_A)
-                elif not should_charge and is_already_charging:
-                    # Потрібно вимкнути зарядку (тільки якщо вона заряджається)
-                    command_executed = charger.turn_off()
-                else:
-                    # Стан не змінився
-                    if should_charge and is_already_charging:
-                        logger.info(
-                            f"Зарядка вже відбувається (DPS 101 = {charge_status})"
-                        )
-                    else:
-                        logger.info(
-                            f"Стан зарядки не змінився (залишається: {'ВВІМК' if charger.current_state else 'ВИМК'})"
-                        )
 
-                # Крок 5: Отримання стану після виконання команди
-                if command_executed:
-                    # Невелика затримка для застосування команди
-                    time.sleep(2)
-                    logger.info("Перевірка стану після виконання команди...")
-                    status_after = charger.get_status()
-                    if status_after:
-                        charger.display_device_status(status_after, prefix="[ПІСЛЯ]")
-
-            except NoSocketAvailableError as e:
-                logger.error(f"З'єднання з інвертором закрите: {e}")
-                logger.info("Спроба перепідключення в наступній ітерації...")
-            except V5FrameError as e:
-                logger.error(f"Помилка зв'язку з інвертором: {e}")
-            except Exception as e:
-                logger.error(f"Неочікувана помилка в циклі: {e}", exc_info=True)
+def _raise_keyboard_interrupt(signum, frame):
+    """SIGTERM (docker stop) завершує роботу так само, як Ctrl+C."""
+    raise KeyboardInterrupt
 
-            # Крок 4: Очікування до наступної перевірки
-            logger.info(
-                f"Очікування {CHECK_INTERVAL_SEC} секунд до наступної перевірки..."
-            )
-            time.sleep(CHECK_INTERVAL_SEC)
 
+def control_loop() -> None:
+    """
+    Запускає асинхронний цикл керування та обробляє Ctrl+C / SIGTERM.
+
+    Див. async_control_loop().
+    """
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    try:
+        asyncio.run(async_control_loop())
     except KeyboardInterrupt:
         logger.info("\n" + "=" * 60)
-        logger.info("Отримано сигнал зупинки (Ctrl+C)")
+        logger.info("Отримано сигнал зупинки (Ctrl+C / SIGTERM)")
         logger.info("Завершення роботи програми...")
         logger.info("=" * 60)
+
+
+# ============================================================
+# Сканер регістрів (карта для інших моделей Deye / Sunsynk)
+# ============================================================
+
+# Декодування, що перевіряються для кожної адреси - ті ж типи, що й у карті
+SCAN_TYPES = REGISTER_TYPES
+SCAN_SCALES = (1.0, 0.1, 0.01, 0.001, 10.0)
+# Мінімальна кореляція з еталоном, що змінювався під час сканування
+SCAN_MIN_CORRELATION = 0.8
+
+
+def decode_register(values: Dict[int, int], address: int, kind: str) -> Optional[int]:
+    """
+    Сире значення поля типу kind за адресою (None, якщо регістр не прочитано).
+
+    Декодується тим самим ReadBlock.decode(), що й карта в циклі керування,
+    тому знак і порядок слів знайденого поля збігаються з runtime.
+    """
+    words = [values.get(address + i) for i in range(RegisterField("scan", 0, kind).words)]
+    if None in words:
+        return None
+    return ReadBlock(address, len(words), (("scan", 0, kind, 1),)).decode(words)["scan"]
+
+
+def register_runs(addresses: list[int], max_block: int) -> list[tuple[int, int]]:
+    """Суцільні діапазони (start, count) з відсортованих адрес, не довші за max_block."""
+    runs: list[tuple[int, int]] = []
+    for address in addresses:
+        if runs and runs[-1][0] + runs[-1][1] == address and runs[-1][1] < max_block:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((address, 1))
+    return runs
+
+
+class RegisterScanner:
+    """
+    Пошук регістрів, що читаються, та їх повторне читання.
+
+    Діапазон адрес ділиться на частини по max_block регістрів, які
+    обробляє пул з'єднань з logger (по одному запиту на з'єднання). У межах
+    частини розмір запиту адаптивний: після успіху подвоюється (не більше
+    max_block), після Modbus exception зменшується вдвічі; регістр, що не
+    читається поодинці, вважається відсутнім. Далі адреси перевіряються з
+    кроком, що подвоюється після кожної відмови, а межу першого регістра,
+    що читається, уточнює бінарний пошук, тож прогалина з N адрес коштує
+    ~2*log2(N) запитів (exhaustive=True - перевіряється кожна адреса).
+    Запити всіх з'єднань разом не частіші за один на pace_sec, тож logger
+    не перевантажується.
+    """
+
+    def __init__(
+        self,
+        inverters: list[AsyncDeyeInverter],
+        max_block: int = MAX_REGISTERS_PER_READ,
+        pace_sec: float = 0.2,
+        exhaustive: bool = False,
+    ):
+        """
+        Args:
+            inverters: Підключені клієнти logger (кількість = паралельність)
+            max_block: Максимум регістрів в одному запиті (не більше 125)
+            pace_sec: Мінімальний проміжок між запитами всіх з'єднань
+            exhaustive: Перевіряти кожну адресу прогалин (без пропусків)
+        """
+        self.inverters = inverters
+        self.max_block = max(1, min(max_block, 125))
+        self.pace_sec = pace_sec
+        self.exhaustive = exhaustive
+        self.requests = 0
+        self.rejected = 0  # Modbus exception
+        self.failed: list[tuple[int, int]] = []  # Без відповіді після всіх повторів
+        self._pace_lock = asyncio.Lock()
+        self._next_request_at = 0.0
+
+    async def _read(self, inverter: AsyncDeyeInverter, start: int, count: int) -> Optional[list[int]]:
+        """Читання з дотриманням паузи. None - діапазон не читається (Modbus exception)."""
+        async with self._pace_lock:
+            delay = self._next_request_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_request_at = time.monotonic() + self.pace_sec
+        self.requests += 1
+        try:
+            return await inverter.read_registers(start, count)
+        except ModbusExceptionError:
+            self.rejected += 1
+            return None
+
+    async def _run_workers(self, jobs: list, handle: Callable[[AsyncDeyeInverter, tuple], Awaitable]):
+        """Обробляє jobs пулом з'єднань (кожне з'єднання - один запит за раз)."""
+        pending = deque(jobs)
+        done = 0
+
+        async def worker(inverter: AsyncDeyeInverter):
+            nonlocal done
+            while pending:
+                await handle(inverter, pending.popleft())
+                done += 1
+                if done % 10 == 0 or not pending:
+                    logger.info(f"Сканування: {done}/{len(jobs)}, запитів {self.requests}")
+
+        await asyncio.gather(*(worker(inverter) for inverter in self.inverters))
+
+    async def sweep(self, start: int, end: int) -> Dict[int, int]:
+        """
+        Пошук регістрів в [start, end).
+
+        Returns:
+            {адреса: значення} для всіх регістрів, що читаються
+        """
+        values: Dict[int, int] = {}
+
+        async def sweep_part(inverter: AsyncDeyeInverter, part: tuple[int, int]):
+            address, part_end = part
+            size = part_end - address
+            failed_at: Optional[int] = None  # Остання адреса, що не читається поодинці
+            skip = 1
+            while address < part_end:
+                size = min(size, part_end - address)
+                try:
+                    block = await self._read(inverter, address, size)
+                except V5FrameError as e:
+                    logger.warning(f"Регістри {address}-{address + size - 1} без відповіді: {e}")
+                    self.failed.append((address, size))
+                    address += size
+                    failed_at, skip = None, 1
+                    continue
+                if block is not None and failed_at is not None and address - failed_at > 1:
+                    # Пропущені адреси між відмовою та цим регістром: шукаємо межу
+                    address = await self._first_readable(inverter, failed_at, address)
+                    failed_at, skip, size = None, 1, 1
+                elif block is not None:
+                    values.update(zip(range(address, address + size), block))
+                    address += size
+                    size *= 2
+                    failed_at, skip = None, 1
+                elif size > 1:
+                    size //= 2
+                else:
+                    failed_at = address
+                    address += skip
+                    if not self.exhaustive:
+                        skip *= 2
+
+        parts = [(a, min(a + self.max_block, end)) for a in range(start, end, self.max_block)]
+        await self._run_workers(parts, sweep_part)
+        return values
+
+    async def _first_readable(self, inverter: AsyncDeyeInverter, failed: int, readable: int) -> int:
+        """Бінарний пошук першої адреси, що читається, в (failed, readable]."""
+        while readable - failed > 1:
+            middle = (failed + readable) // 2
+            try:
+                block = await self._read(inverter, middle, 1)
+            except V5FrameError:
+                block = None
+            if block is None:
+                failed = middle
+            else:
+                readable = middle
+        return readable
+
+    async def snapshot(self, addresses: list[int]) -> Dict[int, int]:
+        """Повторне читання знайдених регістрів суцільними блоками."""
+        values: Dict[int, int] = {}
+
+        async def read_run(inverter: AsyncDeyeInverter, run: tuple[int, int]):
+            start, count = run
+            try:
+                block = await self._read(inverter, start, count)
+            except V5FrameError as e:
+                logger.warning(f"Регістри {start}-{start + count - 1} без відповіді: {e}")
+                return
+            if block is not None:
+                values.update(zip(range(start, start + count), block))
+
+        await self._run_workers(register_runs(sorted(addresses), self.max_block), read_run)
+        return values
+
+
+@dataclass
+class RegisterCandidate:
+    """Декодування регістра, що відповідає відомій величині."""
+
+    name: str
+    address: int
+    type: str
+    scale: float
+    sign: int
+    error: float  # Середня відносна похибка відносно еталону
+    correlation: Optional[float]  # None - еталон або регістр не змінювались
+
+    def register_field(self) -> RegisterField:
+        default = next((f for f in DEFAULT_REGISTER_FIELDS if f.name == self.name), None)
+        unit = default.unit if default is not None else ""
+        return RegisterField(self.name, self.address, self.type, self.scale, self.sign, unit)
+
+
+def match_registers(
+    name: str,
+    snapshots: list[Dict[int, int]],
+    reference: list[Optional[float]],
+    tolerance: float,
+) -> list[RegisterCandidate]:
+    """
+    Кандидати для величини name за знімками регістрів.
+
+    Для кожної адреси перевіряються типи SCAN_TYPES, множники SCAN_SCALES
+    та знак (для знакових типів). Похибка - середнє |значення - еталон|,
+    віднесене до середнього |еталон| (не менше 1). Якщо еталон змінювався,
+    значення регістра має змінюватись з ним (кореляція від
+    SCAN_MIN_CORRELATION).
+
+    Args:
+        name: Ім'я поля карти
+        snapshots: Значення регістрів у кожному знімку
+        reference: Еталон у момент кожного знімка (None = невідомо)
+        tolerance: Максимальна середня відносна похибка
+
+    Returns:
+        Найкраще декодування кожної адреси, що пройшла перевірку, за зростанням похибки
+    """
+    used = [(values, ref) for values, ref in zip(snapshots, reference) if ref is not None]
+    if not used:
+        return []
+    refs = [ref for _, ref in used]
+    norm = max(1.0, statistics.fmean(abs(ref) for ref in refs))
+    ref_varies = len(refs) > 1 and statistics.pstdev(refs) > 0
+
+    best: Dict[int, RegisterCandidate] = {}
+    for address in sorted(set().union(*(values.keys() for values, _ in used))):
+        for kind in SCAN_TYPES:
+            raw = [decode_register(values, address, kind) for values, _ in used]
+            if any(value is None for value in raw):
+                continue
+            correlation = None
+            if ref_varies:
+                if statistics.pstdev(raw) == 0:
+                    continue
+                correlation = statistics.correlation(raw, refs)
+            for sign in ((1, -1) if kind[0] == "s" else (1,)):
+                if correlation is not None and correlation * sign < SCAN_MIN_CORRELATION:
+                    continue
+                for scale in SCAN_SCALES:
+                    factor = scale * sign
+                    error = statistics.fmean(
+                        abs(value * factor - ref) for value, ref in zip(raw, refs)
+                    ) / norm
+                    if error > tolerance:
+                        continue
+                    current = best.get(address)
+                    if current is None or error < current.error:
+                        best[address] = RegisterCandidate(
+                            name,
+                            address,
+                            kind,
+                            scale,
+                            sign,
+                            error,
+                            None if correlation is None else correlation * sign,
+                        )
+    return sorted(best.values(), key=lambda c: (round(c.error, 4), -(c.correlation or 0.0), c.address))
+
+
+def load_scan_reference(path: str) -> Dict[str, list[tuple[float, float]]]:
+    """
+    Еталонні ряди з CSV: колонка timestamp (Unix або ISO 8601) та колонки
+    з іменами полів карти (напр. експорт історії Home Assistant або
+    застосунку інвертора). Порожні значення пропускаються.
+
+    Returns:
+        {ім'я поля: [(час, значення), ...] за зростанням часу}
+    """
+    import csv
+    from datetime import datetime
+
+    series: Dict[str, list[tuple[float, float]]] = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            raw_time = (row.pop("timestamp", None) or "").strip()
+            try:
+                timestamp = float(raw_time)
+            except ValueError:
+                timestamp = datetime.fromisoformat(raw_time).timestamp()
+            for name, value in row.items():
+                if name and value not in (None, ""):
+                    series.setdefault(name, []).append((timestamp, float(value)))
+    for points in series.values():
+        points.sort()
+    return series
+
+
+def reference_value(points: list[tuple[float, float]], timestamp: float) -> Optional[float]:
+    """
+    Значення ряду в момент timestamp: останнє відоме на цей момент (історія
+    Home Assistant записує лише зміни). None - раніше за початок ряду.
+    """
+    index = bisect.bisect_right(points, (timestamp, math.inf))
+    return points[index - 1][1] if index else None
+
+
+async def collect_register_snapshots(args) -> tuple[list[float], list[Dict[int, int]]]:
+    """
+    Пошук регістрів та знімки їх значень (див. scan_registers()).
+
+    Returns:
+        (моменти знімків, значення регістрів у кожному знімку)
+    """
+    inverters = [
+        AsyncDeyeInverter(
+            RegisterMap(()),
+            address=args.address,
+            port=args.port,
+            breaker=CircuitBreaker(f"Сканер {index + 1}", failure_threshold=0),
+        )
+        for index in range(args.connections)
+    ]
+    try:
+        for inverter in inverters:
+            await inverter.connect()
+    except Exception as e:
+        sys.exit(f"Не вдалося підключитися до logger {args.address}:{args.port}: {e!r}")
+
+    scanner = RegisterScanner(inverters, args.block, args.pace_sec, args.exhaustive)
+    try:
+        started = time.time()
+        logger.info(
+            f"Пошук регістрів {args.start}-{args.end - 1}: блоки до {scanner.max_block}, "
+            f"з'єднань {len(inverters)}, пауза {args.pace_sec} сек"
+        )
+        addresses = sorted(await scanner.sweep(args.start, args.end))
+        runs = register_runs(addresses, 1 << 16)
+        print(f"Регістрів, що читаються: {len(addresses)} за {time.time() - started:.0f} сек, "
+              f"запитів {scanner.requests} (Modbus exception {scanner.rejected})")
+        print("Діапазони: " + ", ".join(f"{a}-{a + n - 1}" for a, n in runs))
+        if scanner.failed:
+            print("Без відповіді: " + ", ".join(f"{a}-{a + n - 1}" for a, n in scanner.failed))
+        if not addresses:
+            sys.exit("Жоден регістр не прочитано")
+
+        # Знімки - лише суцільні блоки знайдених регістрів: читання одного
+        # знімка коротке, тож усі його значення відносяться до одного моменту
+        times: list[float] = []
+        snapshots: list[Dict[int, int]] = []
+        for index in range(args.snapshots):
+            if index:
+                await asyncio.sleep(args.every)
+            started = time.time()
+            snapshots.append(await scanner.snapshot(addresses))
+            times.append((started + time.time()) / 2)
+            logger.info(f"Знімок {index + 1}/{args.snapshots}: {time.time() - started:.1f} сек")
     finally:
-        # Закриття з'єднань
-        inverter.disconnect()
+        for inverter in inverters:
+            await inverter.disconnect()
+
+    if args.dump:
+        with open(args.dump, "w", encoding="utf-8") as f:
+            f.write("address," + ",".join(f"{t:.3f}" for t in times) + "\n")
+            for address in addresses:
+                f.write(f"{address}," + ",".join(str(s.get(address, "")) for s in snapshots) + "\n")
+        print(f"Значення регістрів: {args.dump}")
+    return times, snapshots
+
+
+def load_register_dump(path: str) -> tuple[list[float], list[Dict[int, int]]]:
+    """Знімки з файлу --dump попереднього сканування (формат collect_register_snapshots())."""
+    with open(path, encoding="utf-8") as f:
+        header = f.readline().strip().split(",")
+        times = [float(t) for t in header[1:]]
+        snapshots: list[Dict[int, int]] = [{} for _ in times]
+        for line in f:
+            address, *values = line.strip().split(",")
+            for snapshot, value in zip(snapshots, values):
+                if value:
+                    snapshot[int(address)] = int(value)
+    return times, snapshots
+
+
+def write_scanned_register_map(
+    args,
+    references: Dict[str, Callable[[float], Optional[float]]],
+    times: list[float],
+    snapshots: list[Dict[int, int]],
+):
+    """Зіставлення знімків з еталонами та запис карти (див. scan_registers())."""
+    fields: list[RegisterField] = []
+    report: Dict[str, Dict] = {}
+    for name, reference in references.items():
+        candidates = match_registers(
+            name, snapshots, [reference(t) for t in times], args.tolerance
+        )
+        print(f"\n{name}:")
+        if not candidates:
+            print(f"  відповідників немає (похибка до {args.tolerance:.0%})")
+            continue
+        for candidate in candidates[: args.top]:
+            correlation = "-" if candidate.correlation is None else f"{candidate.correlation:.2f}"
+            print(
+                f"  {candidate.address:>5} {candidate.type} x{candidate.scale:g}"
+                f"{' (знак -)' if candidate.sign < 0 else ''}: похибка {candidate.error:.1%}, "
+                f"кореляція {correlation}"
+            )
+        best = candidates[0]
+        tied = [c.address for c in candidates[1:] if round(c.error, 4) == round(best.error, 4)]
+        if tied:
+            print(f"  неоднозначно: так само відповідають {', '.join(map(str, tied))}")
+        fields.append(best.register_field())
+        report[name] = {
+            "error": round(best.error, 4),
+            "correlation": best.correlation,
+            "alternatives": [c.address for c in candidates[1 : args.top]],
+        }
+
+    if not fields:
+        sys.exit("Жодну величину не зіставлено - карту не записано")
+    missing = [name for name in REQUIRED_FIELDS if name not in report]
+    document = {
+        "fields": [asdict(f) for f in sorted(fields, key=lambda f: f.address)],
+        "scan": {
+            "source": args.from_dump or f"{args.address}:{args.port}",
+            "scanned_at": times[0],
+            "snapshots": len(snapshots),
+            "matches": report,
+        },
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+
+    # Перевірка: карта завантажується і читається тим же планувальником, що й у циклі
+    register_map = RegisterMap.from_file(args.output, required=())
+    decoded: Dict[str, float] = {}
+    for block in register_map.plan():
+        if all(a in snapshots[-1] for a in range(block.start, block.start + block.count)):
+            decoded.update(
+                block.decode([snapshots[-1][a] for a in range(block.start, block.start + block.count)])
+            )
+    print(f"\nКарту записано: {args.output} ({len(register_map.plan())} запитів на опитування)")
+    for name, value in sorted(decoded.items()):
+        print(f"  {name} = {value:g}")
+    if missing:
+        print(f"Увага: без {', '.join(missing)} цикл керування з цією картою не запуститься")
+    else:
+        print(f"Використання: REGISTER_MAP_FILE={args.output}")
+
+
+def scan_registers(argv: list[str]) -> None:
+    """
+    CLI: python main.py scan [--start N] [--end N] [--known поле=значення ...]
+    [--reference CSV] [--output FILE].
+
+    Шукає регістри, що читаються, робить кілька знімків з інтервалом і
+    зіставляє їх з відомими величинами: --known (значення з дисплея
+    інвертора на момент сканування, для повільних величин як SOC) або
+    --reference (ряди з часом, напр. експорт історії Home Assistant).
+    Найкращі відповідники записуються у файл формату REGISTER_MAP_FILE.
+    Еталон, експортований після сканування, зіставляється зі збереженими
+    знімками без повторного читання: --dump, потім --from-dump.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="main.py scan", description="Пошук регістрів інвертора та побудова карти"
+    )
+    parser.add_argument("--address", default=LOGGER_IP, help="IP logger (LOGGER_IP)")
+    parser.add_argument("--port", type=int, default=LOGGER_PORT, help="Порт logger (LOGGER_PORT)")
+    parser.add_argument("--start", type=int, default=0, help="Перша адреса")
+    parser.add_argument("--end", type=int, default=1000, help="Кінець діапазону, не включно")
+    parser.add_argument("--block", type=int, default=MAX_REGISTERS_PER_READ, help="Максимум регістрів у запиті")
+    parser.add_argument("--connections", type=int, default=1, help="Паралельні з'єднання з logger")
+    parser.add_argument("--pace-sec", type=float, default=0.2, help="Мінімальна пауза між запитами")
+    parser.add_argument("--exhaustive", action="store_true", help="Перевіряти кожну адресу прогалин")
+    parser.add_argument("--snapshots", type=int, default=10, help="Кількість знімків")
+    parser.add_argument("--every", type=float, default=30.0, help="Інтервал між знімками (сек)")
+    parser.add_argument("--known", action="append", default=[], metavar="ПОЛЕ=ЗНАЧЕННЯ",
+                        help="Відоме значення під час сканування (можна кілька)")
+    parser.add_argument("--reference", help="CSV з колонкою timestamp та колонками полів")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Допустима середня відносна похибка")
+    parser.add_argument("--top", type=int, default=3, help="Скільки кандидатів показувати")
+    parser.add_argument("--output", default="register_map.json", help="Файл карти")
+    parser.add_argument("--dump", help="CSV зі значеннями всіх знайдених регістрів у кожному знімку")
+    parser.add_argument("--from-dump", help="Зіставити знімки з файлу --dump замість сканування")
+    args = parser.parse_args(argv)
+    if not args.address and not args.from_dump:
+        parser.error("не задано --address (LOGGER_IP)")
+    if not 0 <= args.start < args.end <= 65536:
+        parser.error("потрібно 0 <= --start < --end <= 65536")
+    if args.connections < 1 or args.snapshots < 1:
+        parser.error("--connections та --snapshots мають бути не менше 1")
+
+    references: Dict[str, Callable[[float], Optional[float]]] = {}
+    if args.reference:
+        try:
+            series = load_scan_reference(args.reference)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"не вдалося прочитати {args.reference}: {e}")
+        for name, points in series.items():
+            references[name] = functools.partial(reference_value, points)
+    for item in args.known:
+        name, _, value = item.partition("=")
+        try:
+            constant = float(value)
+        except ValueError:
+            parser.error(f"--known {item}: очікується поле=число")
+        references[name.strip()] = lambda _timestamp, constant=constant: constant
+    if not references and not args.dump:
+        parser.error("потрібні відомі величини (--known поле=значення, --reference CSV) або --dump")
+    missing = [name for name in REQUIRED_FIELDS if name not in references]
+    if references and missing:
+        logger.warning(f"Немає еталонів для {', '.join(missing)}: карта буде неповною")
+
+    if args.from_dump:
+        try:
+            times, snapshots = load_register_dump(args.from_dump)
+        except (OSError, ValueError) as e:
+            parser.error(f"не вдалося прочитати {args.from_dump}: {e}")
+    else:
+        times, snapshots = asyncio.run(collect_register_snapshots(args))
+    if not references:
+        print(f"Карта: python main.py scan --from-dump {args.dump} --reference <CSV за час сканування>")
+        return
+    write_scanned_register_map(args, references, times, snapshots)
 
 
 # ============================================================
@@ -632,6 +7092,12 @@ def control_loop() -> None:
 
 def main() -> None:
     """Основна точка входу програми."""
+    if sys.argv[1:2] == ["sessions"]:
+        print_session_summary(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["scan"]:
+        scan_registers(sys.argv[2:])
+        return
     try:
         control_loop()
     except Exception as e:
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Локальні симулятори пристроїв для тестування без реального обладнання.
+
+- SolarmanV5Simulator: Data Logger Stick Deye (Solarman V5 + Modbus RTU)
+- TuyaSimulator: зарядка Feyree (Tuya local protocol 3.3 / 3.4)
+
+Обидва симулятори працюють на asyncio, підтримують штучну затримку, джиттер
+та ін'єкцію помилок (FaultProfile). SimulatorThread запускає їх у фоновому
+потоці з власним event loop, щоб основний код працював як з реальними пристроями.
+
+Запуск окремо (напр. для ручної перевірки main.py):
+    python simulators.py --logger-port 8899 --tuya-port 6668
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import struct
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from hashlib import sha256
+from typing import Dict, List, Optional, Tuple
+
+import tinytuya
+
+logger = logging.getLogger("simulators")
+
+
+# ============================================================
+# Ін'єкція затримок та помилок
+# ============================================================
+
+
+@dataclass
+class FaultProfile:
+    """
+    Профіль затримок та помилок симульованого пристрою.
+
+    Атрибути:
+        latency_sec: Базова затримка відповіді
+        jitter_sec: Випадкова додаткова затримка (0..jitter_sec)
+        drop_rate: Ймовірність не відповісти на запит
+        disconnect_rate: Ймовірність розірвати TCP з'єднання замість відповіді
+        corrupt_rate: Ймовірність відповісти пошкодженим кадром
+        seed: Зерно генератора (None = випадкове)
+    """
+
+    latency_sec: float = 0.0
+    jitter_sec: float = 0.0
+    drop_rate: float = 0.0
+    disconnect_rate: float = 0.0
+    corrupt_rate: float = 0.0
+    seed: Optional[int] = None
+    rng: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    async def delay(self) -> None:
+        """Очікує базову затримку плюс випадковий джиттер."""
+        pause = self.latency_sec
+        if self.jitter_sec > 0:
+            pause += self.rng.uniform(0.0, self.jitter_sec)
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    def pick(self) -> Optional[str]:
+        """
+        Обирає помилку для поточного запиту.
+
+        Returns:
+            "drop", "disconnect", "corrupt" або None (відповісти нормально)
+        """
+        roll = self.rng.random()
+        for name, rate in (
+            ("drop", self.drop_rate),
+            ("disconnect", self.disconnect_rate),
+            ("corrupt", self.corrupt_rate),
+        ):
+            if roll < rate:
+                return name
+            roll -= rate
+        return None
+
+
+@dataclass
+class SimulatorStats:
+    """Лічильники симулятора (читаються бенчмарком та soak тестом)."""
+
+    connections: int = 0
+    requests: int = 0
+    responses: int = 0
+    faults: Dict[str, int] = field(default_factory=dict)
+
+    def count_fault(self, name: str) -> None:
+        self.faults[name] = self.faults.get(name, 0) + 1
+
+
+class _TcpSimulator:
+    """Базовий asyncio TCP сервер з ін'єкцією помилок."""
+
+    def __init__(self, host: str, port: int, faults: Optional[FaultProfile]):
+        self.host = host
+        self.port = port
+        self.faults = faults or FaultProfile()
+        self.stats = SimulatorStats()
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._writers: set = set()
+
+    async def start(self) -> None:
+        """Запускає сервер (port=0 = вільний порт, реальний порт у self.port)."""
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"{type(self).__name__} слухає {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        """Зупиняє сервер і закриває всі клієнтські з'єднання."""
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats.connections += 1
+        self._writers.add(writer)
+        try:
+            await self._handle(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Зупинка симулятора: завершуємо обробник без помилки в колбеку asyncio
+            pass
+        except Exception as e:
+            logger.warning(f"{type(self).__name__}: помилка обробки з'єднання: {e}")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        raise NotImplementedError
+
+    async def _inject(self, writer: asyncio.StreamWriter) -> Optional[str]:
+        """
+        Застосовує затримку та обирає помилку для запиту.
+
+        Returns:
+            Назва помилки ("drop", "corrupt") або None.
+            При "disconnect" з'єднання закривається і піднімається ConnectionError.
+        """
+        await self.faults.delay()
+        fault = self.faults.pick()
+        if fault is not None:
+            self.stats.count_fault(fault)
+        if fault == "disconnect":
+            writer.close()
+            raise ConnectionError("симульований розрив з'єднання")
+        return fault
+
+
+# ============================================================
+# Deye інвертор (Solarman V5 + Modbus RTU)
+# ============================================================
+
+
+def modbus_crc16(data: bytes) -> bytes:
+    """CRC16 Modbus (poly 0xA001, init 0xFFFF), little-endian."""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack("<H", crc)
+
+
+class SolarmanV5Simulator(_TcpSimulator):
+    """
+    Симулятор Data Logger Stick з Modbus регістрами Deye.
+
+    Підтримує функції 0x03/0x04 (читання), 0x06/0x10 (запис).
+    Регістри зберігаються в масиві uint16 на весь адресний простір.
+    readable_ranges обмежує адреси, що читаються (решта повертає
+    Modbus exception 0x02), щоб імітувати реальну карту пристрою.
+    """
+
+    # Адреси регістрів SUN-10K (дзеркалять DEFAULT_REGISTER_FIELDS у main.py)
+    REG_GRID_L1 = 167
+    REG_GRID_L2 = 168
+    REG_GRID_POWER = 169
+    REG_GRID_CT = 172
+    REG_INVERTER_POWER = 175
+    REG_LOAD_POWER = 178
+    REG_BATTERY_VOLTAGE = 183
+    REG_BATTERY_SOC = 184
+    REG_PV1_POWER = 186
+    REG_PV2_POWER = 187
+    REG_BATTERY_POWER = 190
+    REG_BATTERY_CURRENT = 191
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        logger_sn: int = 0,
+        slave_id: int = 1,
+        faults: Optional[FaultProfile] = None,
+        readable_ranges: Optional[List[Tuple[int, int]]] = None,
+    ):
+        super().__init__(host, port, faults)
+        self.logger_sn = logger_sn
+        self.slave_id = slave_id
+        self.readable_ranges = readable_ranges
+        self.registers = array("H", bytes(2 * 65536))
+        self.set_state(battery_soc_pct=95, grid_power_w=-500, pv_power_w=4000, load_power_w=800)
+
+    def set_register(self, address: int, value: int) -> None:
+        """Записує значення регістра (від'ємні значення як int16)."""
+        self.registers[address] = value & 0xFFFF
+
+    def set_state(
+        self,
+        battery_soc_pct: Optional[float] = None,
+        grid_power_w: Optional[float] = None,
+        pv_power_w: Optional[float] = None,
+        load_power_w: Optional[float] = None,
+        battery_power_w: Optional[float] = None,
+        battery_voltage_v: Optional[float] = None,
+    ) -> None:
+        """Встановлює стан інвертора через регістри карти SUN-10K."""
+        if battery_soc_pct is not None:
+            self.set_register(self.REG_BATTERY_SOC, int(battery_soc_pct))
+        if grid_power_w is not None:
+            self.set_register(self.REG_GRID_POWER, int(grid_power_w))
+            self.set_register(self.REG_GRID_CT, int(grid_power_w))
+            self.set_register(self.REG_GRID_L1, int(grid_power_w))
+        if pv_power_w is not None:
+            self.set_register(self.REG_PV1_POWER, int(pv_power_w))
+            self.set_register(self.REG_PV2_POWER, 0)
+        if load_power_w is not None:
+            self.set_register(self.REG_LOAD_POWER, int(load_power_w))
+            self.set_register(self.REG_INVERTER_POWER, int(load_power_w))
+        if battery_power_w is not None:
+            self.set_register(self.REG_BATTERY_POWER, int(battery_power_w))
+        if battery_voltage_v is not None:
+            self.set_register(self.REG_BATTERY_VOLTAGE, int(battery_voltage_v * 100))
+
+    def _readable(self, address: int, count: int) -> bool:
+        if address + count > 65536:
+            return False
+        if self.readable_ranges is None:
+            return True
+        return any(
+            start <= address and address + count <= end
+            for start, end in self.readable_ranges
+        )
+
+    def _modbus(self, frame: bytes) -> Optional[bytes]:
+        """Обробляє Modbus RTU кадр і повертає відповідь (None = не відповідати)."""
+        if len(frame) < 4 or modbus_crc16(frame[:-2]) != frame[-2:]:
+            return None
+        slave, func = frame[0], frame[1]
+        if slave != self.slave_id:
+            return None
+
+        if func in (0x03, 0x04):
+            address, count = struct.unpack(">HH", frame[2:6])
+            if not 1 <= count <= 125:
+                body = bytes([slave, func | 0x80, 0x03])
+            elif not self._readable(address, count):
+                body = bytes([slave, func | 0x80, 0x02])
+            else:
+                values = self.registers[address : address + count]
+                body = bytes([slave, func, 2 * count]) + struct.pack(f">{count}H", *values)
+        elif func == 0x06:
+            address, value = struct.unpack(">HH", frame[2:6])
+            self.registers[address] = value
+            body = frame[:6]
+        elif func == 0x10:
+            address, count = struct.unpack(">HH", frame[2:6])
+            values = struct.unpack(f">{count}H", frame[7 : 7 + 2 * count])
+            self.registers[address : address + count] = array("H", values)
+            body = frame[:6]
+        else:
+            body = bytes([slave, func | 0x80, 0x01])
+        return body + modbus_crc16(body)
+
+    def _v5_response(self, sequence: bytes, modbus: bytes) -> bytes:
+        """Формує Solarman V5 відповідь (control code 0x1510)."""
+        now = int(time.time()) & 0xFFFFFFFF
+        payload = (
+            bytes([0x02, 0x01])
+            + struct.pack("<III", now, 0, 0)
+            + modbus
+        )
+        header = (
+            bytes([0xA5])
+            + struct.pack("<H", len(payload))
+            + struct.pack("<H", 0x1510)
+            + sequence
+            + struct.pack("<I", self.logger_sn)
+        )
+        frame = header + payload
+        checksum = sum(frame[1:]) & 0xFF
+        return frame + bytes([checksum, 0x15])
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            head = await reader.readexactly(3)
+            if head[0] != 0xA5:
+                return
+            length = struct.unpack("<H", head[1:3])[0]
+            rest = await reader.readexactly(length + 10)
+            frame = head + rest
+            self.stats.requests += 1
+
+            serial = struct.unpack("<I", frame[7:11])[0]
+            if self.logger_sn and serial != self.logger_sn:
+                continue
+            sequence = frame[5:7]
+            # payload: frametype(1) + sensortype(2) + 3×4 часові поля, далі Modbus
+            modbus = frame[11 + 15 : -2]
+
+            fault = await self._inject(writer)
+            if fault == "drop":
+                continue
+            response = self._modbus(modbus)
+            if response is None:
+                continue
+            data = self._v5_response(sequence, response)
+            if fault == "corrupt":
+                data = data[:-2] + bytes([(data[-2] + 1) & 0xFF, 0x15])
+            writer.write(data)
+            await writer.drain()
+            self.stats.responses += 1
+
+
+# ============================================================
+# Feyree зарядка (Tuya local protocol)
+# ============================================================
+
+DEFAULT_TUYA_DPS = {
+    "3": 0,  # work_state (код стану пристрою, у моделі не змінюється)
+    "10": 1,
+    "14": "charge_now",
+    "18": False,  # ВВІМК/ВИМК
+    "101": "finish",  # статус зарядки ("charing" / "finish")
+    "102": 0,  # енергія сесії
+    "114": 16,
+    "115": 16,  # max_current
+    "120": 0,
+    "123": False,  # старт/стоп зарядки
+    "124": "CloseCharging",
+}
+
+
+@dataclass
+class _TuyaSession:
+    """Стан одного TCP з'єднання (ключ сесії для протоколу 3.4)."""
+
+    key: bytes
+    local_nonce: bytes = b""
+    remote_nonce: bytes = b""
+
+
+class TuyaSimulator(_TcpSimulator):
+    """
+    Симулятор зарядки Feyree з Tuya local protocol 3.3 / 3.4.
+
+    Обробляє DP_QUERY, CONTROL, CONTROL_NEW, HEART_BEAT, UPDATEDPS та
+    узгодження ключа сесії (3.4). Після кожної зміни DPS розсилає STATUS
+    всім підключеним клієнтам, як це робить реальний пристрій.
+    Моменти застосування команд зберігаються в actuations для вимірювання
+    часу від рішення до виконання.
+
+    За замовчуванням STATUS містить лише DPS, що змінились; з
+    echo_commanded=True - також кожен DPS з команди (частина прошивок Tuya
+    так звітує навіть про незмінні значення).
+    """
+
+    def __init__(
+        self,
+        device_id: str,
+        local_key: str,
+        version: float = 3.3,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        faults: Optional[FaultProfile] = None,
+        dps: Optional[Dict[str, object]] = None,
+        echo_commanded: bool = False,
+    ):
+        super().__init__(host, port, faults)
+        self.device_id = device_id
+        self.echo_commanded = echo_commanded
+        self.local_key = local_key.encode("latin1")
+        self.version = float(version)
+        self.version_header = str(self.version).encode() + tinytuya.PROTOCOL_3x_HEADER
+        self.dps: Dict[str, object] = dict(DEFAULT_TUYA_DPS if dps is None else dps)
+        # (monotonic час, змінені DPS) для кожної застосованої команди
+        self.actuations: List[Tuple[float, Dict[str, object]]] = []
+        self._sessions: Dict[asyncio.StreamWriter, _TuyaSession] = {}
+
+    # ---------- модель пристрою ----------
+
+    def apply_dps(self, changes: Dict[str, object]) -> Dict[str, object]:
+        """
+        Застосовує зміни DPS з моделлю поведінки зарядки.
+
+        Returns:
+            DPS, значення яких дійсно змінилось
+        """
+        updated = dict(changes)
+        if "123" in changes or "18" in changes:
+            charging = bool(changes.get("123", changes.get("18")))
+            updated["101"] = "charing" if charging else "finish"
+            updated["124"] = "OpenCharging" if charging else "CloseCharging"
+        changed = {k: v for k, v in updated.items() if self.dps.get(k) != v}
+        self.dps.update(changed)
+        if changed:
+            self.actuations.append((time.monotonic(), changed))
+        return changed
+
+    def set_dps(self, changes: Dict[str, object]) -> None:
+        """Змінює DPS ззовні (імітація дій на самому пристрої) і розсилає STATUS."""
+        changed = {k: v for k, v in changes.items() if self.dps.get(k) != v}
+        self.dps.update(changed)
+        if changed:
+            for writer in list(self._sessions):
+                self._push_status(writer, changed)
+
+    # ---------- кодування ----------
+
+    def _decrypt(self, session: _TuyaSession, payload: bytes) -> bytes:
+        if not payload:
+            return b""
+        cipher = tinytuya.AESCipher(session.key)
+        if self.version >= 3.4:
+            payload = cipher.decrypt(payload, False, decode_text=False)
+            if payload.startswith(self.version_header[:3]):
+                payload = payload[len(self.version_header) :]
+            return payload
+        if payload.startswith(self.version_header[:3]):
+            payload = payload[len(self.version_header) :]
+        return cipher.decrypt(payload, False, decode_text=False)
+
+    def _encode(self, session: _TuyaSession, cmd: int, payload: bytes) -> bytes:
+        if not payload:
+            return b""
+        cipher = tinytuya.AESCipher(session.key)
+        if self.version >= 3.4:
+            if cmd not in tinytuya.NO_PROTOCOL_HEADER_CMDS:
+                payload = self.version_header + payload
+            return cipher.encrypt(payload, False)
+        payload = cipher.encrypt(payload, False)
+        if cmd not in tinytuya.NO_PROTOCOL_HEADER_CMDS:
+            payload = self.version_header + payload
+        return payload
+
+    def _pack(self, session: _TuyaSession, seqno: int, cmd: int, payload: bytes) -> bytes:
+        """Пакує відповідь пристрою (55AA + retcode + payload + CRC/HMAC)."""
+        body = struct.pack(">I", 0) + self._encode(session, cmd, payload)
+        msg = tinytuya.TuyaMessage(seqno, cmd, 0, body, 0, True, tinytuya.PREFIX_55AA_VALUE, None)
+        hmac_key = session.key if self.version >= 3.4 else None
+        return tinytuya.pack_message(msg, hmac_key=hmac_key)
+
+    def _status_payload(self, dps: Dict[str, object]) -> bytes:
+        t = int(time.time())
+        if self.version >= 3.4:
+            body = {"protocol": 4, "t": t, "data": {"dps": dps}}
+        else:
+            body = {"devId": self.device_id, "dps": dps, "t": t}
+        return json.dumps(body, separators=(",", ":")).encode()
+
+    def _push_status(self, writer: asyncio.StreamWriter, dps: Dict[str, object]) -> None:
+        session = self._sessions.get(writer)
+        if session is None or writer.is_closing():
+            return
+        writer.write(self._pack(session, 0, tinytuya.STATUS, self._status_payload(dps)))
+
+    # ---------- обробка з'єднання ----------
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = _TuyaSession(key=self.local_key)
+        self._sessions[writer] = session
+        header_size = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_55AA)
+        try:
+            while True:
+                header = await reader.readexactly(header_size)
+                prefix, seqno, cmd, length = struct.unpack(
+                    tinytuya.MESSAGE_HEADER_FMT_55AA, header
+                )
+                if prefix != tinytuya.PREFIX_55AA_VALUE:
+                    return
+                data = header + await reader.readexactly(length)
+                self.stats.requests += 1
+
+                hmac_key = session.key if self.version >= 3.4 else None
+                msg = tinytuya.unpack_message(data, hmac_key=hmac_key, no_retcode=True)
+                if not msg.crc_good:
+                    logger.warning("TuyaSimulator: неправильний CRC/HMAC запиту")
+                    continue
+
+                fault = await self._inject(writer)
+                if fault == "drop":
+                    continue
+                replies = self._dispatch(session, msg)
+                for reply in replies:
+                    if fault == "corrupt":
+                        reply = reply[:-5] + bytes([reply[-5] ^ 0xFF]) + reply[-4:]
+                    writer.write(reply)
+                if replies:
+                    self.stats.responses += 1
+                await writer.drain()
+                if session.local_nonce and session.remote_nonce and msg.cmd == tinytuya.SESS_KEY_NEG_FINISH:
+                    self._finish_negotiation(session)
+        finally:
+            self._sessions.pop(writer, None)
+
+    def _finish_negotiation(self, session: _TuyaSession) -> None:
+        xored = bytes(a ^ b for a, b in zip(session.local_nonce, session.remote_nonce))
+        cipher = tinytuya.AESCipher(self.local_key)
+        session.key = cipher.encrypt(xored, False, pad=False)
+        session.local_nonce = session.remote_nonce = b""
+
+    def _dispatch(self, session: _TuyaSession, msg) -> List[bytes]:
+        """Обробляє команду і повертає список кадрів для відправки."""
+        cmd = msg.cmd
+
+        if cmd == tinytuya.SESS_KEY_NEG_START:
+            cipher = tinytuya.AESCipher(self.local_key)
+            session.local_nonce = cipher.decrypt(msg.payload, False, decode_text=False)[:16]
+            session.remote_nonce = os.urandom(16)
+            proof = hmac.new(self.local_key, session.local_nonce, sha256).digest()
+            return [
+                self._pack(session, msg.seqno, tinytuya.SESS_KEY_NEG_RESP, session.remote_nonce + proof)
+            ]
+
+        if cmd == tinytuya.SESS_KEY_NEG_FINISH:
+            # Відповіді немає; ключ сесії застосовується після обробки кадру
+            return []
+
+        payload = self._decrypt(session, msg.payload)
+        request = json.loads(payload) if payload.startswith(b"{") else {}
+
+        if cmd in (tinytuya.DP_QUERY, tinytuya.DP_QUERY_NEW):
+            return [self._pack(session, msg.seqno, cmd, self._status_payload(dict(self.dps)))]
+
+        if cmd == tinytuya.HEART_BEAT:
+            return [self._pack(session, msg.seqno, cmd, b"")]
+
+        if cmd in (tinytuya.CONTROL, tinytuya.CONTROL_NEW):
+            dps = request.get("dps") or request.get("data", {}).get("dps") or {}
+            replies = [self._pack(session, msg.seqno, cmd, b"")]
+            commanded = {str(k): v for k, v in dps.items()}
+            changed = self.apply_dps(commanded)
+            report = {**commanded, **changed} if self.echo_commanded else changed
+            if report:
+                status = self._status_payload(report)
+                for writer, other in self._sessions.items():
+                    if other is session:
+                        replies.append(self._pack(session, 0, tinytuya.STATUS, status))
+                    elif not writer.is_closing():
+                        writer.write(self._pack(other, 0, tinytuya.STATUS, status))
+            return replies
+
+        if cmd == tinytuya.UPDATEDPS:
+            requested = [str(i) for i in request.get("dpId", [])] or list(self.dps)
+            dps = {k: self.dps[k] for k in requested if k in self.dps}
+            return [
+                self._pack(session, msg.seqno, cmd, b""),
+                self._pack(session, 0, tinytuya.STATUS, self._status_payload(dps)),
+            ]
+
+        logger.debug(f"TuyaSimulator: невідома команда {cmd}")
+        return []
+
+
+# ============================================================
+# Запуск у фоновому потоці
+# ============================================================
+
+
+class SimulatorThread(threading.Thread):
+    """
+    Запускає симулятори у фоновому потоці з власним event loop.
+
+    Після start() порти симуляторів доступні в їх атрибутах port.
+    call() виконує функцію в потоці симуляторів (безпечна зміна стану).
+    """
+
+    def __init__(self, *simulators: _TcpSimulator):
+        super().__init__(name="simulators", daemon=True)
+        self.simulators = simulators
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            for simulator in self.simulators:
+                self.loop.run_until_complete(simulator.start())
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        self.loop.run_forever()
+        for simulator in self.simulators:
+            self.loop.run_until_complete(simulator.stop())
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+
+    def start(self) -> None:
+        super().start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def call(self, func, *args, **kwargs):
+        """Виконує func у потоці симуляторів і повертає результат."""
+        async def _call():
+            return func(*args, **kwargs)
+
+        return asyncio.run_coroutine_threadsafe(_call(), self.loop).result()
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+def main() -> None:
+    """Запускає обидва симулятори до Ctrl+C."""
+    parser = argparse.ArgumentParser(description="Симулятори Deye (Solarman V5) та Feyree (Tuya)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--logger-port", type=int, default=8899)
+    parser.add_argument("--logger-sn", type=int, default=0)
+    parser.add_argument("--tuya-port", type=int, default=6668)
+    parser.add_argument("--device-id", default="simulated-feyree")
+    parser.add_argument("--local-key", default="0123456789abcdef")
+    parser.add_argument("--version", type=float, default=3.3)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    def faults() -> FaultProfile:
+        return FaultProfile(args.latency, args.jitter, drop_rate=args.error_rate)
+
+    inverter = SolarmanV5Simulator(args.host, args.logger_port, args.logger_sn, faults=faults())
+    charger = TuyaSimulator(
+        args.device_id, args.local_key, args.version, args.host, args.tuya_port, faults=faults()
+    )
+
+    async def serve():
+        await inverter.start()
+        await charger.start()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logger.info("Симулятори зупинено")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Тривалий soak тест циклу керування на локальних симуляторах (пошук витоків).
+
+Проганяє async_control_loop() з мінімальним інтервалом проти
+SolarmanV5Simulator та TuyaSimulator з ін'єкцією розривів з'єднання,
+пошкоджених кадрів та втрачених відповідей (таймаутів). Стан інвертора
+перемикається між "надлишок" та "дефіцит", тому зарядка постійно
+вмикається і вимикається, а інвертор та зарядка перепідключаються.
+
+Кожні --sample-sec секунд записуються ресурси процесу: RSS, відкриті
+дескриптори, потоки ОС та пам'ять, відстежена tracemalloc. Після прогріву
+(--warmup секунд) ряд ділиться на чотири частини; ресурс вважається таким, що
+витікає, якщо медіана кожної частини більша за попередню і загальний
+приріст перевищує допуск. У цьому разі тест завершується з кодом 1 і
+виводить найбільші прирости алокацій tracemalloc (файл:рядок).
+
+Симулятори працюють у тому ж процесі, тому їхні ресурси також враховуються.
+
+Використання:
+    python soak.py --iterations 1000000 --disconnect-rate 0.01 --corrupt-rate 0.01
+    python soak.py --duration 3600 --sample-sec 30
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from simulators import FaultProfile, SimulatorThread, SolarmanV5Simulator, TuyaSimulator
+
+LOGGER_SN = 1234567890
+DEVICE_ID = "soak00feyree0device0"
+LOCAL_KEY = "0123456789abcdef"
+
+MB = 1024 * 1024
+
+
+@dataclass
+class ResourceSample:
+    """Ресурси процесу в один момент часу."""
+
+    elapsed_sec: float
+    iteration: int
+    rss_bytes: Optional[int]
+    open_fds: Optional[int]
+    threads: int
+    traced_bytes: Optional[int]
+
+
+def rss_bytes() -> Optional[int]:
+    """Поточний RSS процесу (Linux /proc; None, якщо недоступно)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def open_fds() -> Optional[int]:
+    """Кількість відкритих файлових дескрипторів (None, якщо недоступно)."""
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return None
+
+
+def os_threads() -> int:
+    """Кількість потоків ОС (включно з потоками поза threading)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return threading.active_count()
+
+
+def take_sample(started: float, iteration: int) -> ResourceSample:
+    return ResourceSample(
+        elapsed_sec=time.monotonic() - started,
+        iteration=iteration,
+        rss_bytes=rss_bytes(),
+        open_fds=open_fds(),
+        threads=os_threads(),
+        traced_bytes=tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+    )
+
+
+def keeps_growing(values: List[float], tolerance: float) -> bool:
+    """
+    Стійке зростання ряду: медіани чотирьох частин строго зростають
+    і остання більша за першу більш ніж на tolerance.
+    """
+    if len(values) < 8:
+        return False
+    size = len(values) // 4
+    medians = [statistics.median(values[i * size:(i + 1) * size]) for i in range(4)]
+    return all(b > a for a, b in zip(medians, medians[1:])) and medians[-1] - medians[0] > tolerance
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Soak тест циклу керування на симуляторах")
+    parser.add_argument("--iterations", type=int, default=1_000_000, help="Кількість ітерацій циклу")
+    parser.add_argument("--duration", type=float, default=0.0, help="Максимальна тривалість (сек, 0 = без обмеження)")
+    parser.add_argument("--interval", type=float, default=0.001, help="CHECK_INTERVAL_SEC")
+    parser.add_argument("--toggle-every", type=int, default=2, help="Змінювати стан інвертора кожні N ітерацій")
+    parser.add_argument("--disconnect-rate", type=float, default=0.005, help="Ймовірність розриву з'єднання")
+    parser.add_argument("--corrupt-rate", type=float, default=0.005, help="Ймовірність пошкодженого кадру")
+    parser.add_argument("--drop-rate", type=float, default=0.001, help="Ймовірність втрати відповіді (таймаут)")
+    parser.add_argument("--tuya-version", default="3.3", choices=("3.3", "3.4"))
+    parser.add_argument("--no-listener", action="store_true", help="FEYREE_PUSH_LISTENER=false")
+    parser.add_argument("--sample-sec", type=float, default=10.0, help="Період вимірювання ресурсів (сек)")
+    parser.add_argument("--warmup", type=float, default=60.0, help="Прогрів, що не оцінюється (сек)")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Без tracemalloc (швидше)")
+    parser.add_argument("--top", type=int, default=10, help="Кількість рядків звіту tracemalloc")
+    parser.add_argument("--rss-tolerance-mb", type=float, default=8.0, help="Допустимий приріст RSS (MB)")
+    parser.add_argument("--traced-tolerance-mb", type=float, default=2.0, help="Допустимий приріст tracemalloc (MB)")
+    parser.add_argument("--fd-tolerance", type=int, default=4, help="Допустимий приріст дескрипторів")
+    parser.add_argument("--thread-tolerance", type=int, default=2, help="Допустимий приріст потоків")
+    parser.add_argument("--seed", type=int, default=None, help="Зерно генераторів помилок")
+    parser.add_argument("--verbose", action="store_true", help="Не приглушувати логи main.py")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    def faults(seed_offset: int) -> FaultProfile:
+        return FaultProfile(
+            drop_rate=args.drop_rate,
+            disconnect_rate=args.disconnect_rate,
+            corrupt_rate=args.corrupt_rate,
+            seed=None if args.seed is None else args.seed + seed_offset,
+        )
+
+    inverter_sim = SolarmanV5Simulator(logger_sn=LOGGER_SN, faults=faults(0))
+    charger_sim = TuyaSimulator(DEVICE_ID, LOCAL_KEY, float(args.tuya_version), faults=faults(1))
+    simulators = SimulatorThread(inverter_sim, charger_sim)
+    simulators.start()
+
+    # Конфігурація main.py зчитується з ENV під час імпорту. Короткий бюджет
+    # читання та таймаут обмежують час ітерацій з втраченими відповідями
+    os.environ.update(
+        {
+            "LOGGER_IP": "127.0.0.1",
+            "LOGGER_PORT": str(inverter_sim.port),
+            "LOGGER_SN": str(LOGGER_SN),
+            "FEYREE_IP": "127.0.0.1",
+            "FEYREE_PORT": str(charger_sim.port),
+            "FEYREE_DEVICE_ID": DEVICE_ID,
+            "FEYREE_LOCAL_KEY": LOCAL_KEY,
+            "FEYREE_VERSION": args.tuya_version,
+            "FEYREE_PUSH_LISTENER": "false" if args.no_listener else "true",
+            "FEYREE_DISCOVERY": "false",
+            "CHECK_INTERVAL_SEC": str(args.interval),
+            "MIN_ON_TIME_SEC": "0",
+            "MIN_OFF_TIME_SEC": "0",
+            "MAX_COMMANDS_PER_HOUR": "0",
+            "GRID_IMPORT_MAX_SEC": "0",
+            "RETRY_DELAY_SEC": "0.01",
+            "RETRY_MAX_DELAY_SEC": "0.05",
+            "READ_BUDGET_SEC": "1",
+            "CONNECTION_TIMEOUT_SEC": "1",
+            "COMMAND_ACK_TIMEOUT_SEC": "1",
+            "BREAKER_FAILURE_THRESHOLD": "0",
+            "HISTORY_FILE": "",
+            "STATE_SNAPSHOT_FILE": "",
+            "SESSION_DB_FILE": "",
+            "CONFIG_WATCH_SEC": "0",
+        }
+    )
+    import main as controller
+
+    if not args.verbose:
+        logging.getLogger(controller.__name__).setLevel(logging.CRITICAL)
+
+    surplus = {"battery_soc_pct": 95, "grid_power_w": -1500, "pv_power_w": 5000}
+    deficit = {"battery_soc_pct": 40, "grid_power_w": 2500, "pv_power_w": 0}
+    samples: List[ResourceSample] = []
+    iterations = 0
+    errors = 0
+    baseline_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    if not args.no_tracemalloc:
+        tracemalloc.start(1)
+    started = time.monotonic()
+    next_sample = started
+
+    def on_iteration(info: Dict) -> None:
+        nonlocal iterations, errors, next_sample, baseline_snapshot
+        iterations = info["iteration"]
+        if info.get("error"):
+            errors += 1
+        if iterations % args.toggle_every == 0:
+            phase = (iterations // args.toggle_every) % 2
+            simulators.call(inverter_sim.set_state, **(deficit if phase else surplus))
+            # Журнал застосувань симулятора потрібен лише бенчмарку
+            simulators.call(charger_sim.actuations.clear)
+        now = time.monotonic()
+        if now >= next_sample:
+            next_sample = now + args.sample_sec
+            samples.append(take_sample(started, iterations))
+            last = samples[-1]
+            if baseline_snapshot is None and tracemalloc.is_tracing() and last.elapsed_sec >= args.warmup:
+                baseline_snapshot = tracemalloc.take_snapshot()
+            print(
+                f"[{last.elapsed_sec:8.0f} сек] ітерацій {iterations:>9}, "
+                f"RSS {(last.rss_bytes or 0) / MB:7.1f} MB, FD {last.open_fds}, "
+                f"потоків {last.threads}"
+                + ("" if last.traced_bytes is None else f", tracemalloc {last.traced_bytes / MB:6.2f} MB"),
+                flush=True,
+            )
+
+    async def run() -> None:
+        loop_task = asyncio.create_task(
+            controller.async_control_loop(max_iterations=args.iterations, on_iteration=on_iteration)
+        )
+        try:
+            await asyncio.wait_for(loop_task, args.duration if args.duration > 0 else None)
+        except asyncio.TimeoutError:
+            pass  # Тривалість вичерпано: цикл скасовано та закрито
+
+    fds_before = open_fds()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Перервано (Ctrl+C) - оцінка зібраних вимірювань")
+    elapsed = time.monotonic() - started
+    final_snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+    samples.append(take_sample(started, iterations))
+    fds_after = open_fds()
+    simulators.stop()
+
+    print("=" * 60)
+    print(
+        f"Ітерацій: {iterations} за {elapsed:.0f} сек ({iterations / max(elapsed, 1e-9):.0f}/сек), "
+        f"ітерацій з помилкою: {errors}"
+    )
+    print(f"Помилки симуляторів: інвертор {inverter_sim.stats.faults}, зарядка {charger_sim.stats.faults}")
+    print(
+        f"З'єднань з симуляторами: інвертор {inverter_sim.stats.connections}, "
+        f"зарядка {charger_sim.stats.connections}"
+    )
+    print(f"Дескриптори до запуску циклу: {fds_before}, після зупинки: {fds_after}")
+
+    measured = [s for s in samples if s.elapsed_sec >= args.warmup]
+    checks = (
+        ("RSS", [s.rss_bytes for s in measured], args.rss_tolerance_mb * MB, MB, "MB"),
+        ("tracemalloc", [s.traced_bytes for s in measured], args.traced_tolerance_mb * MB, MB, "MB"),
+        ("дескриптори", [s.open_fds for s in measured], args.fd_tolerance, 1, ""),
+        ("потоки", [s.threads for s in measured], args.thread_tolerance, 1, ""),
+    )
+    leaking = []
+    for name, values, tolerance, scale, unit in checks:
+        if not values or any(v is None for v in values):
+            print(f"{name}: немає даних")
+            continue
+        growing = keeps_growing(values, tolerance)
+        if growing:
+            leaking.append(name)
+        print(
+            f"{name}: {values[0] / scale:.1f} -> {values[-1] / scale:.1f}{unit} "
+            f"(мін {min(values) / scale:.1f}, макс {max(values) / scale:.1f}, вимірювань {len(values)}) - "
+            + ("ЗРОСТАЄ" if growing else "стабільно")
+        )
+    if len(measured) < 8:
+        print(f"Замало вимірювань після прогріву ({len(measured)} < 8) - збільште тривалість або зменште --sample-sec")
+
+    if final_snapshot is not None and baseline_snapshot is not None:
+        print("-" * 60)
+        print(f"Найбільші прирости алокацій після прогріву (tracemalloc, top {args.top}):")
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        diff = final_snapshot.filter_traces(filters).compare_to(
+            baseline_snapshot.filter_traces(filters), "lineno"
+        )
+        for stat in diff[: args.top]:
+            frame = stat.traceback[0]
+            print(
+                f"  {stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+7d} блоків  "
+                f"{frame.filename}:{frame.lineno}"
+            )
+    print("=" * 60)
+    if leaking:
+        print(f"ВИТІК: {', '.join(leaking)}")
+        sys.exit(1)
+    sys.exit(0 if iterations else 1)
+
+
+if __name__ == "__main__":
+    main()